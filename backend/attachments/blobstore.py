@@ -0,0 +1,241 @@
+'''
+Хранилище содержимого вложений с адресацией по SHA-256
+Части загрузки лежат под uploads/<id>/<номер>, собранный файл — под
+blobs/<sha[:2]>/<sha>, поэтому одинаковое содержимое хранится один раз.
+BLOB_STORE выбирает реализацию: s3 (по умолчанию, бакет S3_BUCKET; нужен
+boto3) или local (каталог BLOB_STORE_PATH). Экземпляры функции не делят
+диск, поэтому local годится только для локального запуска и тестов и
+включается явно.
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+BLOB_STORE = os.environ.get('BLOB_STORE', 's3')
+BLOB_STORE_PATH = os.environ.get('BLOB_STORE_PATH', os.path.join(tempfile.gettempdir(), 'attachments'))
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+# Ссылка на скачивание прямо из S3 живёт столько секунд
+S3_URL_TTL_SECONDS = int(os.environ.get('S3_URL_TTL_SECONDS', '300'))
+READ_BLOCK_SIZE = 64 * 1024
+
+class MissingPartsError(Exception):
+    '''В хранилище нет части загрузки, хотя в БД она отмечена принятой'''
+    
+    def __init__(self, indexes: List[int]):
+        super().__init__(f'missing upload parts: {indexes}')
+        self.indexes = indexes
+
+def blob_key(sha256: str) -> str:
+    return f'blobs/{sha256[:2]}/{sha256}'
+
+def part_key(upload_id: int, index: int) -> str:
+    return f'uploads/{upload_id}/{index}'
+
+class LocalBlobStore:
+    '''Файлы в локальном каталоге; запись через временный файл и os.replace'''
+    
+    def __init__(self, root: str):
+        self.root = root
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+    
+    def _write(self, key: str, chunks: Iterator[bytes]) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    
+    def put_part(self, upload_id: int, index: int, data: bytes) -> None:
+        self._write(part_key(upload_id, index), iter([data]))
+    
+    def missing_parts(self, upload_id: int, count: int) -> List[int]:
+        return [index for index in range(count) if not os.path.exists(self._path(part_key(upload_id, index)))]
+    
+    def read_parts(self, upload_id: int, count: int) -> Iterator[bytes]:
+        for index in range(count):
+            try:
+                part = open(self._path(part_key(upload_id, index)), 'rb')
+            except FileNotFoundError:
+                raise MissingPartsError([index])
+            with part:
+                while True:
+                    block = part.read(READ_BLOCK_SIZE)
+                    if not block:
+                        break
+                    yield block
+    
+    def delete_parts(self, upload_id: int) -> None:
+        shutil.rmtree(self._path(f'uploads/{upload_id}'), ignore_errors=True)
+    
+    def assemble(self, upload_id: int, count: int) -> Tuple[str, int, bool]:
+        '''
+        Склеить части в blob за один проход с подсчётом SHA-256
+        Returns: (sha256, size, created); created = False, если такое
+        содержимое уже было и склеенная копия выброшена
+        '''
+        staging = os.path.join(self.root, 'staging')
+        os.makedirs(staging, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=staging)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for block in self.read_parts(upload_id, count):
+                    digest.update(block)
+                    size += len(block)
+                    tmp.write(block)
+            sha256 = digest.hexdigest()
+            path = self._path(blob_key(sha256))
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+                return sha256, size, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            return sha256, size, True
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    
+    def read_range(self, sha256: str, start: int, end: int) -> Iterator[bytes]:
+        '''Байты start..end включительно блоками, без чтения файла целиком'''
+        with open(self._path(blob_key(sha256)), 'rb') as blob:
+            blob.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = blob.read(min(READ_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+    
+    def url(self, sha256: str, file_name: str) -> Optional[str]:
+        '''Локальные файлы отдаёт сама функция'''
+        return None
+
+class S3BlobStore:
+    '''Объекты в бакете S3-совместимого хранилища'''
+    
+    def __init__(self, bucket: Optional[str]):
+        if boto3 is None:
+            raise RuntimeError('BLOB_STORE=s3 requires boto3')
+        if not bucket:
+            raise RuntimeError('BLOB_STORE=s3 requires S3_BUCKET; set BLOB_STORE=local only for local runs')
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+    
+    def put_part(self, upload_id: int, index: int, data: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=part_key(upload_id, index), Body=data)
+    
+    def missing_parts(self, upload_id: int, count: int) -> List[int]:
+        present = set()
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f'uploads/{upload_id}/'):
+            present.update(item['Key'] for item in page.get('Contents', []))
+        return [index for index in range(count) if part_key(upload_id, index) not in present]
+    
+    def read_parts(self, upload_id: int, count: int) -> Iterator[bytes]:
+        for index in range(count):
+            try:
+                part = self.client.get_object(Bucket=self.bucket, Key=part_key(upload_id, index))
+            except self.client.exceptions.NoSuchKey:
+                raise MissingPartsError([index])
+            yield from part['Body'].iter_chunks(READ_BLOCK_SIZE)
+    
+    def delete_parts(self, upload_id: int) -> None:
+        # Страница листинга — не больше 1000 ключей, столько же принимает delete_objects
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f'uploads/{upload_id}/'):
+            keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys, 'Quiet': True})
+    
+    def _exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError:
+            return False
+        return True
+    
+    def assemble(self, upload_id: int, count: int) -> Tuple[str, int, bool]:
+        '''
+        Ключ blob известен только после хеширования, поэтому части читаются
+        дважды: для SHA-256 и, если такого содержимого ещё нет, для загрузки
+        '''
+        digest = hashlib.sha256()
+        size = 0
+        for block in self.read_parts(upload_id, count):
+            digest.update(block)
+            size += len(block)
+        sha256 = digest.hexdigest()
+        if self._exists(blob_key(sha256)):
+            return sha256, size, False
+        self.client.upload_fileobj(PartsReader(self.read_parts(upload_id, count)), self.bucket, blob_key(sha256))
+        return sha256, size, True
+    
+    def read_range(self, sha256: str, start: int, end: int) -> Iterator[bytes]:
+        blob = self.client.get_object(Bucket=self.bucket, Key=blob_key(sha256), Range=f'bytes={start}-{end}')
+        yield from blob['Body'].iter_chunks(READ_BLOCK_SIZE)
+    
+    def url(self, sha256: str, file_name: str) -> Optional[str]:
+        '''Подписанная ссылка: байты идут клиенту из S3 мимо функции'''
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': blob_key(sha256),
+            'ResponseContentDisposition': content_disposition(file_name)
+        }, ExpiresIn=S3_URL_TTL_SECONDS)
+
+class PartsReader:
+    '''Файлоподобный объект для upload_fileobj поверх генератора блоков'''
+    
+    def __init__(self, blocks: Iterator[bytes]):
+        self._blocks = blocks
+        self._buffer = b''
+    
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._blocks)
+            except StopIteration:
+                break
+        if size < 0:
+            chunk, self._buffer = self._buffer, b''
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+def content_disposition(file_name: str) -> str:
+    '''Content-Disposition с именем файла в RFC 5987 для не-ASCII имён'''
+    fallback = file_name.encode('ascii', 'replace').decode().replace('"', '')
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quote(file_name)}'
+
+_store = None
+
+def get_store():
+    '''Хранилище по BLOB_STORE; создаётся один раз на экземпляр'''
+    global _store
+    if _store is None:
+        if BLOB_STORE == 's3':
+            _store = S3BlobStore(S3_BUCKET)
+        elif BLOB_STORE == 'local':
+            _store = LocalBlobStore(BLOB_STORE_PATH)
+        else:
+            raise RuntimeError(f'Unknown BLOB_STORE {BLOB_STORE!r}: use s3 or local')
+    return _store
@@ -0,0 +1,589 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+from datetime import date
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from blobstore import MissingPartsError, content_disposition, get_store
+from db import connection
+from instrumentation import instrumented, phase
+from responses import dumps, encoded
+from session import authenticate
+
+# Размер части загрузки; в base64 часть должна помещаться в тело запроса
+ATTACHMENT_CHUNK_SIZE = int(os.environ.get('ATTACHMENT_CHUNK_SIZE', str(1024 * 1024)))
+MAX_ATTACHMENT_SIZE = int(os.environ.get('MAX_ATTACHMENT_SIZE', str(100 * 1024 * 1024)))
+# Больше этого за один ответ не отдаётся: остальное клиент догружает по Range
+MAX_DOWNLOAD_WINDOW = int(os.environ.get('MAX_DOWNLOAD_WINDOW', str(3 * 1024 * 1024)))
+MAX_FILE_NAME_LENGTH = 255
+MAX_CONTENT_TYPE_LENGTH = 100
+# Для дедупликации клиент доказывает владение содержимым хешем этого
+# числа байт со случайного смещения, а не одним известным ему sha256
+PROOF_LENGTH = 64 * 1024
+# Незавершённая загрузка старше этого считается брошенной и удаляется с частями
+STALE_UPLOAD_HOURS = int(os.environ.get('STALE_UPLOAD_HOURS', '48'))
+STALE_UPLOAD_SWEEP_LIMIT = 100
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+ATTACHMENT_COLUMNS = 'id, file_name, content_type, size, chunk_size, received_chunks, status, sha256'
+
+_stale_swept_on: Optional[date] = None
+
+@instrumented('attachments')
+@encoded
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Вложения: возобновляемая загрузка частями и скачивание по Range
+    Args: event с httpMethod, headers {Authorization или X-User-Id},
+          queryStringParameters {id, index, action}, body
+    Returns: HTTP response с состоянием загрузки или байтами файла
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Session-Token, X-User-Id, Range, If-None-Match',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    user_id = authenticate(event)
+    if not user_id:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    params = event.get('queryStringParameters') or {}
+    action = params.get('action')
+    
+    attachment_id = None
+    if params.get('id'):
+        try:
+            attachment_id = int(params['id'])
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': 'id must be an integer'}),
+                'isBase64Encoded': False
+            }
+    
+    if method in ('PUT', 'GET') or action == 'complete':
+        if attachment_id is None:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': 'id required'}),
+                'isBase64Encoded': False
+            }
+    
+    with connection() as conn:
+        if method == 'POST':
+            if action == 'complete':
+                return complete_upload(conn, event, attachment_id, user_id)
+            sweep_stale_uploads(conn)
+            return start_upload(conn, event, user_id)
+        elif method == 'PUT':
+            return upload_chunk(conn, event, attachment_id, user_id)
+        elif method == 'GET':
+            if action == 'status':
+                return upload_status(conn, attachment_id, user_id)
+            return download(conn, event, attachment_id, user_id)
+        else:
+            return {
+                'statusCode': 405,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': 'Method not allowed'}),
+                'isBase64Encoded': False
+            }
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    return (size + chunk_size - 1) // chunk_size
+
+def attachment_to_dict(row) -> Dict[str, Any]:
+    '''
+    Строка attachments (id, file_name, content_type, size, chunk_size, received_chunks, status, sha256)
+    sha256 наружу не отдаётся: по нему нельзя получить чужое содержимое
+    '''
+    attachment_id, file_name, content_type, size, chunk_size, received, status, _ = row[:8]
+    return {
+        'id': attachment_id,
+        'fileName': file_name,
+        'contentType': content_type,
+        'size': size,
+        'chunkSize': chunk_size,
+        'chunkCount': chunk_count(size, chunk_size),
+        'receivedChunks': sorted(received),
+        'status': status
+    }
+
+def sweep_stale_uploads(conn) -> None:
+    '''
+    Удалить брошенные загрузки и их части; не чаще раза в сутки на экземпляр
+    Части удаляются до строк: если хранилище откажет, строки останутся
+    и следующий проход повторит попытку. За проход — не больше
+    STALE_UPLOAD_SWEEP_LIMIT загрузок, полный проход повторяется сразу
+    '''
+    global _stale_swept_on
+    today = date.today()
+    if _stale_swept_on == today:
+        return
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id FROM attachments
+        WHERE status = 'uploading' AND created_at < LOCALTIMESTAMP - make_interval(hours => %s)
+        ORDER BY created_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (STALE_UPLOAD_HOURS, STALE_UPLOAD_SWEEP_LIMIT))
+    stale = [row[0] for row in cur.fetchall()]
+    if stale:
+        store = get_store()
+        for attachment_id in stale:
+            store.delete_parts(attachment_id)
+        cur.execute("DELETE FROM attachments WHERE id = ANY(%s)", (stale,))
+    conn.commit()
+    cur.close()
+    if len(stale) < STALE_UPLOAD_SWEEP_LIMIT:
+        _stale_swept_on = today
+
+def start_upload(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Начать загрузку
+    Если клиент передал sha256, в ответе есть вызов proof {offset, length,
+    nonce}: sha256 от байт nonce и length байт файла с offset. Верный ответ
+    в complete завершает загрузку без передачи частей, если такое
+    содержимое уже хранится. Вызов выдаётся всегда, поэтому по ответу не
+    узнать, есть ли файл с этим хешем
+    '''
+    body_data = json.loads(event.get('body') or '{}')
+    file_name = (body_data.get('fileName') or '').strip()
+    content_type = (body_data.get('contentType') or 'application/octet-stream').strip()
+    sha256 = (body_data.get('sha256') or '').lower() or None
+    
+    try:
+        size = int(body_data.get('size'))
+    except (TypeError, ValueError):
+        size = 0
+    
+    if (not file_name or len(file_name) > MAX_FILE_NAME_LENGTH
+            or len(content_type) > MAX_CONTENT_TYPE_LENGTH
+            or not 0 < size <= MAX_ATTACHMENT_SIZE
+            or (sha256 is not None and not SHA256_RE.match(sha256))):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({
+                'error': f'fileName (up to {MAX_FILE_NAME_LENGTH} characters) and size '
+                         f'(1-{MAX_ATTACHMENT_SIZE} bytes) required, sha256 must be 64 hex digits'
+            }),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    proof = None
+    claimed_sha256, proof_digest = None, None
+    
+    if sha256:
+        length = min(PROOF_LENGTH, size)
+        proof = {'offset': secrets.randbelow(size - length + 1), 'length': length, 'nonce': secrets.token_hex(16)}
+        cur.execute("SELECT 1 FROM blobs WHERE sha256 = %s AND size = %s", (sha256, size))
+        if cur.fetchone():
+            digest = hashlib.sha256(bytes.fromhex(proof['nonce']))
+            with phase('fetch'):
+                for block in get_store().read_range(sha256, proof['offset'], proof['offset'] + length - 1):
+                    digest.update(block)
+            claimed_sha256, proof_digest = sha256, digest.hexdigest()
+    
+    cur.execute(f"""
+        INSERT INTO attachments (
+            owner_id, file_name, content_type, size, chunk_size, claimed_sha256, proof_digest
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING {ATTACHMENT_COLUMNS}
+    """, (user_id, file_name, content_type, size, ATTACHMENT_CHUNK_SIZE, claimed_sha256, proof_digest))
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    
+    attachment = attachment_to_dict(row)
+    if proof:
+        attachment['proof'] = proof
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps(attachment),
+        'isBase64Encoded': False
+    }
+
+def upload_chunk(conn, event: Dict[str, Any], attachment_id: int, user_id: str) -> Dict[str, Any]:
+    '''
+    Принять часть index загрузки
+    Тело — байты части в base64 (сама платформа присылает бинарное тело так
+    же); повтор уже принятой части перезаписывает её и безопасен
+    '''
+    params = event.get('queryStringParameters') or {}
+    
+    try:
+        index = int(params.get('index'))
+        data = base64.b64decode(event.get('body') or '', validate=True)
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'index must be an integer and body base64-encoded chunk bytes'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT size, chunk_size FROM attachments WHERE id = %s AND owner_id = %s AND status = 'uploading'",
+        (attachment_id, user_id)
+    )
+    row = cur.fetchone()
+    if row is None:
+        cur.close()
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Upload not found'}),
+            'isBase64Encoded': False
+        }
+    
+    size, chunk_size = row
+    count = chunk_count(size, chunk_size)
+    expected = chunk_size if index < count - 1 else size - chunk_size * (count - 1)
+    if not 0 <= index < count or len(data) != expected:
+        cur.close()
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'index must be 0-{count - 1} and chunk {expected} bytes long'}),
+            'isBase64Encoded': False
+        }
+    
+    get_store().put_part(attachment_id, index, data)
+    
+    # Номер части добавляется только один раз, даже при повторной отправке
+    cur.execute("""
+        UPDATE attachments
+        SET received_chunks = CASE
+            WHEN %(index)s = ANY(received_chunks) THEN received_chunks
+            ELSE array_append(received_chunks, %(index)s)
+        END
+        WHERE id = %(id)s
+        RETURNING cardinality(received_chunks)
+    """, {'id': attachment_id, 'index': index})
+    received = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'id': attachment_id, 'index': index, 'received': received, 'chunkCount': count}),
+        'isBase64Encoded': False
+    }
+
+def complete_upload(conn, event: Dict[str, Any], attachment_id: int, user_id: str) -> Dict[str, Any]:
+    '''
+    Завершить загрузку: склеить части, посчитать SHA-256 и сохранить blob
+    Содержимое, которое уже есть в хранилище, второй раз не записывается.
+    С body.proof — ответом на вызов из start — загрузка завершается без
+    частей; попытка одна, после неверного ответа остаётся только загрузка
+    '''
+    body_data = json.loads(event.get('body') or '{}')
+    proof = (body_data.get('proof') or '').lower()
+    
+    cur = conn.cursor()
+    # Блокировка строки не даёт двум завершениям одной загрузки склеивать части разом
+    cur.execute(
+        f"SELECT {ATTACHMENT_COLUMNS}, claimed_sha256, proof_digest FROM attachments WHERE id = %s AND owner_id = %s FOR UPDATE",
+        (attachment_id, user_id)
+    )
+    row = cur.fetchone()
+    if row is None:
+        cur.close()
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Upload not found'}),
+            'isBase64Encoded': False
+        }
+    
+    attachment = attachment_to_dict(row)
+    if attachment['status'] == 'ready':
+        conn.commit()
+        cur.close()
+        # Повтор complete дочищает части, если прошлое удаление не удалось
+        get_store().delete_parts(attachment_id)
+        attachment['deduplicated'] = False
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps(attachment),
+            'isBase64Encoded': False
+        }
+    
+    missing = sorted(set(range(attachment['chunkCount'])) - set(attachment['receivedChunks']))
+    
+    if proof:
+        claimed_sha256, proof_digest = row[8], row[9]
+        if claimed_sha256 and proof_digest and SHA256_RE.match(proof) and hmac.compare_digest(proof, proof_digest):
+            # Части, загруженные до ответа на вызов, не нужны при любом исходе
+            try:
+                cur.execute("""
+                    UPDATE attachments
+                    SET sha256 = claimed_sha256, status = 'ready', completed_at = CURRENT_TIMESTAMP,
+                        claimed_sha256 = NULL, proof_digest = NULL
+                    WHERE id = %s
+                """, (attachment_id,))
+                conn.commit()
+            finally:
+                cur.close()
+                get_store().delete_parts(attachment_id)
+            attachment.update({'status': 'ready', 'deduplicated': True})
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps(attachment),
+                'isBase64Encoded': False
+            }
+        cur.execute(
+            "UPDATE attachments SET claimed_sha256 = NULL, proof_digest = NULL WHERE id = %s",
+            (attachment_id,)
+        )
+        conn.commit()
+        cur.close()
+        return {
+            'statusCode': 409,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Proof not accepted, upload the chunks', 'missingChunks': missing}),
+            'isBase64Encoded': False
+        }
+    
+    if missing:
+        conn.rollback()
+        cur.close()
+        return {
+            'statusCode': 409,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Upload incomplete', 'missingChunks': missing}),
+            'isBase64Encoded': False
+        }
+    
+    # Часть, отмеченная в БД, могла не дойти до хранилища (сбой после
+    # записи в БД или local-хранилище на другом экземпляре): клиенту
+    # возвращается список частей для повторной отправки, а не 500
+    store = get_store()
+    try:
+        lost = store.missing_parts(attachment_id, attachment['chunkCount'])
+        if not lost:
+            sha256, size, created = store.assemble(attachment_id, attachment['chunkCount'])
+    except MissingPartsError as error:
+        lost = error.indexes
+    if lost:
+        cur.execute("""
+            UPDATE attachments
+            SET received_chunks = ARRAY(
+                SELECT unnest(received_chunks) EXCEPT SELECT unnest(%s::INTEGER[])
+            )
+            WHERE id = %s
+        """, (lost, attachment_id))
+        conn.commit()
+        cur.close()
+        return {
+            'statusCode': 409,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Upload parts lost, send them again', 'missingChunks': lost}),
+            'isBase64Encoded': False
+        }
+    
+    # Blob уже в хранилище, части больше не нужны, даже если транзакция
+    # не пройдёт: повтор complete увидит их пропажу и попросит загрузить снова
+    try:
+        cur.execute("""
+            WITH blob AS (
+                INSERT INTO blobs (sha256, size) VALUES (%(sha256)s, %(size)s)
+                ON CONFLICT (sha256) DO NOTHING
+            )
+            UPDATE attachments
+            SET sha256 = %(sha256)s, status = 'ready', completed_at = CURRENT_TIMESTAMP
+            WHERE id = %(id)s
+        """, {'sha256': sha256, 'size': size, 'id': attachment_id})
+        conn.commit()
+    finally:
+        cur.close()
+        store.delete_parts(attachment_id)
+    
+    attachment.update({'status': 'ready', 'deduplicated': not created})
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps(attachment),
+        'isBase64Encoded': False
+    }
+
+def upload_status(conn, attachment_id: int, user_id: str) -> Dict[str, Any]:
+    '''Состояние загрузки для продолжения: какие части уже приняты'''
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT {ATTACHMENT_COLUMNS} FROM attachments WHERE id = %s AND owner_id = %s",
+        (attachment_id, user_id)
+    )
+    row = cur.fetchone()
+    cur.close()
+    
+    if row is None:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Upload not found'}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps(attachment_to_dict(row)),
+        'isBase64Encoded': False
+    }
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    '''
+    Один диапазон из заголовка Range: (start, end) включительно
+    Без заголовка — весь файл; ValueError для неудовлетворимого диапазона
+    '''
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        raise ValueError('Unsupported Range')
+    first, last = match.groups()
+    if first == '':
+        # bytes=-N: последние N байт
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable Range')
+    return start, end
+
+def b64_blocks(blocks: Iterator[bytes]) -> str:
+    '''base64 потока блоков: кодируются кратные трём куски по мере чтения'''
+    encoded_parts: List[str] = []
+    tail = b''
+    for block in blocks:
+        block = tail + block
+        cut = len(block) - len(block) % 3
+        encoded_parts.append(base64.b64encode(block[:cut]).decode())
+        tail = block[cut:]
+    encoded_parts.append(base64.b64encode(tail).decode())
+    return ''.join(encoded_parts)
+
+def download(conn, event: Dict[str, Any], attachment_id: int, user_id: str) -> Dict[str, Any]:
+    '''
+    Скачать вложение: владельцу или участнику чата с сообщением, где оно есть
+    Из хранилища читается только запрошенный диапазон и не больше
+    MAX_DOWNLOAD_WINDOW байт; S3 отдаёт файл сам по подписанной ссылке
+    '''
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT a.file_name, a.content_type, a.size, a.sha256
+        FROM attachments a
+        WHERE a.id = %(id)s AND a.status = 'ready' AND (
+            a.owner_id = %(user_id)s OR EXISTS (
+                SELECT 1 FROM messages m
+                JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = %(user_id)s
+                WHERE m.attachment_id = a.id AND m.deleted_at IS NULL
+            )
+        )
+    """, {'id': attachment_id, 'user_id': user_id})
+    row = cur.fetchone()
+    cur.close()
+    
+    if row is None:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Attachment not found'}),
+            'isBase64Encoded': False
+        }
+    
+    file_name, content_type, size, sha256 = row
+    sha256 = sha256.strip()
+    store = get_store()
+    
+    url = store.url(sha256, file_name)
+    if url:
+        return {
+            'statusCode': 302,
+            'headers': {'Location': url, 'Access-Control-Allow-Origin': '*'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    # Содержимое готового вложения не меняется; хеш в ETag не отдаётся
+    etag = f'"attachment-{attachment_id}"'
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    if etag in {candidate.strip() for candidate in (headers.get('if-none-match') or '').split(',')}:
+        return {
+            'statusCode': 304,
+            'headers': {'ETag': etag, 'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    try:
+        requested = parse_range(headers.get('range'), size)
+    except ValueError:
+        return {
+            'statusCode': 416,
+            'headers': {'Content-Range': f'bytes */{size}', 'Access-Control-Allow-Origin': '*'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    # Файл больше окна отдаётся частями даже без Range: по Content-Range
+    # клиент видит полный размер и догружает остаток
+    start, end = requested if requested else (0, size - 1)
+    end = min(end, start + MAX_DOWNLOAD_WINDOW - 1)
+    partial = requested is not None or end < size - 1
+    
+    with phase('fetch'):
+        body = b64_blocks(store.read_range(sha256, start, end))
+    
+    response_headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': content_disposition(file_name),
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag, Content-Range, Accept-Ranges, Content-Disposition'
+    }
+    if partial:
+        response_headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    
+    return {
+        'statusCode': 206 if partial else 200,
+        'headers': response_headers,
+        'body': body,
+        'isBase64Encoded': True
+    }
@@ -0,0 +1,158 @@
+'''
+Замеры одного вызова handler: фазы, число SQL-запросов и строк, размер ответа
+Время делится на connect (выдача соединения из пула), db (execute),
+fetch (чтение строк), serialize (JSON и сжатие тела, responses.py) и app
+(всё остальное).
+Итог пишется одной JSON-строкой в лог и заголовком Server-Timing; запросы
+дольше SLOW_QUERY_MS дополнительно логируются с именем вызывающей функции.
+'''
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from psycopg2 import extensions
+
+# 0 — лог медленных запросов выключен
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+PHASES = ('connect', 'db', 'fetch', 'serialize')
+
+_state = threading.local()
+
+class RequestStats:
+    '''Счётчики текущего вызова handler'''
+    
+    def __init__(self, function: str):
+        self.function = function
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {name: 0.0 for name in PHASES}
+        self.active_phase: Optional[str] = None
+        self.queries = 0
+        self.rows = 0
+    
+    def add(self, phase: str, elapsed: float) -> None:
+        # Внутри явной фазы (например, SELECT 1 при выдаче соединения)
+        # время запроса относится к ней, а не к db
+        self.phases[self.active_phase or phase] += elapsed
+
+def current() -> Optional[RequestStats]:
+    return getattr(_state, 'stats', None)
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    '''Отнести время блока к фазе name'''
+    stats = current()
+    if stats is None or stats.active_phase is not None:
+        yield
+        return
+    started = time.perf_counter()
+    stats.active_phase = name
+    try:
+        yield
+    finally:
+        stats.active_phase = None
+        stats.phases[name] += time.perf_counter() - started
+
+def statement_name(query: Any, caller: str) -> str:
+    '''Имя запроса для лога: вызывающая функция и первое ключевое слово SQL'''
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    words = str(query).split(None, 1)
+    return f'{caller}:{words[0].upper() if words else "?"}'
+
+class InstrumentedCursor(extensions.cursor):
+    '''Курсор, считающий запросы, строки и время execute/fetch текущего вызова'''
+    
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, time.perf_counter() - started, sys._getframe(1).f_code.co_name)
+    
+    def _record(self, query: Any, elapsed: float, caller: str) -> None:
+        stats = current()
+        if stats is not None:
+            stats.queries += 1
+            stats.add('db', elapsed)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            print(json.dumps({
+                'event': 'slow_query',
+                'function': stats.function if stats else None,
+                'statement': statement_name(query, caller),
+                'durationMs': round(elapsed * 1000, 2),
+                'rowcount': self.rowcount
+            }), flush=True)
+    
+    def _fetched(self, rows: Any, elapsed: float, count: int) -> Any:
+        stats = current()
+        if stats is not None:
+            stats.rows += count
+            stats.add('fetch', elapsed)
+        return rows
+    
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        return self._fetched(row, time.perf_counter() - started, 0 if row is None else 1)
+    
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        return self._fetched(rows, time.perf_counter() - started, len(rows))
+    
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        return self._fetched(rows, time.perf_counter() - started, len(rows))
+
+def server_timing(stats: RequestStats, total: float) -> str:
+    '''Значение заголовка Server-Timing в миллисекундах'''
+    app = max(0.0, total - sum(stats.phases.values()))
+    parts = [f'{name};dur={stats.phases[name] * 1000:.2f}' for name in PHASES]
+    parts.append(f'app;dur={app * 1000:.2f}')
+    parts.append(f'total;dur={total * 1000:.2f};desc="{stats.queries} queries, {stats.rows} rows"')
+    return ', '.join(parts)
+
+def instrumented(function: str) -> Callable:
+    '''Обернуть handler: собрать счётчики вызова, добавить Server-Timing и записать лог'''
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]):
+        @wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            stats = RequestStats(function)
+            _state.stats = stats
+            response: Optional[Dict[str, Any]] = None
+            try:
+                response = handler(event, context)
+                return response
+            finally:
+                _state.stats = None
+                total = time.perf_counter() - stats.started
+                status = response.get('statusCode') if response else 500
+                body = response.get('body') if response else None
+                if response is not None:
+                    headers = response.setdefault('headers', {})
+                    headers['Server-Timing'] = server_timing(stats, total)
+                    headers['Timing-Allow-Origin'] = '*'
+                if REQUEST_LOG:
+                    params = event.get('queryStringParameters') or {}
+                    print(json.dumps({
+                        'event': 'request',
+                        'function': function,
+                        'requestId': getattr(context, 'request_id', None),
+                        'method': event.get('httpMethod'),
+                        'action': params.get('action'),
+                        'status': status,
+                        'totalMs': round(total * 1000, 2),
+                        'phasesMs': {name: round(value * 1000, 2) for name, value in stats.phases.items()},
+                        'queries': stats.queries,
+                        'rows': stats.rows,
+                        'responseBytes': len(body.encode('utf-8')) if isinstance(body, str) else 0
+                    }), flush=True)
+        return wrapper
+    return decorate
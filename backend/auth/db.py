@@ -0,0 +1,236 @@
+'''
+Пул соединений с PostgreSQL, общий для тёплых вызовов функции
+Пул живёт на уровне модуля: повторные вызовы того же экземпляра функции
+берут уже установленное соединение вместо нового TCP+TLS+auth рукопожатия.
+'''
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+import psycopg2
+from psycopg2 import extensions, pool
+
+from instrumentation import InstrumentedCursor, phase
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+# Соединение, простоявшее дольше этого времени, проверяется SELECT 1 при выдаче
+HEALTHCHECK_IDLE_SECONDS = float(os.environ.get('DB_POOL_HEALTHCHECK_IDLE_SECONDS', '30'))
+
+class WarmConnectionPool(pool.ThreadedConnectionPool):
+    '''
+    Пул, который держит возвращённые соединения открытыми до maxconn
+    psycopg2 при putconn оставляет в пуле не больше minconn соединений, а
+    остальные закрывает. Открывать все соединения на холодном старте не
+    нужно, поэтому пул создаётся с minconn=0, а порог поднимается потом
+    '''
+    
+    def __init__(self, maxconn: int, *args, **kwargs):
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+
+_pool: Optional[WarmConnectionPool] = None
+_pool_lock = threading.Lock()
+_last_used: Dict[int, float] = {}
+# Подписчики каналов NOTIFY и одно долгоживущее соединение вне пула,
+# которое слушает их каналы
+_listeners: Dict[str, Callable[[str], None]] = {}
+_listener_conn: Optional[extensions.connection] = None
+_listener_channels: Set[str] = set()
+_listener_checked_at = 0.0
+_listener_lock = threading.Lock()
+# Простаивающие соединения для долгого ожидания NOTIFY, вне пула
+_idle_waiters: List[extensions.connection] = []
+WAITER_IDLE_MAX = 2
+
+def get_pool() -> WarmConnectionPool:
+    '''Создать пул при первом обращении и вернуть его'''
+    global _pool
+    if _pool is None or _pool.closed:
+        with _pool_lock:
+            if _pool is None or _pool.closed:
+                _pool = WarmConnectionPool(
+                    POOL_MAX_SIZE, os.environ['DATABASE_URL'], cursor_factory=InstrumentedCursor
+                )
+    return _pool
+
+def subscribe(channel: str, callback: Callable[[str], None]) -> None:
+    '''
+    Подписаться на канал NOTIFY
+    callback получает payload уведомлений, накопившихся на выделенном
+    соединении к моменту очередной выдачи соединения из пула. Уведомления,
+    пропущенные из-за обрыва этого соединения, заменяются одним вызовом с
+    нечисловым payload '*': подписчик должен сбросить всё
+    '''
+    _listeners[channel] = callback
+
+def _poll_listener() -> Optional[List[extensions.Notify]]:
+    '''
+    Забрать уведомления с выделенного соединения, открыв его при необходимости
+    Соединения пула для этого не годятся: на простаивающем соединении
+    уведомления копятся, пока его не выдадут снова, а LISTEN на каждом
+    из них дублирует доставку. Returns: уведомления или None, если
+    соединение было открыто заново или оборвалось и часть могла пропасть
+    '''
+    global _listener_conn, _listener_checked_at
+    conn = _listener_conn
+    try:
+        if conn is not None and not conn.closed and time.monotonic() - _listener_checked_at >= HEALTHCHECK_IDLE_SECONDS:
+            # Оборванное без FIN соединение poll() не замечает, запрос — замечает
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            _listener_checked_at = time.monotonic()
+        if conn is None or conn.closed:
+            conn = _listener_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            conn.autocommit = True
+            _listener_channels.clear()
+            _listener_checked_at = time.monotonic()
+            lost = True
+        else:
+            lost = False
+        missing = set(_listeners) - _listener_channels
+        if missing:
+            cur = conn.cursor()
+            cur.execute('; '.join(f'LISTEN {channel}' for channel in missing))
+            cur.close()
+            _listener_channels.update(missing)
+        conn.poll()
+    except psycopg2.Error:
+        if conn is not None:
+            conn.close()
+        _listener_conn = None
+        return None
+    pending = list(conn.notifies)
+    del conn.notifies[:]
+    return None if lost else pending
+
+def dispatch_notifications() -> None:
+    '''Передать подписчикам уведомления, пришедшие с прошлой выдачи соединения'''
+    if not _listeners:
+        return
+    with _listener_lock:
+        pending = _poll_listener()
+    if pending is None:
+        # Без подписки кэши нельзя держать дольше одного вызова
+        for callback in _listeners.values():
+            callback('*')
+        return
+    for notify in pending:
+        callback = _listeners.get(notify.channel)
+        if callback is not None:
+            callback(notify.payload)
+
+def _forget(conn) -> None:
+    _last_used.pop(id(conn), None)
+
+def _is_healthy(conn) -> bool:
+    '''Проверить, что соединение живо и готово к новому запросу'''
+    if conn.closed:
+        return False
+    idle_since = _last_used.get(id(conn))
+    # Только что открытое соединение или недавно использованное не проверяем
+    if idle_since is None or time.monotonic() - idle_since < HEALTHCHECK_IDLE_SECONDS:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def checkout():
+    '''Взять соединение из пула, заменив его на новое, если оно сломано'''
+    with phase('connect'):
+        db_pool = get_pool()
+        # Все простаивающие соединения могли оборваться разом (рестарт БД),
+        # поэтому перебираем не больше размера пула, затем открываем новое
+        for _ in range(POOL_MAX_SIZE):
+            conn = db_pool.getconn()
+            if _is_healthy(conn):
+                break
+            _forget(conn)
+            db_pool.putconn(conn, close=True)
+        else:
+            conn = db_pool.getconn()
+        dispatch_notifications()
+        return conn
+
+def release(conn, broken: bool = False) -> None:
+    '''Вернуть соединение в пул; сломанное соединение закрывается'''
+    db_pool = get_pool()
+    if not broken and not conn.closed:
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    if broken or conn.closed:
+        _forget(conn)
+        db_pool.putconn(conn, close=True)
+        return
+    _last_used[id(conn)] = time.monotonic()
+    db_pool.putconn(conn)
+
+@contextmanager
+def connection() -> Iterator[extensions.connection]:
+    '''Соединение из пула на время одного вызова handler'''
+    conn = checkout()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release(conn, broken)
+
+def _open_waiter() -> extensions.connection:
+    while True:
+        with _pool_lock:
+            conn = _idle_waiters.pop() if _idle_waiters else None
+        if conn is None:
+            break
+        if _is_healthy(conn):
+            return conn
+        _forget(conn)
+        conn.close()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=InstrumentedCursor)
+    conn.autocommit = True
+    return conn
+
+@contextmanager
+def waiter() -> Iterator[extensions.connection]:
+    '''
+    Отдельное соединение в autocommit для LISTEN на время long-poll
+    Ожидание не держит соединение пула: запросы к данным идут через
+    connection() и отдают его сразу. Тёплое соединение переиспользуется,
+    подписки снимаются UNLISTEN * перед возвратом
+    '''
+    with phase('connect'):
+        conn = _open_waiter()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if not broken and not conn.closed:
+            try:
+                cur = conn.cursor()
+                cur.execute('UNLISTEN *')
+                cur.close()
+                del conn.notifies[:]
+            except psycopg2.Error:
+                broken = True
+        with _pool_lock:
+            if broken or conn.closed or len(_idle_waiters) >= WAITER_IDLE_MAX:
+                _forget(conn)
+                conn.close()
+            else:
+                _last_used[id(conn)] = time.monotonic()
+                _idle_waiters.append(conn)
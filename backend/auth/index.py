@@ -1,13 +1,18 @@
 import json
-import os
-import psycopg2
 from typing import Dict, Any
 
+from db import connection
+from instrumentation import instrumented
+from responses import dumps, encoded
+from session import issue_token
+
+@instrumented('auth')
+@encoded
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Авторизация пользователя по номеру телефона
     Args: event с httpMethod, body {phone, name}
-    Returns: HTTP response с данными пользователя
+    Returns: HTTP response с данными пользователя и сессионным токеном
     '''
     method: str = event.get('httpMethod', 'GET')
     
@@ -17,7 +22,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Session-Token, X-User-Id',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -34,7 +39,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Phone and name are required'}),
+                'body': dumps({'error': 'Phone and name are required'}),
                 'isBase64Encoded': False
             }
         
@@ -43,44 +48,39 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             identity = request_context.get('identity', {})
             ip_address = identity.get('sourceIp', 'unknown')
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        cur.execute(
-            "SELECT id, phone, name, avatar, bio, is_online FROM users WHERE phone = %s",
-            (phone,)
-        )
-        user = cur.fetchone()
-        
-        if user:
-            user_id, db_phone, db_name, avatar, bio, is_online = user
-            cur.execute(
-                "UPDATE users SET name = %s, is_online = true, last_seen = CURRENT_TIMESTAMP, ip_address = %s WHERE id = %s",
-                (name, ip_address, user_id)
-            )
-            conn.commit()
-        else:
-            cur.execute(
-                "INSERT INTO users (phone, name, is_online, ip_address) VALUES (%s, %s, true, %s) RETURNING id, phone, name, avatar, bio, is_online",
-                (phone, name, ip_address)
-            )
-            user = cur.fetchone()
-            user_id, db_phone, db_name, avatar, bio, is_online = user
+        with connection() as conn:
+            cur = conn.cursor()
+            
+            # Вход и регистрация — один запрос: уникальный phone решает,
+            # обновить существующего пользователя или создать нового.
+            # Онлайн-статус выводится из возраста last_seen, is_online не пишется
+            cur.execute("""
+                INSERT INTO users (phone, name, last_seen, ip_address)
+                VALUES (%s, %s, CURRENT_TIMESTAMP, %s)
+                ON CONFLICT (phone) DO UPDATE
+                SET name = EXCLUDED.name, last_seen = CURRENT_TIMESTAMP,
+                    ip_address = EXCLUDED.ip_address
+                RETURNING id, phone, name, avatar, bio
+            """, (phone, name, ip_address))
+            user_id, db_phone, db_name, avatar, bio = cur.fetchone()
             conn.commit()
+            cur.close()
         
-        cur.close()
-        conn.close()
+        token, expires_at = issue_token(user_id)
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
+            'body': dumps({
                 'id': user_id,
                 'phone': db_phone,
                 'name': db_name,
                 'avatar': avatar,
                 'bio': bio,
-                'is_online': is_online
+                # last_seen только что записан: вошедший пользователь онлайн
+                'is_online': True,
+                'token': token,
+                'expiresAt': expires_at
             }),
             'isBase64Encoded': False
         }
@@ -88,6 +88,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     return {
         'statusCode': 405,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'}),
+        'body': dumps({'error': 'Method not allowed'}),
         'isBase64Encoded': False
     }
\ No newline at end of file
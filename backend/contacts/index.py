@@ -1,12 +1,29 @@
+import hashlib
 import json
 import os
-import psycopg2
-from typing import Dict, Any
+import re
+import time
+from typing import Dict, Any, Optional
 
+from db import connection
+from instrumentation import instrumented
+from responses import dumps, encoded, iter_rows, stream_response
+from session import authenticate
+
+# Пользователь онлайн, пока его last_seen моложе этого интервала
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', '90'))
+# Большая записная книжка загружается несколькими запросами такого размера
+MAX_PHONE_BOOK_CHUNK = 1000
+MIN_PHONE_DIGITS = 5
+MAX_PHONE_DIGITS = 15
+PHONE_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+@instrumented('contacts')
+@encoded
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Управление контактами: получение списка, добавление, удаление
-    Args: event с httpMethod, headers {X-User-Id}, body для POST/DELETE
+    Args: event с httpMethod, headers {Authorization или X-User-Id}, body для POST/DELETE
     Returns: HTTP response со списком контактов или результатом операции
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -17,96 +34,279 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Session-Token, X-User-Id, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    user_id = event.get('headers', {}).get('X-User-Id')
+    user_id = authenticate(event)
     if not user_id:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'User ID required in X-User-Id header'}),
+            'body': dumps({'error': 'Session token or X-User-Id header required'}),
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor()
-    
-    if method == 'GET':
-        cur.execute(
-            """
-            SELECT u.id, u.phone, u.name, u.avatar, u.bio, u.is_online, c.added_at
-            FROM contacts c
-            JOIN users u ON c.contact_id = u.id
-            WHERE c.user_id = %s
-            ORDER BY u.is_online DESC, u.name ASC
-            """,
-            (user_id,)
-        )
-        
-        contacts = []
-        for row in cur.fetchall():
-            contact_id, phone, name, avatar, bio, is_online, added_at = row
-            contacts.append({
-                'id': contact_id,
-                'phone': phone,
-                'name': name,
-                'avatar': avatar,
-                'bio': bio,
-                'isOnline': is_online,
-                'addedAt': added_at.isoformat() if added_at else None
-            })
+    with connection() as conn:
+        cur = conn.cursor()
         
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'contacts': contacts}),
-            'isBase64Encoded': False
-        }
-    
-    if method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        contact_id = body_data.get('contactId')
+        if method == 'GET':
+            # Версия списка: contacts_version меняется при добавлении контактов,
+            # last_seen контакта — при его пинге (статус), profile_updated_at —
+            # при смене его профиля. Запрос идёт только по индексу контактов,
+            # без сортировки и сериализации
+            cur.execute(
+                """
+                SELECT u.contacts_version, stats.total, stats.last_seen, stats.profile_updated_at
+                FROM users u
+                CROSS JOIN LATERAL (
+                    SELECT COUNT(*) AS total, MAX(p.last_seen) AS last_seen,
+                           MAX(p.profile_updated_at) AS profile_updated_at
+                    FROM contacts c
+                    JOIN users p ON p.id = c.contact_id
+                    WHERE c.user_id = u.id
+                ) stats
+                WHERE u.id = %s
+                """,
+                (user_id,)
+            )
+            version_row = cur.fetchone()
+            # Онлайн-статус выводится из возраста last_seen, поэтому ETag
+            # обновляется и по истечении каждого окна TTL
+            presence_window = int(time.time() // PRESENCE_TTL_SECONDS)
+            etag = make_etag('contacts', user_id, presence_window, *(version_row or ()))
+            
+            if etag_matches(event, etag):
+                cur.close()
+                return {
+                    'statusCode': 304,
+                    'headers': {'ETag': etag, 'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'},
+                    'body': '',
+                    'isBase64Encoded': False
+                }
+            
+            cur.close()
+            
+            # Серверный курсор отдаёт список порциями, а каждый контакт сразу
+            # сериализуется и сжимается: тысячи контактов не собираются
+            # ни в список dict, ни в одну несжатую строку
+            list_cur = conn.cursor(name='contacts_list')
+            list_cur.execute(
+                """
+                SELECT u.id, u.phone, u.name, u.avatar, u.bio,
+                       u.last_seen > LOCALTIMESTAMP - make_interval(secs => %s) AS is_online,
+                       c.added_at
+                FROM contacts c
+                JOIN users u ON c.contact_id = u.id
+                WHERE c.user_id = %s
+                ORDER BY is_online DESC, u.name ASC
+                """,
+                (PRESENCE_TTL_SECONDS, user_id)
+            )
+            
+            response = stream_response(
+                event, 200,
+                {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*',
+                    'Access-Control-Expose-Headers': 'ETag',
+                    'ETag': etag
+                },
+                {}, 'contacts', iter_rows(list_cur), contact_to_dict
+            )
+            list_cur.close()
+            return response
         
-        if not contact_id:
+        if method == 'POST':
+            body_data = json.loads(event.get('body', '{}'))
+            contact_id = body_data.get('contactId')
+            
+            if 'phones' in body_data or 'phoneHashes' in body_data:
+                cur.close()
+                return sync_phone_book(conn, body_data, user_id)
+            
+            if not contact_id:
+                cur.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': dumps({'error': 'Contact ID is required'}),
+                    'isBase64Encoded': False
+                }
+            
+            cur.execute(
+                """
+                WITH added AS (
+                    INSERT INTO contacts (user_id, contact_id) VALUES (%s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING contact_id
+                )
+                UPDATE users SET contacts_version = contacts_version + 1
+                WHERE id = %s AND EXISTS (SELECT 1 FROM added)
+                """,
+                (user_id, contact_id, user_id)
+            )
+            conn.commit()
+            
             cur.close()
-            conn.close()
+            
             return {
-                'statusCode': 400,
+                'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Contact ID is required'}),
+                'body': dumps({'success': True, 'message': 'Contact added'}),
                 'isBase64Encoded': False
             }
         
-        cur.execute(
-            "INSERT INTO contacts (user_id, contact_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-            (user_id, contact_id)
-        )
-        conn.commit()
-        
         cur.close()
-        conn.close()
         
         return {
-            'statusCode': 200,
+            'statusCode': 405,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': True, 'message': 'Contact added'}),
+            'body': dumps({'error': 'Method not allowed'}),
             'isBase64Encoded': False
         }
+
+def contact_to_dict(row) -> Dict[str, Any]:
+    '''Строка списка контактов в формат API'''
+    contact_id, phone, name, avatar, bio, is_online, added_at = row
+    return {
+        'id': contact_id,
+        'phone': phone,
+        'name': name,
+        'avatar': avatar,
+        'bio': bio,
+        'isOnline': is_online,
+        'addedAt': added_at.isoformat() if added_at else None
+    }
+
+def make_etag(*parts: Any) -> str:
+    '''Сильный ETag из версии ресурса и параметров, влияющих на тело ответа'''
+    digest = hashlib.sha1(':'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+def request_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    '''Заголовок запроса без учёта регистра имени'''
+    lowered = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    '''Совпадает ли ETag с одним из значений If-None-Match'''
+    header = request_header(event, 'If-None-Match')
+    if not header:
+        return False
+    candidates = {candidate.strip() for candidate in header.split(',')}
+    return etag in candidates or '*' in candidates
+
+def normalize_phone(value: str) -> str:
+    '''Оставить только цифры; российский номер с 8 в начале привести к 7'''
+    digits = re.sub(r'\D', '', value)
+    if re.fullmatch(r'8\d{10}', digits):
+        digits = '7' + digits[1:]
+    return digits
+
+def sync_phone_book(conn, body_data: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Синхронизация записной книжки: номера (phones) или SHA-256 от
+    нормализованных цифр номера (phoneHashes) сопоставляются с users одним
+    запросом, найденные добавляются в контакты одним INSERT ... ON CONFLICT.
+    Книга больше MAX_PHONE_BOOK_CHUNK отправляется частями; каждая часть
+    независима и безопасно повторяется.
+    '''
+    phones = body_data.get('phones') or []
+    hashes = body_data.get('phoneHashes') or []
+    
+    if not isinstance(phones, list) or not isinstance(hashes, list):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'phones and phoneHashes must be arrays'}),
+            'isBase64Encoded': False
+        }
+    
+    if len(phones) + len(hashes) > MAX_PHONE_BOOK_CHUNK:
+        return {
+            'statusCode': 413,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({
+                'error': f'At most {MAX_PHONE_BOOK_CHUNK} entries per request, upload the book in chunks',
+                'maxChunkSize': MAX_PHONE_BOOK_CHUNK
+            }),
+            'isBase64Encoded': False
+        }
+    
+    digits = set()
+    for phone in phones:
+        normalized = normalize_phone(str(phone))
+        if MIN_PHONE_DIGITS <= len(normalized) <= MAX_PHONE_DIGITS:
+            digits.add(normalized)
+    phone_hashes = {str(value).lower() for value in hashes if PHONE_HASH_RE.match(str(value).lower())}
     
+    cur = conn.cursor()
+    cur.execute(
+        """
+        WITH matched AS (
+            SELECT u.id FROM users u
+            JOIN unnest(%(digits)s::TEXT[]) AS book(digits) ON u.phone_digits = book.digits
+            UNION
+            SELECT u.id FROM users u
+            JOIN unnest(%(hashes)s::TEXT[]) AS book(hash) ON u.phone_hash = book.hash
+        ), added AS (
+            INSERT INTO contacts (user_id, contact_id)
+            SELECT %(user_id)s, id FROM matched WHERE id <> %(user_id)s::INTEGER
+            ON CONFLICT DO NOTHING
+            RETURNING contact_id
+        ), bumped AS (
+            UPDATE users SET contacts_version = contacts_version + 1
+            WHERE id = %(user_id)s AND EXISTS (SELECT 1 FROM added)
+        )
+        SELECT u.id, u.phone, u.phone_hash, u.name, u.avatar, u.bio,
+               u.last_seen > LOCALTIMESTAMP - make_interval(secs => %(presence_ttl)s),
+               added.contact_id IS NOT NULL
+        FROM matched
+        JOIN users u ON u.id = matched.id
+        LEFT JOIN added ON added.contact_id = u.id
+        WHERE u.id <> %(user_id)s::INTEGER
+        ORDER BY u.name ASC
+        """,
+        {
+            'digits': sorted(digits),
+            'hashes': sorted(phone_hashes),
+            'user_id': user_id,
+            'presence_ttl': PRESENCE_TTL_SECONDS
+        }
+    )
+    
+    contacts = []
+    for row in cur.fetchall():
+        contact_id, phone, phone_hash, name, avatar, bio, is_online, added = row
+        contacts.append({
+            'id': contact_id,
+            'phone': phone,
+            'phoneHash': phone_hash,
+            'name': name,
+            'avatar': avatar,
+            'bio': bio,
+            'isOnline': is_online,
+            'added': added
+        })
+    
+    conn.commit()
     cur.close()
-    conn.close()
     
     return {
-        'statusCode': 405,
+        'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'}),
+        'body': dumps({
+            'contacts': contacts,
+            'received': len(phones) + len(hashes),
+            'matched': len(contacts),
+            'added': sum(1 for contact in contacts if contact['added'])
+        }),
         'isBase64Encoded': False
-    }
+    }
\ No newline at end of file
@@ -0,0 +1,103 @@
+'''
+Сессионные токены без состояния: auth выдаёт, остальные функции проверяют
+Токен "v1.<user_id>.<expires>.<signature>" подписан HMAC-SHA256 общим
+секретом SESSION_SECRET, поэтому проверка не обращается к БД.
+Голый X-User-Id принимается только без SESSION_SECRET (локальный запуск):
+с заданным секретом по нему можно было бы войти за любого пользователя.
+Отсутствие секрета пишется в лог; SESSION_TOKENS_REQUIRED=1 отключает
+X-User-Id и без секрета. HTTP-тесты tests.json ходят с X-User-Id и поэтому
+проходят только без SESSION_SECRET и SESSION_TOKENS_REQUIRED: токен
+подписывается секретом окружения и в статичный JSON не записывается.
+'''
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+TOKEN_VERSION = 'v1'
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', str(30 * 24 * 3600)))
+SESSION_TOKENS_REQUIRED = os.environ.get('SESSION_TOKENS_REQUIRED', '0') == '1'
+
+def _secret() -> Optional[bytes]:
+    secret = os.environ.get('SESSION_SECRET')
+    return secret.encode() if secret else None
+
+_warned: Set[str] = set()
+
+def _warn_no_secret(action: str) -> None:
+    '''Один раз на экземпляр для каждого action, чтобы не засорять лог'''
+    if action in _warned:
+        return
+    _warned.add(action)
+    print(json.dumps({
+        'event': 'session_secret_missing',
+        'action': action,
+        'message': 'SESSION_SECRET is not set: no session tokens, X-User-Id is trusted as is'
+    }), flush=True)
+
+def _sign(secret: bytes, payload: str) -> str:
+    digest = hmac.new(secret, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def issue_token(user_id: int) -> Tuple[Optional[str], Optional[int]]:
+    '''
+    Выдать токен пользователю
+    Returns: (token, expires_at в секундах Unix); (None, None) с записью
+    в лог, если секрет не задан
+    '''
+    secret = _secret()
+    if not secret:
+        _warn_no_secret('issue_token')
+        return None, None
+    expires_at = int(time.time()) + SESSION_TTL_SECONDS
+    payload = f'{TOKEN_VERSION}.{int(user_id)}.{expires_at}'
+    return f'{payload}.{_sign(secret, payload)}', expires_at
+
+def verify_token(token: str) -> Optional[int]:
+    '''id пользователя из действующего токена; None при неверной подписи или истёкшем сроке'''
+    secret = _secret()
+    if not secret or not token:
+        return None
+    parts = token.split('.')
+    if len(parts) != 4 or parts[0] != TOKEN_VERSION:
+        return None
+    payload = '.'.join(parts[:3])
+    if not hmac.compare_digest(_sign(secret, payload), parts[3]):
+        return None
+    try:
+        user_id, expires_at = int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+    if expires_at < time.time():
+        return None
+    return user_id
+
+def _header(event: Dict[str, Any], name: str) -> Optional[str]:
+    lowered = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+def authenticate(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    id пользователя запроса строкой или None
+    Токен берётся из Authorization: Bearer или X-Session-Token; неверный
+    токен не подменяется X-User-Id, чтобы его нельзя было обойти.
+    При заданном SESSION_SECRET без токена запрос не аутентифицирован
+    '''
+    authorization = _header(event, 'Authorization') or ''
+    token = authorization[7:].strip() if authorization.lower().startswith('bearer ') else None
+    token = token or _header(event, 'X-Session-Token')
+    if token:
+        user_id = verify_token(token)
+        return str(user_id) if user_id is not None else None
+    if SESSION_TOKENS_REQUIRED or _secret():
+        return None
+    user_id = _header(event, 'X-User-Id') or None
+    if user_id:
+        _warn_no_secret('authenticate')
+    return user_id
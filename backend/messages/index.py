@@ -1,9 +1,61 @@
+import hashlib
 import json
 import os
+import select
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from datetime import date, datetime
+
 import psycopg2
-from typing import Dict, Any, Optional
-from datetime import datetime
+import psycopg2.errors
+
+from db import connection, waiter
+from instrumentation import instrumented
+from membership import forget as forget_members, is_member
+from profiles import attach_senders
+from responses import dumps, encoded
+from session import authenticate
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Цитата в карте referenced обрезается до этой длины
+REFERENCE_SNIPPET_LENGTH = 100
+MAX_SYNC_CHANGES = 500
+WAIT_DEFAULT_TIMEOUT = 25
+WAIT_MAX_TIMEOUT = 50
+# Без chatId long-poll слушает столько последних по активности чатов
+WAIT_MAX_CHATS = 100
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+MAX_BATCH_SIZE = 100
+# Пересылка: не больше чатов-получателей и копий за один запрос
+MAX_FORWARD_CHATS = 20
+MAX_FORWARD_COPIES = 500
+# Группы: длина названия и число участников в одном запросе на добавление/удаление
+MAX_GROUP_NAME_LENGTH = 100
+MAX_GROUP_MEMBERS_PER_REQUEST = 500
+DEFAULT_CHAT_LIST_PAGE_SIZE = 30
+MAX_CHAT_LIST_PAGE_SIZE = 100
+# Непрочитанные считаются до этого порога, дальше клиент показывает «99+»
+MAX_UNREAD_COUNT = 99
+# Пользователь онлайн, пока его last_seen моложе этого интервала
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', '90'))
+MAX_CLIENT_ID_LENGTH = 64
+MAX_EMOJI_LENGTH = 10
+# На сколько месяцев вперёд держать готовые партиции messages
+PARTITIONS_AHEAD_MONTHS = 3
+
+_partitions_checked_on: Optional[date] = None
 
+MESSAGE_COLUMNS = '''
+    m.id, m.sender_id, m.text, m.is_voice, m.voice_duration,
+    m.is_file, m.file_name, m.file_size, m.is_edited, m.is_forwarded,
+    m.forwarded_from, m.reply_to_id, m.created_at, m.version, m.chat_id,
+    m.attachment_id
+'''
+
+@instrumented('messages')
+@encoded
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Работа с сообщениями: отправка, получение истории, редактирование
@@ -19,44 +71,68 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Session-Token, X-User-Id, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    user_id = event.get('headers', {}).get('X-User-Id') or event.get('headers', {}).get('x-user-id')
+    user_id = authenticate(event)
     
     if not user_id:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Unauthorized'}),
+            'body': dumps({'error': 'Unauthorized'}),
             'isBase64Encoded': False
         }
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
+    action = (event.get('queryStringParameters') or {}).get('action')
     
-    try:
+    # Long-poll сам берёт соединение пула только на время выборок
+    if method == 'GET' and action == 'wait':
+        return wait_messages(event, user_id)
+    
+    with connection() as conn:
         if method == 'GET':
+            if action == 'sync':
+                return sync_messages(conn, event, user_id)
+            if action == 'search':
+                return search_messages(conn, event, user_id)
+            if action == 'chats':
+                return list_chats(conn, event, user_id)
+            if action == 'around':
+                return get_messages_around(conn, event, user_id)
             return get_messages(conn, event, user_id)
         elif method == 'POST':
+            if action == 'react':
+                return add_reaction(conn, event, user_id)
+            if action == 'read':
+                return mark_read(conn, event, user_id)
+            if action == 'group':
+                return create_group(conn, event, user_id)
+            if action == 'members':
+                return add_members(conn, event, user_id)
+            ensure_partitions(conn)
+            if action == 'forward':
+                return forward_messages(conn, event, user_id)
             return send_message(conn, event, user_id)
         elif method == 'PUT':
             return edit_message(conn, event, user_id)
         elif method == 'DELETE':
+            if action == 'react':
+                return remove_reaction(conn, event, user_id)
+            if action == 'members':
+                return remove_members(conn, event, user_id)
             return delete_message(conn, event, user_id)
         else:
             return {
                 'statusCode': 405,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
+                'body': dumps({'error': 'Method not allowed'}),
                 'isBase64Encoded': False
             }
-    finally:
-        conn.close()
 
 def get_messages(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
     '''Получить историю сообщений чата'''
@@ -68,253 +144,2000 @@ def get_messages(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'chatId or contactId required'}),
+            'body': dumps({'error': 'chatId or contactId required'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        before = parse_history_cursor(params.get('before'))
+        after = parse_history_cursor(params.get('after'))
+        limit = int(params.get('limit') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'before and after must be message ids or cursors, limit an integer'}),
+            'isBase64Encoded': False
+        }
+    
+    if before is not None and after is not None:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Use either before or after, not both'}),
             'isBase64Encoded': False
         }
     
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    
     cur = conn.cursor()
     
     # Если передан contactId, найти или создать чат
     if contact_id:
-        # Проверить, что contact_id существует в users
-        cur.execute("SELECT id FROM users WHERE id = %s", (contact_id,))
-        if not cur.fetchone():
+        chat_id, created = get_or_create_direct_chat(cur, user_id, contact_id)
+        if not chat_id:
             cur.close()
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': f'User with id {contact_id} not found'}),
+                'body': dumps({'error': f'User with id {contact_id} not found'}),
                 'isBase64Encoded': False
             }
-        
-        # Проверяем, есть ли уже чат между этими пользователями
-        cur.execute("""
-            SELECT c.id FROM chats c
-            JOIN chat_members cm1 ON c.id = cm1.chat_id
-            JOIN chat_members cm2 ON c.id = cm2.chat_id
-            WHERE c.is_group = false
-            AND cm1.user_id = %s
-            AND cm2.user_id = %s
-        """, (user_id, contact_id))
-        
-        result = cur.fetchone()
-        if result:
-            chat_id = result[0]
-        else:
-            # Создать новый чат
-            cur.execute("INSERT INTO chats (is_group, created_at) VALUES (false, CURRENT_TIMESTAMP) RETURNING id")
-            chat_id = cur.fetchone()[0]
-            
-            # Добавить обоих пользователей в чат
-            cur.execute("INSERT INTO chat_members (chat_id, user_id, joined_at) VALUES (%s, %s, CURRENT_TIMESTAMP)", (chat_id, user_id))
-            cur.execute("INSERT INTO chat_members (chat_id, user_id, joined_at) VALUES (%s, %s, CURRENT_TIMESTAMP)", (chat_id, contact_id))
+        if created:
             conn.commit()
+    elif not is_member(cur, chat_id, user_id):
+        cur.close()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
     
-    # Получить сообщения
+    # Версия читается до страницы: изменения, попавшие между запросами,
+    # клиент получит повторно при синхронизации, но не потеряет.
+    # Отметки прочтения остальных участников читаются тем же запросом
     cur.execute("""
-        SELECT 
-            m.id, m.sender_id, m.text, m.is_voice, m.voice_duration,
-            m.is_file, m.file_name, m.file_size, m.is_edited, m.is_forwarded,
-            m.forwarded_from, m.reply_to_id, m.created_at,
-            u.name as sender_name
+        SELECT c.change_seq, c.last_message_id,
+               COALESCE(marks.user_ids, '{}'), COALESCE(marks.read_ids, '{}')
+        FROM chats c
+        LEFT JOIN LATERAL (
+            SELECT array_agg(cm.user_id ORDER BY cm.user_id) AS user_ids,
+                   array_agg(cm.last_read_message_id ORDER BY cm.user_id) AS read_ids
+            FROM chat_members cm
+            WHERE cm.chat_id = c.id AND cm.user_id <> %s::INTEGER
+        ) marks ON true
+        WHERE c.id = %s
+    """, (user_id, chat_id))
+    chat_row = cur.fetchone()
+    version, last_message_id, mark_user_ids, mark_read_ids = chat_row if chat_row else (0, None, [], [])
+    read_marks = [
+        {'userId': mark_user_id, 'lastReadMessageId': read_id}
+        for mark_user_id, read_id in zip(mark_user_ids, mark_read_ids)
+    ]
+    
+    # Любое изменение сообщений чата сдвигает change_seq, поэтому неизменный
+    # чат отвечает 304 до выборки страницы и сериализации. Отметки прочтения
+    # change_seq не сдвигают и входят в ETag отдельно
+    etag = make_etag('messages', chat_id, version, last_message_id, user_id,
+                     params.get('before'), params.get('after'), limit,
+                     *(f"{mark['userId']}:{mark['lastReadMessageId']}" for mark in read_marks))
+    if etag_matches(event, etag):
+        cur.close()
+        return {
+            'statusCode': 304,
+            'headers': {'ETag': etag, 'Access-Control-Allow-Origin': '*', 'Access-Control-Expose-Headers': 'ETag'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    # Keyset-пагинация по (chat_id, created_at, id): страница читается по
+    # индексу idx_messages_chat_id_created_at_id. Порядок совпадает с ключом
+    # секционирования, поэтому первая страница читает только свежие партиции,
+    # а граница created_at курсора отсекает остальные ещё при планировании.
+    # Без курсора и с before читаем от новых к старым, с after — наоборот.
+    order = 'ASC' if after is not None else 'DESC'
+    cursor = after if after is not None else before
+    cursor_condition = ''
+    query_params: List[Any] = [chat_id]
+    if cursor is not None:
+        cursor_time, cursor_id = cursor
+        if cursor_time is None:
+            cursor_time = find_message_time(cur, chat_id, cursor_id)
+        comparison = '>' if after is not None else '<'
+        if cursor_time is None:
+            # Сообщения курсора нет в горячих партициях (ушло в архив)
+            cursor_condition = f'AND m.id {comparison} %s'
+            query_params.append(cursor_id)
+        else:
+            # Сравнение кортежей планировщик для отсечения партиций не
+            # использует, поэтому граница по created_at задана отдельно
+            cursor_condition = f'AND m.created_at {comparison}= %s AND (m.created_at, m.id) {comparison} (%s, %s)'
+            query_params.extend([cursor_time, cursor_time, cursor_id])
+    query_params.append(limit + 1)
+    
+    cur.execute(f"""
+        SELECT {MESSAGE_COLUMNS}
         FROM messages m
-        JOIN users u ON m.sender_id = u.id
-        WHERE m.chat_id = %s
-        ORDER BY m.created_at ASC
-    """, (chat_id,))
+        WHERE m.chat_id = %s AND m.deleted_at IS NULL {cursor_condition}
+        ORDER BY m.created_at {order}, m.id {order}
+        LIMIT %s
+    """, query_params)
     
-    messages = []
-    for row in cur.fetchall():
-        msg = {
-            'id': row[0],
-            'senderId': row[1],
-            'text': row[2],
-            'isVoice': row[3],
-            'voiceDuration': row[4],
-            'isFile': row[5],
-            'fileName': row[6],
-            'fileSize': row[7],
-            'isEdited': row[8],
-            'isForwarded': row[9],
-            'forwardedFrom': row[10],
-            'replyToId': row[11],
-            'createdAt': row[12].isoformat() if row[12] else None,
-            'senderName': row[13],
-            'isOwn': str(row[1]) == user_id
-        }
-        messages.append(msg)
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == 'DESC':
+        rows.reverse()
+    
+    messages = [message_to_dict(row, user_id) for row in rows]
+    attach_senders(cur, messages)
+    attach_reactions(cur, messages, user_id)
+    referenced = load_referenced(cur, chat_id, messages)
     
     cur.close()
     
+    # nextCursor указывает, откуда продолжать в том же направлении:
+    # для before — самое старое сообщение страницы, для after — самое новое
+    next_cursor = None
+    if has_more and messages:
+        edge = messages[-1] if order == 'ASC' else messages[0]
+        next_cursor = f"{edge['createdAt']}|{edge['id']}"
+    
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'chatId': chat_id, 'messages': messages}),
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'ETag',
+            'ETag': etag
+        },
+        'body': dumps({
+            'chatId': chat_id,
+            'messages': messages,
+            'nextCursor': next_cursor,
+            'hasMore': has_more,
+            'version': version,
+            'readMarks': read_marks,
+            'referenced': referenced
+        }),
         'isBase64Encoded': False
     }
 
-def send_message(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
-    '''Отправить новое сообщение'''
-    body_data = json.loads(event.get('body', '{}'))
-    
-    chat_id = body_data.get('chatId')
-    contact_id = body_data.get('contactId')
-    text = body_data.get('text', '').strip()
-    is_voice = body_data.get('isVoice', False)
-    voice_duration = body_data.get('voiceDuration')
-    is_file = body_data.get('isFile', False)
-    file_name = body_data.get('fileName')
-    file_size = body_data.get('fileSize')
-    reply_to_id = body_data.get('replyToId')
+def get_messages_around(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Окно истории вокруг messageId для перехода к цитате: до limit // 2
+    сообщений до него и после, плюс курсоры для догрузки в обе стороны
+    '''
+    params = event.get('queryStringParameters', {}) or {}
+    chat_id = params.get('chatId')
     
-    if not text and not is_voice and not is_file:
+    try:
+        message_id = int(params.get('messageId'))
+        created_at = parse_created_at(params.get('createdAt'))
+        limit = int(params.get('limit') or DEFAULT_PAGE_SIZE)
+    except (TypeError, ValueError):
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Message text required'}),
+            'body': dumps({'error': 'messageId must be an integer, createdAt an ISO timestamp, limit an integer'}),
             'isBase64Encoded': False
         }
     
+    limit = max(2, min(limit, MAX_PAGE_SIZE))
+    
     cur = conn.cursor()
     
-    # Если передан contactId, найти или создать чат
-    if contact_id:
-        # Проверить, что contact_id существует в users
-        cur.execute("SELECT id FROM users WHERE id = %s", (contact_id,))
-        if not cur.fetchone():
-            cur.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': f'User with id {contact_id} not found'}),
-                'isBase64Encoded': False
-            }
-        
-        cur.execute("""
-            SELECT c.id FROM chats c
-            JOIN chat_members cm1 ON c.id = cm1.chat_id
-            JOIN chat_members cm2 ON c.id = cm2.chat_id
-            WHERE c.is_group = false
-            AND cm1.user_id = %s
-            AND cm2.user_id = %s
-        """, (user_id, contact_id))
-        
-        result = cur.fetchone()
-        if result:
-            chat_id = result[0]
-        else:
-            # Создать новый чат
-            cur.execute("INSERT INTO chats (is_group, created_at) VALUES (false, CURRENT_TIMESTAMP) RETURNING id")
-            chat_id = cur.fetchone()[0]
-            
-            # Добавить обоих пользователей
-            cur.execute("INSERT INTO chat_members (chat_id, user_id, joined_at) VALUES (%s, %s, CURRENT_TIMESTAMP)", (chat_id, user_id))
-            cur.execute("INSERT INTO chat_members (chat_id, user_id, joined_at) VALUES (%s, %s, CURRENT_TIMESTAMP)", (chat_id, contact_id))
+    if not chat_id or not is_member(cur, chat_id, user_id):
+        cur.close()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
     
-    if not chat_id:
+    if created_at is None:
+        created_at = find_message_time(cur, chat_id, message_id)
+    if created_at is None:
+        cur.close()
         return {
-            'statusCode': 400,
+            'statusCode': 404,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'chatId or contactId required'}),
+            'body': dumps({'error': 'Message not found'}),
             'isBase64Encoded': False
         }
     
-    # Вставить сообщение
-    cur.execute("""
-        INSERT INTO messages (
-            chat_id, sender_id, text, is_voice, voice_duration,
-            is_file, file_name, file_size, reply_to_id, created_at
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-        RETURNING id, created_at
-    """, (chat_id, user_id, text, is_voice, voice_duration, is_file, file_name, file_size, reply_to_id))
-    
-    message_id, created_at = cur.fetchone()
-    conn.commit()
+    # Две ветки по индексу (chat_id, created_at, id) от позиции сообщения:
+    # к старым (вместе с ним самим) и к новым, по лишней строке на hasMore
+    before_limit = limit // 2
+    after_limit = limit - before_limit
+    cur.execute(f"""
+        (
+            SELECT {MESSAGE_COLUMNS}
+            FROM messages m
+            WHERE m.chat_id = %(chat_id)s AND m.deleted_at IS NULL
+            AND m.created_at <= %(created_at)s
+            AND (m.created_at, m.id) <= (%(created_at)s, %(message_id)s)
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT %(before_limit)s
+        )
+        UNION ALL
+        (
+            SELECT {MESSAGE_COLUMNS}
+            FROM messages m
+            WHERE m.chat_id = %(chat_id)s AND m.deleted_at IS NULL
+            AND m.created_at >= %(created_at)s
+            AND (m.created_at, m.id) > (%(created_at)s, %(message_id)s)
+            ORDER BY m.created_at ASC, m.id ASC
+            LIMIT %(after_limit)s
+        )
+    """, {
+        'chat_id': chat_id,
+        'created_at': created_at,
+        'message_id': message_id,
+        'before_limit': before_limit + 1,
+        'after_limit': after_limit + 1
+    })
+    
+    rows = cur.fetchall()
+    older = [row for row in rows if (row[12], row[0]) <= (created_at, message_id)]
+    newer = [row for row in rows if (row[12], row[0]) > (created_at, message_id)]
+    has_more_before = len(older) > before_limit
+    has_more_after = len(newer) > after_limit
+    rows = list(reversed(older[:before_limit])) + newer[:after_limit]
+    
+    messages = [message_to_dict(row, user_id) for row in rows]
+    attach_senders(cur, messages)
+    attach_reactions(cur, messages, user_id)
+    referenced = load_referenced(cur, chat_id, messages)
+    
     cur.close()
     
+    # Курсоры в формате nextCursor: before — от самого старого, after — от самого нового
+    before_cursor = after_cursor = None
+    if messages:
+        if has_more_before:
+            before_cursor = f"{messages[0]['createdAt']}|{messages[0]['id']}"
+        if has_more_after:
+            after_cursor = f"{messages[-1]['createdAt']}|{messages[-1]['id']}"
+    
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'id': message_id,
-            'chatId': chat_id,
-            'createdAt': created_at.isoformat() if created_at else None
+        'body': dumps({
+            'chatId': int(chat_id),
+            'messageId': message_id,
+            'messages': messages,
+            'referenced': referenced,
+            'beforeCursor': before_cursor,
+            'afterCursor': after_cursor,
+            'hasMoreBefore': has_more_before,
+            'hasMoreAfter': has_more_after
         }),
         'isBase64Encoded': False
     }
 
-def edit_message(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
-    '''Редактировать сообщение'''
-    body_data = json.loads(event.get('body', '{}'))
+def load_referenced(cur, chat_id: Any, messages: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+    '''
+    Карта цитируемых сообщений страницы {id: {senderId, senderName, text, ...}}
+    Цитаты со страницы берутся из неё, остальные читаются одним запросом
+    WHERE id = ANY(...); удалённые остаются в карте с deleted = true.
+    У пересланных сообщений источник не хранится: автор уже в forwardedFrom
+    '''
+    by_id = {msg['id']: msg for msg in messages}
+    reply_ids = {msg['replyToId'] for msg in messages if msg.get('replyToId')}
+    referenced: Dict[int, Dict[str, Any]] = {}
     
-    message_id = body_data.get('messageId')
-    text = body_data.get('text', '').strip()
+    for reply_id in reply_ids & by_id.keys():
+        msg = by_id[reply_id]
+        referenced[reply_id] = {
+            'id': reply_id,
+            'senderId': msg['senderId'],
+            'senderName': msg['senderName'],
+            'text': (msg['text'] or '')[:REFERENCE_SNIPPET_LENGTH],
+            'isVoice': msg['isVoice'],
+            'isFile': msg['isFile'],
+            'fileName': msg['fileName'],
+            'createdAt': msg['createdAt'],
+            'deleted': False
+        }
     
-    if not message_id or not text:
+    missing = list(reply_ids - by_id.keys())
+    if missing:
+        cur.execute("""
+            SELECT id, sender_id, LEFT(text, %s), is_voice, is_file, file_name, created_at, deleted_at
+            FROM messages
+            WHERE id = ANY(%s) AND chat_id = %s
+        """, (REFERENCE_SNIPPET_LENGTH, missing, chat_id))
+        loaded = [
+            {
+                'id': row[0],
+                'senderId': row[1],
+                'text': row[2],
+                'isVoice': row[3],
+                'isFile': row[4],
+                'fileName': row[5],
+                'createdAt': row[6].isoformat() if row[6] else None,
+                'deleted': row[7] is not None
+            }
+            for row in cur.fetchall()
+        ]
+        attach_senders(cur, loaded)
+        for item in loaded:
+            referenced[item['id']] = item
+    
+    return referenced
+
+def parse_created_at(value: Any) -> Optional[datetime]:
+    '''createdAt сообщения из запроса; ValueError при неверном формате'''
+    if not value:
+        return None
+    if not isinstance(value, str):
+        raise ValueError('createdAt must be an ISO timestamp')
+    return datetime.fromisoformat(value)
+
+def parse_history_cursor(value: Optional[str]) -> Optional[Tuple[Optional[datetime], int]]:
+    '''
+    Курсор истории: "<createdAt>|<id>" из nextCursor или просто id сообщения
+    Returns: (created_at или None, id); ValueError при неверном формате
+    '''
+    if not value:
+        return None
+    if '|' in value:
+        time_part, id_part = value.rsplit('|', 1)
+        return parse_created_at(time_part), int(id_part)
+    return None, int(value)
+
+def find_message_time(cur, chat_id: Any, message_id: int) -> Optional[datetime]:
+    '''
+    created_at сообщения для курсора в виде голого id
+    Без created_at поиск проверяет первичный ключ каждой партиции, поэтому
+    клиентам стоит передавать nextCursor как есть.
+    '''
+    cur.execute("SELECT created_at FROM messages WHERE id = %s AND chat_id = %s", (message_id, chat_id))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def ensure_partitions(conn) -> None:
+    '''Создать недостающие партиции messages наперёд; не чаще раза в сутки на экземпляр'''
+    global _partitions_checked_on
+    today = date.today()
+    if _partitions_checked_on == today:
+        return
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT ensure_messages_partitions(LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(months => %s))",
+        (PARTITIONS_AHEAD_MONTHS,)
+    )
+    cur.close()
+    conn.commit()
+    _partitions_checked_on = today
+
+def request_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    '''Заголовок запроса без учёта регистра имени'''
+    lowered = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+def make_etag(*parts: Any) -> str:
+    '''Сильный ETag из версии ресурса и параметров, влияющих на тело ответа'''
+    digest = hashlib.sha1(':'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    '''Совпадает ли ETag с одним из значений If-None-Match'''
+    header = request_header(event, 'If-None-Match')
+    if not header:
+        return False
+    candidates = {candidate.strip() for candidate in header.split(',')}
+    return etag in candidates or '*' in candidates
+
+def message_to_dict(row, user_id: str) -> Dict[str, Any]:
+    '''
+    Преобразовать строку выборки MESSAGE_COLUMNS в JSON-объект сообщения
+    senderName заполняет attach_senders из кэша профилей
+    '''
+    return {
+        'id': row[0],
+        'senderId': row[1],
+        'text': row[2],
+        'isVoice': row[3],
+        'voiceDuration': row[4],
+        'isFile': row[5],
+        'fileName': row[6],
+        'fileSize': row[7],
+        'isEdited': row[8],
+        'isForwarded': row[9],
+        'forwardedFrom': row[10],
+        'replyToId': row[11],
+        'createdAt': row[12].isoformat() if row[12] else None,
+        'senderName': None,
+        'isOwn': str(row[1]) == user_id,
+        'version': row[13],
+        'chatId': row[14],
+        'attachmentId': row[15]
+    }
+
+def sync_messages(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Инкрементальная синхронизация чата: новые, изменённые и удалённые
+    сообщения с версией больше sinceVersion
+    '''
+    params = event.get('queryStringParameters', {}) or {}
+    chat_id = params.get('chatId')
+    
+    if not chat_id:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'messageId and text required'}),
+            'body': dumps({'error': 'chatId required'}),
             'isBase64Encoded': False
         }
     
-    cur = conn.cursor()
+    try:
+        since_version = int(params.get('sinceVersion') or 0)
+        limit = int(params.get('limit') or MAX_SYNC_CHANGES)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'sinceVersion and limit must be integers'}),
+            'isBase64Encoded': False
+        }
     
-    # Проверить, что сообщение принадлежит пользователю
-    cur.execute("UPDATE messages SET text = %s, is_edited = true WHERE id = %s AND sender_id = %s", (text, message_id, user_id))
+    limit = max(1, min(limit, MAX_SYNC_CHANGES))
     
-    if cur.rowcount == 0:
-        conn.rollback()
+    cur = conn.cursor()
+    
+    if not is_member(cur, chat_id, user_id):
+        cur.close()
         return {
             'statusCode': 403,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Forbidden'}),
+            'body': dumps({'error': 'Forbidden'}),
             'isBase64Encoded': False
         }
     
-    conn.commit()
+    cur.execute("SELECT change_seq FROM chats WHERE id = %s", (chat_id,))
+    chat_row = cur.fetchone()
+    if not chat_row:
+        cur.close()
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Chat not found'}),
+            'isBase64Encoded': False
+        }
+    current_version = chat_row[0]
+    
+    # Версии выше current_version ещё могут коммититься, поэтому окно
+    # ограничено сверху: следующий запрос продолжит ровно с этой границы
+    cur.execute(f"""
+        SELECT {MESSAGE_COLUMNS}, m.deleted_at
+        FROM messages m
+        WHERE m.chat_id = %s AND m.version > %s AND m.version <= %s
+        ORDER BY m.version ASC
+        LIMIT %s
+    """, (chat_id, since_version, current_version, limit + 1))
+    
+    rows = cur.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    messages = []
+    deleted = []
+    for row in rows:
+        if row[16] is not None:
+            deleted.append({'id': row[0], 'version': row[13]})
+        else:
+            messages.append(message_to_dict(row, user_id))
+    
+    attach_senders(cur, messages)
+    attach_reactions(cur, messages, user_id)
     cur.close()
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True}),
+        'body': dumps({
+            'chatId': int(chat_id),
+            'messages': messages,
+            'deleted': deleted,
+            'version': rows[-1][13] if has_more else current_version,
+            'hasMore': has_more
+        }),
         'isBase64Encoded': False
     }
 
-def delete_message(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
-    '''Удалить сообщение'''
+def wait_messages(event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Long-poll: держать запрос, пока в чатах пользователя не появится
+    изменение новее курсора или не истечёт timeout секунд
+    Курсор — change_seq каждого чата в виде "chatId:version,...", как у
+    sync: версии внутри чата коммитятся по порядку под блокировкой строки
+    chats, поэтому сообщение с меньшим id, закоммиченное позже, не теряется.
+    Без chatId слушаются WAIT_MAX_CHATS последних по активности чатов.
+    Ожидание идёт на отдельном соединении waiter(), соединение пула
+    берётся только на время выборок
+    '''
     params = event.get('queryStringParameters', {}) or {}
-    message_id = params.get('messageId')
+    chat_id = params.get('chatId')
     
-    if not message_id:
+    try:
+        cursor = parse_wait_cursor(params.get('cursor'))
+        timeout = float(params.get('timeout') or WAIT_DEFAULT_TIMEOUT)
+        chat_id = int(chat_id) if chat_id else None
+    except ValueError:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'messageId required'}),
+            'body': dumps({'error': 'cursor must be chatId:version pairs, timeout and chatId numbers'}),
             'isBase64Encoded': False
         }
     
+    timeout = max(0.0, min(timeout, WAIT_MAX_TIMEOUT))
+    deadline = time.monotonic() + timeout
+    changes: Tuple[List[Dict[str, Any]], List[Dict[str, Any]]] = ([], [])
+    
+    with waiter() as listen_conn:
+        with connection() as conn:
+            cur = conn.cursor()
+            
+            if chat_id is not None and not is_member(cur, chat_id, user_id):
+                cur.close()
+                return {
+                    'statusCode': 403,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': dumps({'error': 'Forbidden'}),
+                    'isBase64Encoded': False
+                }
+            
+            # Чаты без позиции в курсоре начинают с текущего change_seq
+            if chat_id is not None:
+                cur.execute("SELECT id, change_seq FROM chats WHERE id = %s", (chat_id,))
+            else:
+                cur.execute("""
+                    SELECT c.id, c.change_seq
+                    FROM chat_members cm
+                    JOIN chats c ON c.id = cm.chat_id
+                    WHERE cm.user_id = %s
+                    ORDER BY c.last_activity_at DESC, c.id DESC
+                    LIMIT %s
+                """, (user_id, WAIT_MAX_CHATS))
+            cursor = {cid: cursor.get(cid, change_seq) for cid, change_seq in cur.fetchall()}
+            cur.close()
+            conn.commit()
+            
+            channels = {f'chat_{cid}' for cid in cursor}
+            
+            if channels:
+                # waiter в autocommit: LISTEN действует сразу, а сообщения,
+                # пришедшие до него, ловит контрольная выборка
+                listen_cur = listen_conn.cursor()
+                listen_cur.execute('; '.join(f'LISTEN {channel}' for channel in channels))
+                listen_cur.close()
+                changes = fetch_changes(conn, cursor, user_id)
+        
+        while channels and not any(changes):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if select.select([listen_conn], [], [], remaining) == ([], [], []):
+                break
+            listen_conn.poll()
+            woke = any(notify.channel in channels for notify in listen_conn.notifies)
+            del listen_conn.notifies[:]
+            if woke:
+                with connection() as conn:
+                    changes = fetch_changes(conn, cursor, user_id)
+    
+    messages, deleted = changes
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({
+            'messages': messages,
+            'deleted': deleted,
+            'cursor': format_wait_cursor(cursor),
+            'timedOut': not messages and not deleted
+        }),
+        'isBase64Encoded': False
+    }
+
+def parse_wait_cursor(value: Optional[str]) -> Dict[int, int]:
+    '''Курсор long-poll "chatId:version,..." в словарь; ValueError на мусор'''
+    cursor: Dict[int, int] = {}
+    for pair in (value or '').split(','):
+        if pair:
+            chat_id, _, version = pair.partition(':')
+            cursor[int(chat_id)] = int(version)
+    return cursor
+
+def format_wait_cursor(cursor: Dict[int, int]) -> str:
+    return ','.join(f'{chat_id}:{version}' for chat_id, version in sorted(cursor.items()))
+
+def fetch_changes(conn, cursor: Dict[int, int], user_id: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    '''
+    Новые, изменённые и удалённые сообщения с версией выше позиции чата
+    в курсоре; курсор сдвигается на место. Транзакция сразу закрывается
+    Returns: (messages, deleted) — клиент сводит сообщения по id
+    '''
+    chat_ids = list(cursor)
     cur = conn.cursor()
+    # Версии выше change_seq ещё могут коммититься — окно ограничено им, как в sync
+    cur.execute(f"""
+        SELECT {MESSAGE_COLUMNS}, m.deleted_at
+        FROM unnest(%s::INTEGER[], %s::BIGINT[]) AS since(chat_id, version)
+        JOIN chats c ON c.id = since.chat_id
+        JOIN messages m ON m.chat_id = since.chat_id
+        AND m.version > since.version AND m.version <= c.change_seq
+        ORDER BY m.chat_id, m.version
+        LIMIT %s
+    """, (chat_ids, [cursor[cid] for cid in chat_ids], MAX_PAGE_SIZE))
     
-    # Удалить только свои сообщения
-    cur.execute("DELETE FROM messages WHERE id = %s AND sender_id = %s", (message_id, user_id))
+    messages = []
+    deleted = []
+    for row in cur.fetchall():
+        cursor[row[14]] = row[13]
+        if row[16] is not None:
+            deleted.append({'id': row[0], 'chatId': row[14], 'version': row[13]})
+        else:
+            messages.append(message_to_dict(row, user_id))
+    attach_senders(cur, messages)
+    cur.close()
+    conn.commit()
+    return messages, deleted
+
+def search_messages(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Полнотекстовый поиск по сообщениям одного чата или всех чатов пользователя
+    Выдача ранжирована ts_rank_cd, сниппеты строятся только для страницы,
+    страницы идут по курсору "<rank>:<id>" без OFFSET
+    '''
+    params = event.get('queryStringParameters', {}) or {}
+    query = (params.get('q') or '').strip()
+    chat_id = params.get('chatId')
     
-    if cur.rowcount == 0:
-        conn.rollback()
+    if not query:
         return {
-            'statusCode': 403,
+            'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Forbidden'}),
+            'body': dumps({'error': 'q required'}),
             'isBase64Encoded': False
         }
     
-    conn.commit()
+    try:
+        limit = int(params.get('limit') or DEFAULT_SEARCH_PAGE_SIZE)
+        cursor_rank, cursor_id = None, None
+        if params.get('cursor'):
+            rank_part, id_part = params['cursor'].split(':', 1)
+            cursor_rank, cursor_id = float(rank_part), int(id_part)
+        chat_id = int(chat_id) if chat_id else None
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Invalid limit, cursor or chatId'}),
+            'isBase64Encoded': False
+        }
+    
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    
+    if chat_id:
+        scope = '''m.chat_id = %(chat_id)s AND EXISTS (
+            SELECT 1 FROM chat_members WHERE chat_id = %(chat_id)s AND user_id = %(user_id)s
+        )'''
+    else:
+        scope = 'm.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = %(user_id)s)'
+    
+    # Ранг сравнивается как real, чтобы курсор совпал с ts_rank_cd бит в бит
+    cursor_condition = ''
+    if cursor_rank is not None:
+        cursor_condition = '''AND (rank < %(cursor_rank)s::real
+                 OR (rank = %(cursor_rank)s::real AND id < %(cursor_id)s))'''
+    
+    cur = conn.cursor()
+    cur.execute(f"""
+        WITH q AS (
+            SELECT websearch_to_tsquery('russian', %(query)s) AS query
+        ), hits AS (
+            SELECT m.id, m.chat_id, m.sender_id, m.text, m.created_at,
+                   ts_rank_cd(m.search_vector, q.query) AS rank
+            FROM messages m, q
+            WHERE m.search_vector @@ q.query
+            AND m.deleted_at IS NULL
+            AND {scope}
+        ), page AS (
+            SELECT * FROM hits
+            WHERE true {cursor_condition}
+            ORDER BY rank DESC, id DESC
+            LIMIT %(limit)s
+        )
+        SELECT page.id, page.chat_id, page.sender_id, page.created_at, page.rank,
+               ts_headline('russian', COALESCE(page.text, ''), q.query,
+                           'StartSel=<mark>, StopSel=</mark>, MaxWords=20, MinWords=5, MaxFragments=2')
+        FROM page
+        CROSS JOIN q
+        ORDER BY page.rank DESC, page.id DESC
+    """, {
+        'query': query,
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'cursor_rank': cursor_rank,
+        'cursor_id': cursor_id,
+        'limit': limit + 1
+    })
+    
+    rows = cur.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    hits = []
+    for row in rows:
+        hits.append({
+            'id': row[0],
+            'chatId': row[1],
+            'senderId': row[2],
+            'senderName': None,
+            'createdAt': row[3].isoformat() if row[3] else None,
+            'rank': row[4],
+            'snippet': row[5],
+            'isOwn': str(row[2]) == user_id
+        })
+    attach_senders(cur, hits)
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({
+            'hits': hits,
+            'nextCursor': f'{rows[-1][4]!r}:{rows[-1][0]}' if has_more else None
+        }),
+        'isBase64Encoded': False
+    }
+
+def list_chats(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Список чатов пользователя для боковой панели одним запросом
+    Последнее сообщение берётся по денормализованному chats.last_message_id,
+    поэтому стоимость зависит от числа чатов на странице, а не от истории.
+    '''
+    params = event.get('queryStringParameters', {}) or {}
+    
+    try:
+        limit = int(params.get('limit') or DEFAULT_CHAT_LIST_PAGE_SIZE)
+        cursor_time, cursor_id = None, None
+        if params.get('cursor'):
+            time_part, id_part = params['cursor'].rsplit('|', 1)
+            cursor_time, cursor_id = datetime.fromisoformat(time_part), int(id_part)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Invalid limit or cursor'}),
+            'isBase64Encoded': False
+        }
+    
+    limit = max(1, min(limit, MAX_CHAT_LIST_PAGE_SIZE))
+    
+    cursor_condition = ''
+    if cursor_time is not None:
+        cursor_condition = 'AND (c.last_activity_at, c.id) < (%(cursor_time)s, %(cursor_id)s)'
+    
+    cur = conn.cursor()
+    # Сначала отбирается страница чатов, и только для неё считаются
+    # превью и непрочитанные
+    cur.execute(f"""
+        WITH page AS (
+            SELECT c.id, c.is_group, c.name, c.avatar, c.last_activity_at,
+                   c.last_message_id, c.last_message_at, cm.last_read_message_id
+            FROM chat_members cm
+            JOIN chats c ON c.id = cm.chat_id
+            WHERE cm.user_id = %(user_id)s {cursor_condition}
+            ORDER BY c.last_activity_at DESC, c.id DESC
+            LIMIT %(limit)s
+        )
+        SELECT page.id, page.is_group, page.name, page.avatar, page.last_activity_at,
+               m.id, m.sender_id, m.text, m.is_voice, m.is_file, m.created_at,
+               peer.id, peer.name, peer.avatar,
+               peer.last_seen > LOCALTIMESTAMP - make_interval(secs => %(presence_ttl)s),
+               unread.count
+        FROM page
+        LEFT JOIN messages m ON m.id = page.last_message_id AND m.created_at = page.last_message_at
+        LEFT JOIN direct_chats dc ON dc.chat_id = page.id
+        LEFT JOIN users peer ON peer.id = CASE
+            WHEN dc.user_lo = %(user_id)s::INTEGER THEN dc.user_hi ELSE dc.user_lo
+        END
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS count FROM (
+                SELECT 1 FROM messages um
+                WHERE um.chat_id = page.id
+                AND um.id > page.last_read_message_id
+                AND um.sender_id <> %(user_id)s::INTEGER
+                AND um.deleted_at IS NULL
+                LIMIT %(unread_cap)s
+            ) capped
+        ) unread
+        ORDER BY page.last_activity_at DESC, page.id DESC
+    """, {
+        'user_id': user_id,
+        'cursor_time': cursor_time,
+        'cursor_id': cursor_id,
+        'limit': limit + 1,
+        'unread_cap': MAX_UNREAD_COUNT + 1,
+        'presence_ttl': PRESENCE_TTL_SECONDS
+    })
+    
+    rows = cur.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    chats = []
+    for row in rows:
+        last_message = None
+        if row[5] is not None:
+            last_message = {
+                'id': row[5],
+                'senderId': row[6],
+                'senderName': None,
+                'text': row[7],
+                'isVoice': row[8],
+                'isFile': row[9],
+                'createdAt': row[10].isoformat() if row[10] else None,
+                'isOwn': str(row[6]) == user_id
+            }
+        peer = None
+        if row[11] is not None:
+            peer = {
+                'id': row[11],
+                'name': row[12],
+                'avatar': row[13],
+                'isOnline': row[14]
+            }
+        chats.append({
+            'id': row[0],
+            'isGroup': row[1],
+            'name': row[2] if row[1] else (peer['name'] if peer else row[2]),
+            'avatar': row[3] if row[1] else (peer['avatar'] if peer else row[3]),
+            'lastActivityAt': row[4].isoformat() if row[4] else None,
+            'lastMessage': last_message,
+            'peer': peer,
+            'unreadCount': row[15]
+        })
+    
+    attach_senders(cur, [chat['lastMessage'] for chat in chats if chat['lastMessage']])
     cur.close()
     
+    next_cursor = None
+    if has_more:
+        next_cursor = f'{rows[-1][4].isoformat()}|{rows[-1][0]}'
+    
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True}),
+        'body': dumps({'chats': chats, 'nextCursor': next_cursor}),
+        'isBase64Encoded': False
+    }
+
+def mark_read(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Отметить чат прочитанным до messageId одним UPDATE
+    Отметка только растёт и не уходит дальше последнего сообщения чата;
+    непрочитанные считаются от неё по индексу (chat_id, id), без строк
+    прочтения на каждое сообщение
+    '''
+    body_data = json.loads(event.get('body') or '{}')
+    
+    try:
+        chat_id = int(body_data.get('chatId'))
+        message_id = int(body_data.get('messageId'))
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'chatId and messageId must be integers'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE chat_members cm
+        SET last_read_message_id = LEAST(%(message_id)s, COALESCE(c.last_message_id, 0))
+        FROM chats c
+        WHERE c.id = cm.chat_id AND cm.chat_id = %(chat_id)s AND cm.user_id = %(user_id)s
+        AND cm.last_read_message_id < LEAST(%(message_id)s, COALESCE(c.last_message_id, 0))
+        RETURNING cm.last_read_message_id
+    """, {'chat_id': chat_id, 'message_id': message_id, 'user_id': user_id})
+    row = cur.fetchone()
+    
+    if row is None:
+        # Отметка уже не ниже или пользователь не участник чата
+        cur.execute(
+            "SELECT last_read_message_id FROM chat_members WHERE chat_id = %s AND user_id = %s",
+            (chat_id, user_id)
+        )
+        row = cur.fetchone()
+        if row is None:
+            cur.close()
+            return {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': 'Forbidden'}),
+                'isBase64Encoded': False
+            }
+    
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'chatId': chat_id, 'lastReadMessageId': row[0]}),
+        'isBase64Encoded': False
+    }
+
+def attach_reactions(cur, messages: List[Dict[str, Any]], user_id: str) -> None:
+    '''
+    Добавить к сообщениям страницы агрегированные реакции одним GROUP BY
+    по id страницы вместо запроса на каждое сообщение
+    '''
+    for msg in messages:
+        msg['reactions'] = []
+    if not messages:
+        return
+    
+    by_id = {msg['id']: msg for msg in messages}
+    cur.execute("""
+        SELECT message_id, emoji, COUNT(*), BOOL_OR(user_id = %s::INTEGER)
+        FROM message_reactions
+        WHERE message_id = ANY(%s)
+        GROUP BY message_id, emoji
+        ORDER BY message_id, MIN(created_at)
+    """, (user_id, list(by_id.keys())))
+    
+    for message_id, emoji, count, reacted in cur.fetchall():
+        by_id[message_id]['reactions'].append({'emoji': emoji, 'count': count, 'reacted': reacted})
+
+def parse_reaction(data: Dict[str, Any]) -> Tuple[Optional[int], Optional[str]]:
+    '''Достать messageId и emoji реакции; None при некорректных значениях'''
+    emoji = (data.get('emoji') or '').strip()
+    try:
+        message_id = int(data.get('messageId'))
+    except (TypeError, ValueError):
+        return None, None
+    if not emoji or len(emoji) > MAX_EMOJI_LENGTH:
+        return None, None
+    return message_id, emoji
+
+def add_reaction(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''Поставить реакцию на сообщение чата, в котором состоит пользователь'''
+    body_data = json.loads(event.get('body') or '{}')
+    message_id, emoji = parse_reaction(body_data)
+    
+    if not message_id:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'messageId and emoji (up to {MAX_EMOJI_LENGTH} characters) required'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    # Холостой UPDATE сообщения выдаёт ему новую версию через триггер,
+    # так что реакции видны синхронизации и сбрасывают ETag истории
+    cur.execute("""
+        WITH target AS (
+            SELECT m.id FROM messages m
+            JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = %(user_id)s
+            WHERE m.id = %(message_id)s AND m.deleted_at IS NULL
+        ), reacted AS (
+            INSERT INTO message_reactions (message_id, user_id, emoji)
+            SELECT id, %(user_id)s, %(emoji)s FROM target
+            ON CONFLICT (message_id, user_id, emoji) DO NOTHING
+            RETURNING message_id
+        ), touched AS (
+            UPDATE messages SET version = version
+            WHERE id IN (SELECT message_id FROM reacted)
+            RETURNING version
+        )
+        SELECT (SELECT COUNT(*) FROM target), (SELECT version FROM touched)
+    """, {'user_id': user_id, 'message_id': message_id, 'emoji': emoji})
+    
+    found, version = cur.fetchone()
+    if not found:
+        conn.rollback()
+        cur.close()
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Message not found'}),
+            'isBase64Encoded': False
+        }
+    
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'success': True, 'added': version is not None, 'version': version}),
+        'isBase64Encoded': False
+    }
+
+def remove_reaction(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''Снять свою реакцию с сообщения'''
+    params = event.get('queryStringParameters', {}) or {}
+    message_id, emoji = parse_reaction(params)
+    
+    if not message_id:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'messageId and emoji (up to {MAX_EMOJI_LENGTH} characters) required'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    cur.execute("""
+        WITH removed AS (
+            DELETE FROM message_reactions
+            WHERE message_id = %(message_id)s AND user_id = %(user_id)s AND emoji = %(emoji)s
+            RETURNING message_id
+        ), touched AS (
+            UPDATE messages SET version = version
+            WHERE id IN (SELECT message_id FROM removed)
+            RETURNING version
+        )
+        SELECT version FROM touched
+    """, {'user_id': user_id, 'message_id': message_id, 'emoji': emoji})
+    
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'success': True, 'removed': row is not None, 'version': row[0] if row else None}),
+        'isBase64Encoded': False
+    }
+
+def get_or_create_direct_chat(cur, user_id: str, contact_id: Any) -> Tuple[Optional[int], bool]:
+    '''
+    Найти или создать личный чат пары пользователей за один запрос
+    Пара хранится в direct_chats упорядоченно (user_lo, user_hi), поэтому
+    конкурентные первые сообщения сходятся в один чат через ON CONFLICT.
+    Returns: (chat_id, created); chat_id = None, если собеседника нет
+    '''
+    try:
+        user_lo, user_hi = sorted((int(user_id), int(contact_id)))
+    except (TypeError, ValueError):
+        return None, False
+    
+    try:
+        cur.execute("""
+            WITH existing AS (
+                SELECT chat_id FROM direct_chats
+                WHERE user_lo = %(lo)s AND user_hi = %(hi)s
+            ), pair AS (
+                INSERT INTO direct_chats (user_lo, user_hi, chat_id)
+                SELECT %(lo)s, %(hi)s, nextval(pg_get_serial_sequence('chats', 'id'))
+                WHERE NOT EXISTS (SELECT 1 FROM existing)
+                ON CONFLICT (user_lo, user_hi) DO UPDATE SET user_lo = EXCLUDED.user_lo
+                RETURNING chat_id, (xmax = 0) AS created
+            ), new_chat AS (
+                INSERT INTO chats (id, is_group, created_at)
+                SELECT chat_id, false, CURRENT_TIMESTAMP FROM pair WHERE created
+                RETURNING id
+            ), new_members AS (
+                INSERT INTO chat_members (chat_id, user_id, joined_at)
+                SELECT new_chat.id, member.user_id, CURRENT_TIMESTAMP
+                FROM new_chat CROSS JOIN (VALUES (%(lo)s), (%(hi)s)) AS member(user_id)
+                ON CONFLICT (chat_id, user_id) DO NOTHING
+            )
+            SELECT chat_id, false FROM existing
+            UNION ALL
+            SELECT chat_id, created FROM pair
+        """, {'lo': user_lo, 'hi': user_hi})
+    except psycopg2.errors.ForeignKeyViolation:
+        # Внешний ключ direct_chats -> users заменяет отдельную проверку собеседника
+        cur.connection.rollback()
+        return None, False
+    
+    chat_id, created = cur.fetchone()
+    return chat_id, created
+
+def parse_user_ids(raw_ids: Any) -> Optional[List[int]]:
+    '''Разобрать список id участников без повторов; None при некорректном списке'''
+    if not isinstance(raw_ids, list) or not raw_ids or len(raw_ids) > MAX_GROUP_MEMBERS_PER_REQUEST:
+        return None
+    try:
+        return sorted({int(raw_id) for raw_id in raw_ids})
+    except (TypeError, ValueError):
+        return None
+
+def create_group(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Создать групповой чат с участниками одним запросом
+    Сообщения группы, как и личные, рассылаются одним NOTIFY chat_<id>,
+    а непрочитанные считаются от отметки прочтения участника, поэтому
+    отправка в группу не пишет строк на каждого участника
+    '''
+    body_data = json.loads(event.get('body') or '{}')
+    name = (body_data.get('name') or '').strip()
+    member_ids = parse_user_ids(body_data.get('memberIds') or [user_id])
+    
+    if not name or len(name) > MAX_GROUP_NAME_LENGTH or member_ids is None:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({
+                'error': f'name (up to {MAX_GROUP_NAME_LENGTH} characters) and '
+                         f'memberIds (up to {MAX_GROUP_MEMBERS_PER_REQUEST}) required'
+            }),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    # Несуществующие пользователи отсеиваются соединением с users
+    cur.execute("""
+        WITH new_chat AS (
+            INSERT INTO chats (is_group, name, avatar, created_by, created_at)
+            VALUES (true, %(name)s, %(avatar)s, %(user_id)s, CURRENT_TIMESTAMP)
+            RETURNING id, created_at
+        ), new_members AS (
+            INSERT INTO chat_members (chat_id, user_id, joined_at)
+            SELECT new_chat.id, u.id, CURRENT_TIMESTAMP
+            FROM new_chat
+            JOIN users u ON u.id = ANY(%(member_ids)s::INTEGER[])
+            RETURNING user_id
+        )
+        SELECT new_chat.id, new_chat.created_at, ARRAY(SELECT user_id FROM new_members ORDER BY user_id)
+        FROM new_chat
+    """, {
+        'name': name,
+        'avatar': body_data.get('avatar'),
+        'user_id': user_id,
+        'member_ids': sorted(set(member_ids) | {int(user_id)})
+    })
+    chat_id, created_at, added_ids = cur.fetchone()
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({
+            'id': chat_id,
+            'isGroup': True,
+            'name': name,
+            'avatar': body_data.get('avatar'),
+            'createdAt': created_at.isoformat() if created_at else None,
+            'memberIds': added_ids
+        }),
+        'isBase64Encoded': False
+    }
+
+def add_members(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Добавить участников в группу одной многострочной вставкой
+    Приглашать может любой участник; новички видят историю прочитанной
+    '''
+    body_data = json.loads(event.get('body') or '{}')
+    user_ids = parse_user_ids(body_data.get('userIds'))
+    
+    try:
+        chat_id = int(body_data.get('chatId'))
+    except (TypeError, ValueError):
+        chat_id = None
+    
+    if chat_id is None or user_ids is None:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'chatId and userIds (up to {MAX_GROUP_MEMBERS_PER_REQUEST}) required'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    cur.execute("""
+        WITH target AS (
+            SELECT c.id, COALESCE(c.last_message_id, 0) AS last_message_id
+            FROM chats c
+            JOIN chat_members cm ON cm.chat_id = c.id AND cm.user_id = %(user_id)s
+            WHERE c.id = %(chat_id)s AND c.is_group
+        ), added AS (
+            INSERT INTO chat_members (chat_id, user_id, joined_at, last_read_message_id)
+            SELECT target.id, u.id, CURRENT_TIMESTAMP, target.last_message_id
+            FROM target
+            JOIN users u ON u.id = ANY(%(user_ids)s::INTEGER[])
+            ON CONFLICT (chat_id, user_id) DO NOTHING
+            RETURNING user_id
+        )
+        SELECT (SELECT COUNT(*) FROM target), ARRAY(SELECT user_id FROM added ORDER BY user_id)
+    """, {'chat_id': chat_id, 'user_ids': user_ids, 'user_id': user_id})
+    found, added_ids = cur.fetchone()
+    
+    if not found:
+        conn.rollback()
+        cur.close()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    conn.commit()
+    cur.close()
+    forget_members(chat_id)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'chatId': chat_id, 'added': added_ids}),
+        'isBase64Encoded': False
+    }
+
+def remove_members(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Удалить участников группы одним DELETE
+    Создатель группы удаляет кого угодно, остальные могут только выйти сами
+    '''
+    body_data = json.loads(event.get('body') or '{}')
+    user_ids = parse_user_ids(body_data.get('userIds'))
+    
+    try:
+        chat_id = int(body_data.get('chatId'))
+    except (TypeError, ValueError):
+        chat_id = None
+    
+    if chat_id is None or user_ids is None:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'chatId and userIds (up to {MAX_GROUP_MEMBERS_PER_REQUEST}) required'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    cur.execute("""
+        WITH target AS (
+            SELECT c.id, COALESCE(c.created_by = %(user_id)s::INTEGER, false) AS is_owner
+            FROM chats c
+            JOIN chat_members cm ON cm.chat_id = c.id AND cm.user_id = %(user_id)s
+            WHERE c.id = %(chat_id)s AND c.is_group
+        ), removed AS (
+            DELETE FROM chat_members cm
+            USING target
+            WHERE cm.chat_id = target.id AND cm.user_id = ANY(%(user_ids)s::INTEGER[])
+            AND (target.is_owner OR cm.user_id = %(user_id)s::INTEGER)
+            RETURNING cm.user_id
+        )
+        SELECT (SELECT is_owner FROM target), ARRAY(SELECT user_id FROM removed ORDER BY user_id)
+    """, {'chat_id': chat_id, 'user_ids': user_ids, 'user_id': user_id})
+    is_owner, removed_ids = cur.fetchone()
+    
+    # Не создатель может убрать только себя: чужие id отменяют весь запрос
+    if is_owner is None or (not is_owner and user_ids != [int(user_id)]):
+        conn.rollback()
+        cur.close()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    conn.commit()
+    cur.close()
+    forget_members(chat_id)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'chatId': chat_id, 'removed': removed_ids}),
+        'isBase64Encoded': False
+    }
+
+def send_message(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''Отправить новое сообщение или пакет сообщений (body.messages)'''
+    body_data = json.loads(event.get('body', '{}'))
+    
+    if 'messages' in body_data:
+        return send_message_batch(conn, body_data.get('messages'), user_id)
+    
+    item, error = parse_message_item(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    
+    # Если передан contactId, найти или создать чат
+    if item['contact_id']:
+        chat_id, created = get_or_create_direct_chat(cur, user_id, item['contact_id'])
+        if not chat_id:
+            cur.close()
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': f'User with id {item["contact_id"]} not found'}),
+                'isBase64Encoded': False
+            }
+        item['chat_id'] = chat_id
+    
+    if not item['chat_id']:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'chatId or contactId required'}),
+            'isBase64Encoded': False
+        }
+    
+    if not item['contact_id'] and not is_member(cur, item['chat_id'], user_id):
+        cur.close()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    missing_attachment = attach_files(cur, user_id, [item])
+    if missing_attachment:
+        cur.close()
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'Attachment {missing_attachment} not found or not uploaded'}),
+            'isBase64Encoded': False
+        }
+    
+    result = insert_messages(cur, user_id, [item])[0]
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps(result),
+        'isBase64Encoded': False
+    }
+
+def send_message_batch(conn, raw_items: Any, user_id: str) -> Dict[str, Any]:
+    '''
+    Пакетная отправка из офлайн-очереди клиента: одна транзакция, одна
+    многострочная вставка. Повтор пакета после таймаута безопасен — уже
+    сохранённые clientId возвращаются с duplicate = true.
+    '''
+    if not isinstance(raw_items, list) or not raw_items or len(raw_items) > MAX_BATCH_SIZE:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'messages must be a non-empty array of at most {MAX_BATCH_SIZE} items'}),
+            'isBase64Encoded': False
+        }
+    
+    items = []
+    for index, raw_item in enumerate(raw_items):
+        item, error = parse_message_item(raw_item if isinstance(raw_item, dict) else {})
+        if not error and not item['client_id']:
+            error = 'clientId required'
+        if not error and not item['chat_id'] and not item['contact_id']:
+            error = 'chatId or contactId required'
+        if error:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': error, 'index': index}),
+                'isBase64Encoded': False
+            }
+        items.append(item)
+    
+    if len({item['client_id'] for item in items}) != len(items):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'clientId must be unique within a batch'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    
+    for chat_id in {item['chat_id'] for item in items if not item['contact_id']}:
+        if not is_member(cur, chat_id, user_id):
+            cur.close()
+            return {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': 'Forbidden', 'chatId': chat_id}),
+                'isBase64Encoded': False
+            }
+    
+    # Личные чаты разрешаются по одному разу на собеседника, а не на сообщение
+    direct_chats: Dict[str, int] = {}
+    for item in items:
+        contact_id = item['contact_id']
+        if not contact_id:
+            continue
+        if str(contact_id) not in direct_chats:
+            chat_id, created = get_or_create_direct_chat(cur, user_id, contact_id)
+            if not chat_id:
+                cur.close()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': dumps({'error': f'User with id {contact_id} not found'}),
+                    'isBase64Encoded': False
+                }
+            direct_chats[str(contact_id)] = chat_id
+        item['chat_id'] = direct_chats[str(contact_id)]
+    
+    missing_attachment = attach_files(cur, user_id, items)
+    if missing_attachment:
+        cur.close()
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'Attachment {missing_attachment} not found or not uploaded'}),
+            'isBase64Encoded': False
+        }
+    
+    results = insert_messages(cur, user_id, items)
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'messages': results}),
+        'isBase64Encoded': False
+    }
+
+def parse_message_item(data: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    '''Разобрать поля одного отправляемого сообщения; вернуть (item, error)'''
+    item = {
+        'chat_id': data.get('chatId'),
+        'contact_id': data.get('contactId'),
+        'text': (data.get('text') or '').strip(),
+        'is_voice': bool(data.get('isVoice', False)),
+        'voice_duration': data.get('voiceDuration'),
+        'is_file': bool(data.get('isFile', False)),
+        'file_name': data.get('fileName'),
+        'file_size': data.get('fileSize'),
+        'reply_to_id': data.get('replyToId'),
+        'attachment_id': data.get('attachmentId'),
+        'client_id': data.get('clientId')
+    }
+    
+    if not item['text'] and not item['is_voice'] and not item['is_file'] and not item['attachment_id']:
+        return item, 'Message text required'
+    
+    if item['client_id'] is not None:
+        item['client_id'] = str(item['client_id'])
+        if not item['client_id'] or len(item['client_id']) > MAX_CLIENT_ID_LENGTH:
+            return item, f'clientId must be 1-{MAX_CLIENT_ID_LENGTH} characters'
+    
+    # Массивы unnest типизированы, поэтому числа из JSON приводятся к колонкам
+    for key in ('voice_duration', 'file_size'):
+        if item[key] is not None:
+            item[key] = str(item[key])
+    try:
+        for key in ('chat_id', 'reply_to_id', 'attachment_id'):
+            if item[key] is not None:
+                item[key] = int(item[key])
+    except (TypeError, ValueError):
+        return item, 'chatId, replyToId and attachmentId must be integers'
+    
+    return item, None
+
+def format_file_size(size: int) -> str:
+    '''Размер файла для подписи в чате: "2.4 МБ"'''
+    value = float(size)
+    for unit in ('Б', 'КБ', 'МБ'):
+        if value < 1024:
+            return f'{value:.0f} {unit}' if unit == 'Б' else f'{value:.1f} {unit}'
+        value /= 1024
+    return f'{value:.1f} ГБ'
+
+def attach_files(cur, user_id: str, items: List[Dict[str, Any]]) -> Optional[int]:
+    '''
+    Заполнить isFile, имя и размер файла сообщений из их вложений одним запросом
+    Отправить можно только своё загруженное вложение; чужое попадает в чат
+    только пересылкой, которая копирует attachment_id
+    Returns: id недоступного вложения или None
+    '''
+    attachment_ids = {item['attachment_id'] for item in items if item['attachment_id']}
+    if not attachment_ids:
+        return None
+    
+    cur.execute("""
+        SELECT id, file_name, size FROM attachments
+        WHERE id = ANY(%s) AND owner_id = %s AND status = 'ready'
+    """, (list(attachment_ids), user_id))
+    found = {row[0]: row for row in cur.fetchall()}
+    
+    for item in items:
+        if not item['attachment_id']:
+            continue
+        row = found.get(item['attachment_id'])
+        if row is None:
+            return item['attachment_id']
+        item['is_file'] = True
+        item['file_name'] = row[1]
+        item['file_size'] = format_file_size(row[2])
+    return None
+
+def insert_messages(cur, user_id: str, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Вставить сообщения одним запросом INSERT ... SELECT FROM unnest
+    clientId занимается в message_client_ids (sender_id, client_id) в том же
+    запросе: повторная отправка не создаёт строку, а возвращает ранее
+    сохранённое сообщение. id выдаются заранее, чтобы ключ ссылался на них.
+    NOTIFY уходит по одному на чат и доставляется ожидающим при коммите.
+    '''
+    cur.execute("""
+        WITH items AS (
+            SELECT item.*, nextval(pg_get_serial_sequence('messages', 'id'))::INTEGER AS id
+            FROM unnest(
+                %(ord)s::INTEGER[], %(chat_id)s::INTEGER[], %(text)s::TEXT[],
+                %(is_voice)s::BOOLEAN[], %(voice_duration)s::VARCHAR[], %(is_file)s::BOOLEAN[],
+                %(file_name)s::VARCHAR[], %(file_size)s::VARCHAR[], %(reply_to_id)s::INTEGER[],
+                %(attachment_id)s::INTEGER[], %(client_id)s::VARCHAR[]
+            ) AS item(
+                ord, chat_id, text, is_voice, voice_duration, is_file,
+                file_name, file_size, reply_to_id, attachment_id, client_id
+            )
+        ), claimed AS (
+            INSERT INTO message_client_ids (sender_id, client_id, message_id, created_at)
+            SELECT %(sender_id)s, client_id, id, CURRENT_TIMESTAMP
+            FROM items
+            WHERE client_id IS NOT NULL
+            ON CONFLICT (sender_id, client_id) DO NOTHING
+            RETURNING client_id
+        ), inserted AS (
+            INSERT INTO messages (
+                id, chat_id, sender_id, text, is_voice, voice_duration,
+                is_file, file_name, file_size, reply_to_id, attachment_id, client_id, created_at
+            )
+            SELECT id, chat_id, %(sender_id)s, text, is_voice, voice_duration,
+                   is_file, file_name, file_size, reply_to_id, attachment_id, client_id, CURRENT_TIMESTAMP
+            FROM items
+            WHERE client_id IS NULL OR client_id IN (SELECT client_id FROM claimed)
+            ORDER BY ord
+            RETURNING id, chat_id, created_at, version, client_id
+        ), notified AS (
+            SELECT pg_notify('chat_' || chat_id, MAX(id)::text)
+            FROM inserted
+            GROUP BY chat_id
+        )
+        SELECT items.ord, items.client_id,
+               COALESCE(inserted.id, existing.id),
+               COALESCE(inserted.chat_id, existing.chat_id),
+               COALESCE(inserted.created_at, existing.created_at),
+               COALESCE(inserted.version, existing.version),
+               inserted.id IS NULL AS duplicate
+        FROM items
+        LEFT JOIN inserted ON inserted.id = items.id
+        LEFT JOIN message_client_ids client_key
+            ON inserted.id IS NULL
+            AND client_key.sender_id = %(sender_id)s
+            AND client_key.client_id = items.client_id
+        LEFT JOIN messages existing
+            ON existing.id = client_key.message_id
+            AND existing.created_at = client_key.created_at
+        CROSS JOIN (SELECT COUNT(*) FROM notified) AS notifications
+        ORDER BY items.ord
+    """, {
+        'sender_id': user_id,
+        'ord': list(range(len(items))),
+        'chat_id': [item['chat_id'] for item in items],
+        'text': [item['text'] for item in items],
+        'is_voice': [item['is_voice'] for item in items],
+        'voice_duration': [item['voice_duration'] for item in items],
+        'is_file': [item['is_file'] for item in items],
+        'file_name': [item['file_name'] for item in items],
+        'file_size': [item['file_size'] for item in items],
+        'reply_to_id': [item['reply_to_id'] for item in items],
+        'attachment_id': [item['attachment_id'] for item in items],
+        'client_id': [item['client_id'] for item in items]
+    })
+    
+    results = []
+    for row in cur.fetchall():
+        ord_, client_id, message_id, chat_id, created_at, version, duplicate = row
+        results.append({
+            'id': message_id,
+            'chatId': chat_id,
+            'createdAt': created_at.isoformat() if created_at else None,
+            'version': version,
+            'clientId': client_id,
+            'duplicate': duplicate
+        })
+    
+    # Параллельный повтор с тем же clientId ждёт коммита первого на ON CONFLICT,
+    # но снимок запроса строку победителя не видит. Следующий запрос в
+    # READ COMMITTED берёт новый снимок и находит её
+    unresolved = {r['clientId']: r for r in results if r['duplicate'] and r['id'] is None}
+    if unresolved:
+        cur.execute("""
+            SELECT client_key.client_id, m.id, m.chat_id, m.created_at, m.version
+            FROM message_client_ids client_key
+            JOIN messages m
+                ON m.id = client_key.message_id
+                AND m.created_at = client_key.created_at
+            WHERE client_key.sender_id = %s AND client_key.client_id = ANY(%s)
+        """, (user_id, list(unresolved)))
+        for client_id, message_id, chat_id, created_at, version in cur.fetchall():
+            unresolved[client_id].update({
+                'id': message_id,
+                'chatId': chat_id,
+                'createdAt': created_at.isoformat() if created_at else None,
+                'version': version
+            })
+    return results
+
+def edit_message(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''Редактировать сообщение или пакет сообщений (body.messages)'''
+    body_data = json.loads(event.get('body', '{}'))
+    
+    if 'messages' in body_data:
+        return edit_message_batch(conn, body_data.get('messages'), user_id)
+    
+    message_id = body_data.get('messageId')
+    text = body_data.get('text', '').strip()
+    
+    if not message_id or not text:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'messageId and text required'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        created_at = parse_created_at(body_data.get('createdAt'))
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'createdAt must be an ISO timestamp'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    
+    # Проверить, что сообщение принадлежит пользователю; версию выставит триггер.
+    # createdAt из истории сводит UPDATE к одной партиции
+    cur.execute(f"""
+        UPDATE messages SET text = %s, is_edited = true
+        WHERE id = %s AND sender_id = %s AND deleted_at IS NULL
+        {'AND created_at = %s' if created_at else ''}
+        RETURNING version
+    """, (text, message_id, user_id) + ((created_at,) if created_at else ()))
+    
+    if cur.rowcount == 0:
+        conn.rollback()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    version = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'success': True, 'version': version}),
+        'isBase64Encoded': False
+    }
+
+def delete_message(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''Удалить сообщение (messageId в запросе) или пакет сообщений (body.messages)'''
+    body_data = json.loads(event.get('body') or '{}')
+    if 'messages' in body_data:
+        return delete_message_batch(conn, body_data.get('messages'), user_id)
+    
+    params = event.get('queryStringParameters', {}) or {}
+    message_id = params.get('messageId')
+    
+    if not message_id:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'messageId required'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        created_at = parse_created_at(params.get('createdAt'))
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'createdAt must be an ISO timestamp'}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    
+    # Удалить только свои сообщения. Строка остаётся как tombstone без
+    # содержимого, чтобы синхронизация могла сообщить клиентам об удалении.
+    # createdAt из истории сводит UPDATE к одной партиции
+    cur.execute(f"""
+        UPDATE messages
+        SET deleted_at = CURRENT_TIMESTAMP, text = NULL, voice_duration = NULL,
+            file_name = NULL, file_size = NULL
+        WHERE id = %s AND sender_id = %s AND deleted_at IS NULL
+        {'AND created_at = %s' if created_at else ''}
+        RETURNING version
+    """, (message_id, user_id) + ((created_at,) if created_at else ()))
+    
+    if cur.rowcount == 0:
+        conn.rollback()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+    
+    version = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'success': True, 'version': version}),
+        'isBase64Encoded': False
+    }
+
+def parse_message_refs(raw_items: Any) -> Tuple[List[int], List[Optional[datetime]], Optional[str]]:
+    '''
+    Разобрать список {messageId, createdAt} пакетной операции
+    createdAt необязателен, но только с ним запрос отсекает партиции
+    Returns: (ids, created_ats, error)
+    '''
+    if not isinstance(raw_items, list) or not raw_items or len(raw_items) > MAX_BATCH_SIZE:
+        return [], [], f'messages must be a non-empty array of at most {MAX_BATCH_SIZE} items'
+    
+    ids: List[int] = []
+    created_ats: List[Optional[datetime]] = []
+    for raw_item in raw_items:
+        try:
+            if not isinstance(raw_item, dict):
+                raise ValueError('item must be an object')
+            ids.append(int(raw_item.get('messageId')))
+            created_ats.append(parse_created_at(raw_item.get('createdAt')))
+        except (TypeError, ValueError):
+            return [], [], 'each item needs an integer messageId and an optional ISO createdAt'
+    
+    if len(set(ids)) != len(ids):
+        return [], [], 'messageId must be unique within a batch'
+    return ids, created_ats, None
+
+def partition_condition(created_ats: List[Optional[datetime]], alias: str) -> str:
+    '''Условие на created_at из unnest, если оно известно для всех элементов пакета'''
+    if created_ats and all(created_ats):
+        return f'AND m.created_at = {alias}.created_at'
+    return ''
+
+def apply_message_batch(conn, cur, ids: List[int], rows: List[Tuple[int, int]]) -> Dict[str, Any]:
+    '''
+    Завершить пакетное изменение: всё или ничего
+    Если хотя бы одно сообщение не найдено среди своих неудалённых,
+    транзакция откатывается, а в ответе перечисляются такие id
+    '''
+    changed = {message_id: version for message_id, version in rows}
+    missing = [message_id for message_id in ids if message_id not in changed]
+    if missing:
+        conn.rollback()
+        cur.close()
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Forbidden', 'messageIds': missing}),
+            'isBase64Encoded': False
+        }
+    
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({
+            'success': True,
+            'messages': [{'id': message_id, 'version': changed[message_id]} for message_id in ids]
+        }),
+        'isBase64Encoded': False
+    }
+
+def edit_message_batch(conn, raw_items: Any, user_id: str) -> Dict[str, Any]:
+    '''Отредактировать пакет своих сообщений одним UPDATE ... FROM unnest'''
+    ids, created_ats, error = parse_message_refs(raw_items)
+    texts = []
+    if not error:
+        texts = [str(raw_item.get('text') or '').strip() for raw_item in raw_items]
+        if not all(texts):
+            error = 'text required for every message'
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE messages m
+        SET text = edit.text, is_edited = true
+        FROM unnest(%s::INTEGER[], %s::TEXT[], %s::TIMESTAMP[]) AS edit(id, text, created_at)
+        WHERE m.id = edit.id {partition_condition(created_ats, 'edit')}
+        AND m.sender_id = %s AND m.deleted_at IS NULL
+        RETURNING m.id, m.version
+    """, (ids, texts, created_ats, user_id))
+    
+    return apply_message_batch(conn, cur, ids, cur.fetchall())
+
+def delete_message_batch(conn, raw_items: Any, user_id: str) -> Dict[str, Any]:
+    '''
+    Мягко удалить пакет своих сообщений одним UPDATE ... FROM unnest
+    Строки остаются tombstone, поэтому ответы на них (reply_to_id) не ломаются
+    '''
+    ids, created_ats, error = parse_message_refs(raw_items)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE messages m
+        SET deleted_at = CURRENT_TIMESTAMP, text = NULL, voice_duration = NULL,
+            file_name = NULL, file_size = NULL
+        FROM unnest(%s::INTEGER[], %s::TIMESTAMP[]) AS target(id, created_at)
+        WHERE m.id = target.id {partition_condition(created_ats, 'target')}
+        AND m.sender_id = %s AND m.deleted_at IS NULL
+        RETURNING m.id, m.version
+    """, (ids, created_ats, user_id))
+    
+    return apply_message_batch(conn, cur, ids, cur.fetchall())
+
+def forward_messages(conn, event: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    '''
+    Переслать N сообщений в M чатов одной многострочной вставкой
+    Пересылать можно только сообщения из своих чатов и только в свои чаты;
+    forwarded_from хранит автора оригинала и сохраняется при повторной пересылке
+    '''
+    body_data = json.loads(event.get('body') or '{}')
+    ids, created_ats, error = parse_message_refs(body_data.get('messages'))
+    chat_ids = body_data.get('chatIds')
+    if not error:
+        try:
+            chat_ids = [int(chat_id) for chat_id in chat_ids]
+        except (TypeError, ValueError):
+            chat_ids = []
+        if not chat_ids or len(chat_ids) > MAX_FORWARD_CHATS or len(set(chat_ids)) != len(chat_ids):
+            error = f'chatIds must be 1-{MAX_FORWARD_CHATS} distinct chat ids'
+        elif len(ids) * len(chat_ids) > MAX_FORWARD_COPIES:
+            error = f'At most {MAX_FORWARD_COPIES} copies per request'
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    cur = conn.cursor()
+    # id копий выдаются в порядке (чат, исходное сообщение), чтобы в каждом
+    # чате пересланные шли в том же порядке, что и оригиналы
+    cur.execute(f"""
+        WITH source AS (
+            SELECT ref.ord, m.id, m.text, m.is_voice, m.voice_duration, m.is_file,
+                   m.file_name, m.file_size, m.attachment_id,
+                   CASE WHEN m.is_forwarded THEN m.forwarded_from ELSE u.name END AS forwarded_from
+            FROM unnest(%(ids)s::INTEGER[], %(created_ats)s::TIMESTAMP[]) WITH ORDINALITY
+                AS ref(id, created_at, ord)
+            JOIN messages m ON m.id = ref.id {partition_condition(created_ats, 'ref')}
+            JOIN chat_members source_member
+                ON source_member.chat_id = m.chat_id AND source_member.user_id = %(user_id)s
+            JOIN users u ON u.id = m.sender_id
+            WHERE m.deleted_at IS NULL
+        ), targets AS (
+            SELECT target.chat_id, target.ord
+            FROM unnest(%(chat_ids)s::INTEGER[]) WITH ORDINALITY AS target(chat_id, ord)
+            JOIN chat_members target_member
+                ON target_member.chat_id = target.chat_id AND target_member.user_id = %(user_id)s
+        ), copies AS (
+            SELECT nextval(pg_get_serial_sequence('messages', 'id'))::INTEGER AS id, ordered.*
+            FROM (
+                SELECT targets.chat_id, source.id AS source_id, source.text, source.is_voice,
+                       source.voice_duration, source.is_file, source.file_name, source.file_size,
+                       source.attachment_id, source.forwarded_from
+                FROM targets CROSS JOIN source
+                ORDER BY targets.ord, source.ord
+            ) ordered
+        ), inserted AS (
+            INSERT INTO messages (
+                id, chat_id, sender_id, text, is_voice, voice_duration, is_file,
+                file_name, file_size, attachment_id, is_forwarded, forwarded_from, created_at
+            )
+            SELECT id, chat_id, %(user_id)s, text, is_voice, voice_duration, is_file,
+                   file_name, file_size, attachment_id, true, forwarded_from, CURRENT_TIMESTAMP
+            FROM copies
+            ORDER BY id
+            RETURNING id, chat_id, created_at, version
+        ), notified AS (
+            SELECT pg_notify('chat_' || chat_id, MAX(id)::text)
+            FROM inserted
+            GROUP BY chat_id
+        )
+        SELECT (SELECT COUNT(*) FROM source), (SELECT COUNT(*) FROM targets),
+               copies.source_id, inserted.id, inserted.chat_id, inserted.created_at, inserted.version
+        FROM inserted
+        JOIN copies ON copies.id = inserted.id
+        CROSS JOIN (SELECT COUNT(*) FROM notified) AS notifications
+        ORDER BY inserted.id
+    """, {
+        'ids': ids,
+        'created_ats': created_ats,
+        'chat_ids': chat_ids,
+        'user_id': user_id
+    })
+    rows = cur.fetchall()
+    
+    # Недоступный источник или чат отменяет всю пересылку
+    found_sources, found_targets = (rows[0][0], rows[0][1]) if rows else (0, 0)
+    if found_sources != len(ids) or found_targets != len(chat_ids):
+        conn.rollback()
+        cur.close()
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Message or chat not found'}),
+            'isBase64Encoded': False
+        }
+    
+    conn.commit()
+    cur.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({
+            'messages': [
+                {
+                    'sourceId': source_id,
+                    'id': message_id,
+                    'chatId': chat_id,
+                    'createdAt': created_at.isoformat() if created_at else None,
+                    'version': version
+                }
+                for _, _, source_id, message_id, chat_id, created_at, version in rows
+            ]
+        }),
         'isBase64Encoded': False
     }
\ No newline at end of file
@@ -0,0 +1,70 @@
+'''
+Кэш состава чатов в памяти тёплого экземпляра
+Каждое чтение и запись сообщений проверяет, что пользователь состоит в
+чате; состав чата читается одним запросом при промахе и дальше проверяется
+без обращения к БД. Запись сбрасывается по NOTIFY chat_members_changed
+(триггер на chat_members), своим экземпляром — сразу после изменения, и в
+любом случае живёт не дольше MEMBERSHIP_CACHE_TTL_SECONDS.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import FrozenSet, Tuple
+
+from db import subscribe
+
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', '5000'))
+MEMBERSHIP_CACHE_TTL_SECONDS = float(os.environ.get('MEMBERSHIP_CACHE_TTL_SECONDS', '60'))
+MEMBERS_CHANGED_CHANNEL = 'chat_members_changed'
+
+_members: 'OrderedDict[int, Tuple[float, FrozenSet[int]]]' = OrderedDict()
+_members_lock = threading.Lock()
+
+def get_members(cur, chat_id: int, refresh: bool = False) -> FrozenSet[int]:
+    '''Множество id участников чата; при промахе или refresh читается одним запросом'''
+    now = time.monotonic()
+    with _members_lock:
+        entry = _members.get(chat_id)
+        if entry is not None and entry[0] > now and not refresh:
+            _members.move_to_end(chat_id)
+            return entry[1]
+    
+    cur.execute("SELECT user_id FROM chat_members WHERE chat_id = %s", (chat_id,))
+    members = frozenset(row[0] for row in cur.fetchall())
+    
+    with _members_lock:
+        _members[chat_id] = (time.monotonic() + MEMBERSHIP_CACHE_TTL_SECONDS, members)
+        _members.move_to_end(chat_id)
+        while len(_members) > MEMBERSHIP_CACHE_SIZE:
+            _members.popitem(last=False)
+    return members
+
+def is_member(cur, chat_id, user_id) -> bool:
+    '''
+    Состоит ли пользователь в чате; нечисловые id — не состоит
+    Отказ перепроверяется по БД: уведомление о только что добавленном
+    участнике может ещё не дойти до этого экземпляра
+    '''
+    try:
+        chat_id, user_id = int(chat_id), int(user_id)
+    except (TypeError, ValueError):
+        return False
+    if user_id in get_members(cur, chat_id):
+        return True
+    return user_id in get_members(cur, chat_id, refresh=True)
+
+def forget(chat_id: int) -> None:
+    '''Сбросить состав чата после изменения в этом же экземпляре'''
+    with _members_lock:
+        _members.pop(chat_id, None)
+
+def invalidate(payload: str) -> None:
+    '''Сбросить состав из уведомления; нечисловой payload сбрасывает весь кэш'''
+    try:
+        forget(int(payload))
+    except ValueError:
+        with _members_lock:
+            _members.clear()
+
+subscribe(MEMBERS_CHANGED_CHANNEL, invalidate)
@@ -0,0 +1,69 @@
+'''
+Кэш профилей пользователей (имя, аватар) в памяти тёплого экземпляра
+В истории чата одни и те же несколько отправителей повторяются на каждой
+строке, поэтому выборки сообщений не соединяются с users: имена берутся
+отсюда, а промахи дочитываются одним запросом WHERE id = ANY(...).
+Запись сбрасывается по NOTIFY profile_changed (триггер на users) и в любом
+случае живёт не дольше PROFILE_CACHE_TTL_SECONDS.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Tuple
+
+from db import subscribe
+
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL_SECONDS = float(os.environ.get('PROFILE_CACHE_TTL_SECONDS', '300'))
+PROFILE_CHANGED_CHANNEL = 'profile_changed'
+
+_profiles: 'OrderedDict[int, Tuple[float, Dict[str, Any]]]' = OrderedDict()
+_profiles_lock = threading.Lock()
+
+def get_profiles(cur, user_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    '''Профили {id: {name, avatar}}; отсутствующие в кэше читаются одним запросом'''
+    now = time.monotonic()
+    found: Dict[int, Dict[str, Any]] = {}
+    missing = []
+    with _profiles_lock:
+        for user_id in set(user_ids):
+            entry = _profiles.get(user_id)
+            if entry is not None and entry[0] > now:
+                _profiles.move_to_end(user_id)
+                found[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+    if not missing:
+        return found
+    
+    cur.execute("SELECT id, name, avatar FROM users WHERE id = ANY(%s)", (missing,))
+    loaded = {row[0]: {'name': row[1], 'avatar': row[2]} for row in cur.fetchall()}
+    
+    expires_at = time.monotonic() + PROFILE_CACHE_TTL_SECONDS
+    with _profiles_lock:
+        for user_id, profile in loaded.items():
+            _profiles[user_id] = (expires_at, profile)
+            _profiles.move_to_end(user_id)
+        while len(_profiles) > PROFILE_CACHE_SIZE:
+            _profiles.popitem(last=False)
+    found.update(loaded)
+    return found
+
+def invalidate(payload: str) -> None:
+    '''Сбросить профиль из уведомления; нечисловой payload сбрасывает весь кэш'''
+    with _profiles_lock:
+        try:
+            _profiles.pop(int(payload), None)
+        except ValueError:
+            _profiles.clear()
+
+def attach_senders(cur, items: Iterable[Dict[str, Any]]) -> None:
+    '''Заполнить senderName у сообщений по senderId из кэша профилей'''
+    items = list(items)
+    profiles = get_profiles(cur, (item['senderId'] for item in items))
+    for item in items:
+        profile = profiles.get(item['senderId'])
+        item['senderName'] = profile['name'] if profile else None
+
+subscribe(PROFILE_CHANGED_CHANNEL, invalidate)
@@ -0,0 +1,157 @@
+'''
+Кодирование тела ответа: JSON, сжатие по Accept-Encoding и base64
+JSON собирает orjson, если он установлен, иначе стандартный json. Тело
+от RESPONSE_COMPRESS_MIN_BYTES сжимается brotli (если установлен) или gzip
+и уходит в base64 с isBase64Encoded, когда сжатое действительно короче.
+Длинные списки пишутся построчно прямо из серверного курсора: строки
+сериализуются и сжимаются по мере чтения, без промежуточного списка dict.
+'''
+import base64
+import json
+import os
+import zlib
+from functools import wraps
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from instrumentation import phase
+
+# Меньшие тела не окупают сжатие и base64
+COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+# Сколько строк серверного курсора читать за одно обращение к БД
+STREAM_FETCH_SIZE = int(os.environ.get('RESPONSE_STREAM_FETCH_SIZE', '500'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+def json_bytes(value: Any) -> bytes:
+    '''JSON в байтах; orjson в несколько раз быстрее json.dumps'''
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, separators=(',', ':')).encode()
+
+def dumps(value: Any) -> str:
+    '''JSON тела ответа с учётом времени в фазе serialize'''
+    with phase('serialize'):
+        return json_bytes(value).decode()
+
+def negotiate_encoding(event: Dict[str, Any]) -> Optional[str]:
+    '''Лучшее доступное сжатие из Accept-Encoding: br, затем gzip'''
+    header = ''
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == 'accept-encoding':
+            header = value or ''
+    accepted = set()
+    for token in header.lower().split(','):
+        name, _, params = token.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(name.strip())
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+class BodyEncoder:
+    '''Тело ответа, сжимаемое кусками по мере записи'''
+    
+    def __init__(self, encoding: Optional[str]):
+        self.encoding = encoding
+        self._chunks = []
+        self._compressor = None
+        if encoding == 'gzip':
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    
+    def write(self, data: bytes) -> None:
+        if self._compressor is None:
+            self._chunks.append(data)
+        elif self.encoding == 'br':
+            self._chunks.append(self._compressor.process(data))
+        else:
+            self._chunks.append(self._compressor.compress(data))
+    
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            self._chunks.append(self._compressor.finish())
+        elif self._compressor is not None:
+            self._chunks.append(self._compressor.flush())
+        return b''.join(self._chunks)
+
+def _apply_body(response: Dict[str, Any], encoding: Optional[str], body: bytes) -> Dict[str, Any]:
+    headers = response.setdefault('headers', {})
+    headers['Vary'] = 'Accept-Encoding'
+    if encoding is None:
+        response['body'] = body.decode()
+        response['isBase64Encoded'] = False
+    else:
+        headers['Content-Encoding'] = encoding
+        response['body'] = base64.b64encode(body).decode()
+        response['isBase64Encoded'] = True
+    return response
+
+def encode_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    '''Сжать готовое тело, если клиент это поддерживает и сжатие окупается'''
+    body = response.get('body')
+    if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = negotiate_encoding(event)
+    if encoding is None:
+        response.setdefault('headers', {})['Vary'] = 'Accept-Encoding'
+        return response
+    with phase('serialize'):
+        raw = body.encode()
+        encoder = BodyEncoder(encoding)
+        encoder.write(raw)
+        compressed = encoder.finish()
+        if len(compressed) >= len(raw):
+            return response
+        return _apply_body(response, encoding, compressed)
+
+def encoded(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]):
+    '''Обернуть handler: сжимать ответы по Accept-Encoding запроса'''
+    @wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        return encode_response(event, handler(event, context))
+    return wrapper
+
+def iter_rows(cur, size: int = STREAM_FETCH_SIZE) -> Iterator[Any]:
+    '''Строки курсора порциями fetchmany; с именованным курсором — без чтения всей выборки'''
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+def stream_response(event: Dict[str, Any], status: int, headers: Dict[str, str],
+                    head: Dict[str, Any], key: str, rows: Iterable[Any],
+                    convert: Callable[[Any], Any]) -> Dict[str, Any]:
+    '''
+    Ответ {**head, key: [convert(row), ...]}, собранный без списка элементов
+    Каждый элемент сериализуется и сразу уходит в сжатие; размер заранее
+    неизвестен, поэтому тело сжимается всегда, когда клиент это принимает
+    '''
+    encoder = BodyEncoder(negotiate_encoding(event))
+    opening = json_bytes(head)[:-1]
+    encoder.write(opening + (b',' if len(opening) > 1 else b'') + json_bytes(key) + b':[')
+    first = True
+    for row in rows:
+        item = convert(row)
+        with phase('serialize'):
+            encoder.write((b'' if first else b',') + json_bytes(item))
+        first = False
+    with phase('serialize'):
+        encoder.write(b']}')
+        body = encoder.finish()
+    response = {'statusCode': status, 'headers': dict(headers)}
+    return _apply_body(response, encoder.encoding, body)
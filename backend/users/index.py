@@ -1,13 +1,27 @@
-import json
-import os
-import psycopg2
-from typing import Dict, Any
+import re
+from typing import Dict, Any, Optional
 
+from db import connection
+from instrumentation import instrumented
+from presence import PRESENCE_TTL_SECONDS, record_heartbeat, write_due
+from responses import dumps, encoded
+from session import authenticate
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+# Короче этого запрос ищется только по префиксу имени: триграммы не работают
+MIN_TRIGRAM_QUERY_LENGTH = 3
+MIN_PHONE_QUERY_DIGITS = 3
+MAX_PRESENCE_IDS = 200
+
+@instrumented('users')
+@encoded
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Поиск пользователей по имени, телефону или био
-    Args: event с httpMethod, queryStringParameters {query}
-    Returns: HTTP response со списком найденных пользователей
+    Поиск пользователей и их присутствие
+    Args: event с httpMethod; GET queryStringParameters {query, limit, cursor}
+          или {ids} с сессией для статусов, POST с сессией — heartbeat
+    Returns: HTTP response со списком найденных пользователей или статусами
     '''
     method: str = event.get('httpMethod', 'GET')
     
@@ -16,67 +30,262 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Session-Token, X-User-Id',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
+    if method == 'POST':
+        return heartbeat(event)
+    
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get('ids'):
+        return get_presence(event)
+    
     if method == 'GET':
         params = event.get('queryStringParameters', {}) or {}
         query = params.get('query', '').strip()
-        user_id = event.get('headers', {}).get('X-User-Id')
+        user_id = authenticate(event)
         
         if not query:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Query parameter is required'}),
+                'body': dumps({'error': 'Query parameter is required'}),
                 'isBase64Encoded': False
             }
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        search_pattern = f'%{query}%'
-        cur.execute(
-            """
-            SELECT id, phone, name, avatar, bio, is_online 
-            FROM users 
-            WHERE (name ILIKE %s OR phone ILIKE %s OR bio ILIKE %s)
-            AND id != COALESCE(%s::INTEGER, 0)
-            LIMIT 50
-            """,
-            (search_pattern, search_pattern, search_pattern, user_id)
-        )
+        try:
+            limit = int(params.get('limit') or DEFAULT_PAGE_SIZE)
+            cursor_rank, cursor_id = parse_cursor(params.get('cursor'))
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': dumps({'error': 'Invalid limit or cursor'}),
+                'isBase64Encoded': False
+            }
         
-        users = []
-        for row in cur.fetchall():
-            user_id_found, phone, name, avatar, bio, is_online = row
-            users.append({
-                'id': user_id_found,
-                'phone': phone,
-                'name': name,
-                'avatar': avatar,
-                'bio': bio,
-                'isOnline': is_online
-            })
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
         
-        cur.close()
-        conn.close()
+        with connection() as conn:
+            users, next_cursor = search_users(conn, query, user_id, limit, cursor_rank, cursor_id)
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'users': users}),
+            'body': dumps({'users': users, 'nextCursor': next_cursor}),
             'isBase64Encoded': False
         }
     
     return {
         'statusCode': 405,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'}),
+        'body': dumps({'error': 'Method not allowed'}),
         'isBase64Encoded': False
     }
+
+def normalize_phone(value: str) -> str:
+    '''Оставить только цифры; российский номер с 8 в начале привести к 7'''
+    digits = re.sub(r'\D', '', value)
+    if re.fullmatch(r'8\d{10}', digits):
+        digits = '7' + digits[1:]
+    return digits
+
+def parse_cursor(cursor: Optional[str]):
+    '''Курсор страницы поиска имеет вид "<rank>:<id>" последнего найденного'''
+    if not cursor:
+        # Ранг выше любого реального: первая страница начинается с лучших совпадений
+        return 5.0, 0
+    rank, last_id = cursor.split(':', 1)
+    return float(rank), int(last_id)
+
+def escape_like(value: str) -> str:
+    '''Экранировать спецсимволы LIKE'''
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_users(conn, query: str, user_id: Optional[str], limit: int,
+                 cursor_rank: float, cursor_id: int):
+    '''
+    Ранжированный поиск: точное совпадение (3) > префикс (2) > вхождение (1)
+    > нечёткое совпадение имени (0); внутри уровня — по similarity() имени
+    Имя ищется триграммным оператором %, поэтому опечатки тоже находятся;
+    вхождение в имя, био и цифры телефона — по триграммным GIN-индексам,
+    префикс телефона — по индексу нормализованных цифр. Страницы идут по
+    (rank DESC, id ASC) без OFFSET.
+    '''
+    needle = query.lower()
+    pattern = escape_like(needle)
+    digits = normalize_phone(query)
+    if len(digits) < MIN_PHONE_QUERY_DIGITS:
+        digits = None
+    
+    conditions = []
+    if len(needle) >= MIN_TRIGRAM_QUERY_LENGTH:
+        conditions.append("lower(name) %% %(needle)s")
+        conditions.append("lower(name) LIKE %(contains)s")
+        conditions.append("lower(bio) LIKE %(contains)s")
+    else:
+        conditions.append("lower(name) LIKE %(prefix)s")
+    if digits:
+        conditions.append("phone_digits LIKE %(digits_contains)s")
+    
+    cur = conn.cursor()
+    cur.execute(
+        f"""
+        SELECT id, phone, name, avatar, bio, is_online, rank
+        FROM (
+            SELECT id, phone, name, avatar, bio,
+                last_seen > LOCALTIMESTAMP - make_interval(secs => %(presence_ttl)s) AS is_online,
+                (CASE
+                    WHEN lower(name) = %(needle)s OR phone_digits = %(digits)s THEN 3
+                    WHEN lower(name) LIKE %(prefix)s OR phone_digits LIKE %(digits_prefix)s THEN 2
+                    WHEN lower(name) LIKE %(contains)s OR lower(bio) LIKE %(contains)s
+                        OR phone_digits LIKE %(digits_contains)s THEN 1
+                    ELSE 0
+                END + similarity(lower(name), %(needle)s))::real AS rank
+            FROM users
+            WHERE ({' OR '.join(conditions)})
+            AND id != COALESCE(%(user_id)s::INTEGER, 0)
+        ) ranked
+        WHERE rank < %(cursor_rank)s::real OR (rank = %(cursor_rank)s::real AND id > %(cursor_id)s)
+        ORDER BY rank DESC, id ASC
+        LIMIT %(limit)s
+        """,
+        {
+            'needle': needle,
+            'prefix': pattern + '%',
+            'contains': '%' + pattern + '%',
+            'digits': digits,
+            'digits_prefix': digits + '%' if digits else None,
+            'digits_contains': '%' + digits + '%' if digits else None,
+            'user_id': user_id,
+            'cursor_rank': cursor_rank,
+            'cursor_id': cursor_id,
+            'limit': limit + 1,
+            'presence_ttl': PRESENCE_TTL_SECONDS
+        }
+    )
+    
+    rows = cur.fetchall()
+    cur.close()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    users = []
+    for row in rows:
+        user_id_found, phone, name, avatar, bio, is_online, rank = row
+        users.append({
+            'id': user_id_found,
+            'phone': phone,
+            'name': name,
+            'avatar': avatar,
+            'bio': bio,
+            'isOnline': is_online
+        })
+    
+    next_cursor = f'{rows[-1][6]!r}:{rows[-1][0]}' if has_more else None
+    return users, next_cursor
+
+def heartbeat(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Пинг присутствия от открытого клиента
+    Без обращения к БД, если этот экземпляр недавно уже записал last_seen
+    '''
+    user_id = authenticate(event)
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Session token or X-User-Id header required'}),
+            'isBase64Encoded': False
+        }
+    
+    if write_due(user_id):
+        with connection() as conn:
+            record_heartbeat(conn, user_id)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'success': True, 'ttl': PRESENCE_TTL_SECONDS}),
+        'isBase64Encoded': False
+    }
+
+def get_presence(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Статусы присутствия для списка пользователей одним запросом
+    Отдаются только сам пользователь, его контакты и собеседники по общим
+    чатам; остальные id молча пропускаются, как несуществующие
+    '''
+    user_id = authenticate(event)
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': 'Session token or X-User-Id header required'}),
+            'isBase64Encoded': False
+        }
+    
+    params = event.get('queryStringParameters', {}) or {}
+    try:
+        user_ids = sorted({int(value) for value in params['ids'].split(',') if value.strip()})
+    except ValueError:
+        user_ids = []
+    
+    if not user_ids or len(user_ids) > MAX_PRESENCE_IDS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dumps({'error': f'ids must be 1-{MAX_PRESENCE_IDS} comma-separated user ids'}),
+            'isBase64Encoded': False
+        }
+    
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT u.id, u.last_seen,
+                   u.last_seen > LOCALTIMESTAMP - make_interval(secs => %(presence_ttl)s) AS is_online
+            FROM users u
+            WHERE u.id = ANY(%(ids)s)
+            AND (
+                u.id = %(user_id)s
+                OR EXISTS (
+                    SELECT 1 FROM contacts c
+                    WHERE c.user_id = %(user_id)s AND c.contact_id = u.id
+                )
+                OR EXISTS (
+                    SELECT 1
+                    FROM chat_members theirs
+                    JOIN chat_members mine ON mine.chat_id = theirs.chat_id
+                    WHERE theirs.user_id = u.id AND mine.user_id = %(user_id)s
+                )
+            )
+            """,
+            {'presence_ttl': PRESENCE_TTL_SECONDS, 'ids': user_ids, 'user_id': user_id}
+        )
+        rows = cur.fetchall()
+        cur.close()
+    
+    presence = []
+    for found_id, last_seen, is_online in rows:
+        presence.append({
+            'id': found_id,
+            'isOnline': bool(is_online),
+            'lastSeen': last_seen.isoformat() if last_seen else None
+        })
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dumps({'presence': presence, 'ttl': PRESENCE_TTL_SECONDS}),
+        'isBase64Encoded': False
+    }
\ No newline at end of file
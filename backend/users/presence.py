@@ -0,0 +1,58 @@
+'''
+Присутствие пользователей: heartbeat с прореженной записью last_seen
+Пинг пишется в БД в том же запросе, но условным UPDATE: last_seen
+обновляется, только если он старше PRESENCE_WRITE_INTERVAL_SECONDS, так что
+частые пинги одного клиента дают одну запись за интервал. Экземпляр помнит
+свои недавние записи и такие пинги вовсе не доводит до БД; в памяти нет
+ничего не записанного, поэтому остывший экземпляр ничего не теряет.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Пользователь онлайн, пока его last_seen моложе этого интервала
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', '90'))
+# Чаще этого last_seen не переписывается; должно быть заметно меньше TTL
+PRESENCE_WRITE_INTERVAL_SECONDS = float(os.environ.get('PRESENCE_WRITE_INTERVAL_SECONDS', '15'))
+PRESENCE_RECENT_SIZE = int(os.environ.get('PRESENCE_RECENT_SIZE', '10000'))
+
+# Когда этот экземпляр последний раз записал или застал свежим last_seen
+_recent: 'OrderedDict[int, float]' = OrderedDict()
+_recent_lock = threading.Lock()
+
+def write_due(user_id: int) -> bool:
+    '''Прошёл ли интервал с последней записи этого пользователя на экземпляре'''
+    with _recent_lock:
+        written = _recent.get(user_id)
+    return written is None or time.monotonic() - written >= PRESENCE_WRITE_INTERVAL_SECONDS
+
+def _remember(user_id: int) -> None:
+    with _recent_lock:
+        _recent[user_id] = time.monotonic()
+        _recent.move_to_end(user_id)
+        while len(_recent) > PRESENCE_RECENT_SIZE:
+            _recent.popitem(last=False)
+
+def record_heartbeat(conn, user_id: int) -> bool:
+    '''
+    Записать пинг условным UPDATE, если last_seen старше интервала
+    Пинги с других экземпляров могли уже обновить last_seen — тогда
+    UPDATE не трогает строку и не порождает лишнюю версию.
+    Returns: True, если last_seen обновлён
+    '''
+    cur = conn.cursor()
+    cur.execute(
+        """
+        UPDATE users
+        SET last_seen = LOCALTIMESTAMP
+        WHERE id = %s
+        AND (last_seen IS NULL OR last_seen < LOCALTIMESTAMP - make_interval(secs => %s))
+        """,
+        (user_id, PRESENCE_WRITE_INTERVAL_SECONDS)
+    )
+    updated = cur.rowcount > 0
+    cur.close()
+    conn.commit()
+    _remember(user_id)
+    return updated
@@ -0,0 +1,167 @@
+'''
+Проверки поведения функций backend против локальной БД
+Здесь то, что не выразить HTTP-тестами tests.json: соединения пула между
+вызовами, сброс кэшей экземпляра по изменениям из другого процесса.
+Проверки создают свои строки и не трогают чужие.
+Использование:
+    DATABASE_URL=postgresql://... python bench/checks.py
+    python bench/checks.py --only pool_keeps_connections_warm
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+CHECKS: Dict[str, Callable[[], None]] = {}
+# Столько ждём, пока NOTIFY из другого процесса дойдёт до слушающего соединения
+NOTIFY_DELAY_SECONDS = 0.2
+
+def check(func: Callable[[], None]) -> Callable[[], None]:
+    CHECKS[func.__name__] = func
+    return func
+
+@check
+def pool_keeps_connections_warm():
+    '''Два вызова подряд получают одно и то же серверное соединение'''
+    import db
+    
+    pids = []
+    for _ in range(2):
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_backend_pid()')
+            pids.append(cur.fetchone()[0])
+            cur.close()
+            conn.commit()
+    assert pids[0] == pids[1], f'pool reconnected between checkouts: backend pids {pids}'
+    assert len(db.get_pool()._pool) == 1, 'released connection was not kept in the pool'
+
+@contextmanager
+def external_chat(names: List[str]) -> Iterator[Tuple[Any, List[int], int]]:
+    '''
+    Пользователи и групповой чат с ними, созданные отдельным соединением,
+    как это сделал бы другой экземпляр функции или администратор БД
+    Returns: (курсор в autocommit, id пользователей, id чата); всё
+    созданное удаляется на выходе
+    '''
+    import psycopg2
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    user_ids = []
+    chat_id = None
+    try:
+        for name in names:
+            cur.execute(
+                "INSERT INTO users (phone, name) VALUES (%s, %s) RETURNING id",
+                (f'+7000{random.randrange(10 ** 7):07d}', name)
+            )
+            user_ids.append(cur.fetchone()[0])
+        cur.execute("INSERT INTO chats (is_group, name) VALUES (true, 'checks') RETURNING id")
+        chat_id = cur.fetchone()[0]
+        cur.execute(
+            "INSERT INTO chat_members (chat_id, user_id) SELECT %s, unnest(%s::INTEGER[])",
+            (chat_id, user_ids)
+        )
+        yield cur, user_ids, chat_id
+    finally:
+        if chat_id is not None:
+            cur.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
+            cur.execute("DELETE FROM chat_members WHERE chat_id = %s", (chat_id,))
+            cur.execute("DELETE FROM chats WHERE id = %s", (chat_id,))
+        if user_ids:
+            cur.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+        conn.close()
+
+def get_history(user_id: int, chat_id: int) -> Tuple[int, Dict[str, Any]]:
+    '''История чата через handler функции messages, как её запросил бы клиент'''
+    import index
+    from load import auth_headers
+    
+    response = index.handler({
+        'httpMethod': 'GET',
+        'headers': auth_headers(user_id),
+        'queryStringParameters': {'chatId': str(chat_id)},
+        'body': '',
+        'isBase64Encoded': False
+    }, None)
+    return response['statusCode'], json.loads(response['body'] or '{}')
+
+@check
+def membership_sees_external_removal():
+    '''
+    Участник, удалённый из чата другим процессом, сразу теряет доступ
+    Параллельный вызов держит тёплое соединение, поэтому проверка идёт
+    через другое соединение пула, чем то, что было выдано до удаления
+    '''
+    import db
+    
+    with external_chat(['checks owner', 'checks member']) as (cur, (owner_id, member_id), chat_id):
+        status, _ = get_history(member_id, chat_id)
+        assert status == 200, f'member could not read the chat: {status}'
+        
+        with db.connection():
+            cur.execute("DELETE FROM chat_members WHERE chat_id = %s AND user_id = %s", (chat_id, member_id))
+            time.sleep(NOTIFY_DELAY_SECONDS)
+            status, _ = get_history(member_id, chat_id)
+        assert status == 403, f'removed member still reads the chat from cache: {status}'
+
+@check
+def profiles_see_external_rename():
+    '''История показывает новое имя отправителя сразу после переименования другим процессом'''
+    import db
+    
+    with external_chat(['Alice', 'checks reader']) as (cur, (sender_id, reader_id), chat_id):
+        cur.execute(
+            "INSERT INTO messages (chat_id, sender_id, text) VALUES (%s, %s, 'hello')",
+            (chat_id, sender_id)
+        )
+        status, body = get_history(reader_id, chat_id)
+        assert status == 200, f'reader could not read the chat: {status}'
+        assert [m['senderName'] for m in body['messages']] == ['Alice'], body['messages']
+        
+        with db.connection():
+            cur.execute("UPDATE users SET name = 'Alicia' WHERE id = %s", (sender_id,))
+            time.sleep(NOTIFY_DELAY_SECONDS)
+            status, body = get_history(reader_id, chat_id)
+        assert status == 200, f'reader could not read the chat: {status}'
+        names = [m['senderName'] for m in body['messages']]
+        assert names == ['Alicia'], f'history still shows the old sender name from cache: {names}'
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'), help='строка подключения (по умолчанию DATABASE_URL)')
+    parser.add_argument('--only', help='проверки через запятую')
+    args = parser.parse_args()
+    
+    if not args.dsn:
+        parser.error('--dsn or DATABASE_URL is required')
+    os.environ['DATABASE_URL'] = args.dsn
+    os.environ.setdefault('REQUEST_LOG', '0')
+    # Общие модули одинаковы во всех функциях; проверки идут через messages
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'messages'))
+    
+    names = [name.strip() for name in args.only.split(',')] if args.only else list(CHECKS)
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        parser.error(f'unknown checks: {", ".join(unknown)}')
+    
+    failed = 0
+    for name in names:
+        try:
+            CHECKS[name]()
+            print(f'ok    {name}')
+        except Exception:
+            failed += 1
+            print(f'FAIL  {name}')
+            traceback.print_exc()
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+'''
+Нагрузочный прогон функций backend без деплоя
+Каждый воркер — отдельный процесс, то есть отдельный «тёплый экземпляр» со
+своим пулом соединений; handler(event, context) вызывается напрямую против
+локальной БД из DATABASE_URL. В конце печатается пропускная способность и
+p50/p95/p99 по каждому сценарию.
+Использование:
+    DATABASE_URL=postgresql://... python bench/load.py --workers 8 --duration 30
+    python bench/load.py --scenarios open_chat,send --json results.json
+'''
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Tuple
+
+SERVER_TIMING_RE = re.compile(r'(\w+);dur=([\d.]+)(?:;desc="(\d+) queries)?')
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+SEARCH_QUERIES = ['ан', 'ми', 'кора', 'лена', 'Ваня', 'тоси', '+7900', '900000', 'рома', 'ника']
+SEND_TEXTS = ['привет', 'как дела?', 'созвон в 15:00', 'отправил документ', 'ok']
+
+# Веса сценариев в смешанной нагрузке примерно повторяют живой трафик:
+# чаты открывают и листают намного чаще, чем пишут и ищут
+SCENARIO_WEIGHTS = {
+    'auth': 1,
+    'search': 2,
+    'open_chat': 10,
+    'chat_list': 4,
+    'send': 4
+}
+
+def load_handler(function: str) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    '''Импортировать backend/<function>/index.py так, как его видит рантайм функции'''
+    function_dir = os.path.normpath(os.path.join(BACKEND_DIR, function))
+    if function_dir not in sys.path:
+        sys.path.insert(0, function_dir)
+    spec = importlib.util.spec_from_file_location(f'bench_{function}_index', os.path.join(function_dir, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.handler
+
+def load_fixtures(dsn: str, sample_size: int, seed: int) -> Dict[str, Any]:
+    '''Выборка существующих пользователей и чатов, по которым ходят сценарии'''
+    import psycopg2
+    
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, phone, name FROM users WHERE id >= (SELECT MAX(id) * random() FROM users) ORDER BY id LIMIT %s",
+        (sample_size,)
+    )
+    users = cur.fetchall()
+    # Пары из личных чатов: открытие чата по contactId — основной путь клиента
+    cur.execute(
+        """
+        SELECT user_lo, user_hi, chat_id FROM direct_chats
+        WHERE chat_id >= (SELECT MAX(chat_id) * random() FROM direct_chats)
+        ORDER BY chat_id LIMIT %s
+        """,
+        (sample_size,)
+    )
+    pairs = cur.fetchall()
+    cur.close()
+    conn.close()
+    
+    if not users or not pairs:
+        raise SystemExit('database has no users or direct chats, run bench/seed.py first')
+    return {'users': users, 'pairs': pairs, 'seed': seed}
+
+_session = None
+
+def auth_headers(user_id: Any) -> Dict[str, str]:
+    '''С SESSION_SECRET голый X-User-Id не принимается: подписать токен, как auth'''
+    global _session
+    if not os.environ.get('SESSION_SECRET'):
+        return {'X-User-Id': str(user_id)}
+    if _session is None:
+        spec = importlib.util.spec_from_file_location('bench_session', os.path.join(BACKEND_DIR, 'auth', 'session.py'))
+        _session = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_session)
+    token, _ = _session.issue_token(user_id)
+    return {'Authorization': f'Bearer {token}'}
+
+def make_event(method: str, user_id: Any = None, params: Dict[str, Any] = None,
+               body: Any = None) -> Dict[str, Any]:
+    # Как браузер: ответы сжимаются, и замер включает время сжатия
+    headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip, br'}
+    if user_id is not None:
+        headers.update(auth_headers(user_id))
+    return {
+        'httpMethod': method,
+        'headers': headers,
+        'queryStringParameters': {key: str(value) for key, value in (params or {}).items()},
+        'body': json.dumps(body) if body is not None else '',
+        'requestContext': {'identity': {'sourceIp': '127.0.0.1'}},
+        'isBase64Encoded': False
+    }
+
+def build_scenarios(fixtures: Dict[str, Any], rng: random.Random) -> Dict[str, Callable[[], Tuple[str, Dict[str, Any]]]]:
+    '''Сценарий возвращает имя функции и событие для её handler'''
+    users = fixtures['users']
+    pairs = fixtures['pairs']
+    
+    def auth():
+        _, phone, name = rng.choice(users)
+        return 'auth', make_event('POST', body={'phone': phone, 'name': name})
+    
+    def search():
+        user_id = rng.choice(users)[0]
+        return 'users', make_event('GET', user_id, {'query': rng.choice(SEARCH_QUERIES), 'limit': 20})
+    
+    def open_chat():
+        user_lo, user_hi, _ = rng.choice(pairs)
+        return 'messages', make_event('GET', user_lo, {'contactId': user_hi, 'limit': 50})
+    
+    def chat_list():
+        user_lo, _, _ = rng.choice(pairs)
+        return 'messages', make_event('GET', user_lo, {'action': 'chats'})
+    
+    def send():
+        user_lo, user_hi, chat_id = rng.choice(pairs)
+        sender = user_lo if rng.random() < 0.5 else user_hi
+        return 'messages', make_event('POST', sender, body={'chatId': chat_id, 'text': rng.choice(SEND_TEXTS)})
+    
+    return {
+        'auth': auth,
+        'search': search,
+        'open_chat': open_chat,
+        'chat_list': chat_list,
+        'send': send
+    }
+
+def parse_server_timing(value: str) -> Tuple[float, int]:
+    '''Время в БД (connect + db + fetch, мс) и число запросов из Server-Timing'''
+    db_ms, queries = 0.0, 0
+    for name, duration, count in SERVER_TIMING_RE.findall(value or ''):
+        if name in ('connect', 'db', 'fetch'):
+            db_ms += float(duration)
+        if count:
+            queries = int(count)
+    return db_ms, queries
+
+def run_worker(worker_id: int, args: SimpleNamespace, fixtures: Dict[str, Any], results) -> None:
+    '''Цикл одного процесса: случайный сценарий по весам до истечения времени'''
+    rng = random.Random(fixtures['seed'] + worker_id)
+    handlers = {function: load_handler(function) for function in ('auth', 'users', 'messages')}
+    scenarios = build_scenarios(fixtures, rng)
+    names = list(args.scenarios)
+    weights = [SCENARIO_WEIGHTS[name] for name in names]
+    context = SimpleNamespace(request_id=f'bench-{worker_id}', function_name='bench')
+    
+    samples: Dict[str, List[float]] = {name: [] for name in names}
+    errors: Dict[str, int] = {name: 0 for name in names}
+    db_totals: Dict[str, List[float]] = {name: [0.0, 0] for name in names}
+    
+    # Прогрев: первые вызовы открывают соединения и не должны попадать в замеры
+    warmup_until = time.monotonic() + args.warmup
+    deadline = warmup_until + args.duration
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        name = rng.choices(names, weights=weights)[0]
+        function, event = scenarios[name]()
+        started = time.perf_counter()
+        try:
+            response = handlers[function](event, context)
+        except Exception:
+            response = {'statusCode': 500}
+        elapsed = time.perf_counter() - started
+        if now < warmup_until:
+            continue
+        status = response.get('statusCode', 500)
+        samples[name].append(elapsed)
+        db_ms, queries = parse_server_timing((response.get('headers') or {}).get('Server-Timing'))
+        db_totals[name][0] += db_ms
+        db_totals[name][1] += queries
+        if status >= 400:
+            errors[name] += 1
+    
+    results.put((samples, errors, db_totals))
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(samples: Dict[str, List[float]], errors: Dict[str, int], db_totals: Dict[str, List[float]],
+              duration: float) -> List[Dict[str, Any]]:
+    report = []
+    for name in sorted(samples):
+        values = sorted(samples[name])
+        count = max(len(values), 1)
+        report.append({
+            'scenario': name,
+            'requests': len(values),
+            'errors': errors.get(name, 0),
+            'rps': round(len(values) / duration, 1),
+            'p50Ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95Ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99Ms': round(percentile(values, 0.99) * 1000, 2),
+            'maxMs': round((values[-1] if values else 0.0) * 1000, 2),
+            'dbMs': round(db_totals[name][0] / count, 2),
+            'queries': round(db_totals[name][1] / count, 1)
+        })
+    return report
+
+def print_report(report: List[Dict[str, Any]], args: SimpleNamespace) -> None:
+    print(f'workers={args.workers} duration={args.duration}s pool={os.environ.get("DB_POOL_MAX_SIZE")}')
+    print(f'{"scenario":<12}{"requests":>10}{"errors":>8}{"rps":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}{"db ms":>10}{"queries":>9}')
+    for row in report:
+        print(f'{row["scenario"]:<12}{row["requests"]:>10}{row["errors"]:>8}{row["rps"]:>10}'
+              f'{row["p50Ms"]:>10}{row["p95Ms"]:>10}{row["p99Ms"]:>10}{row["maxMs"]:>10}{row["dbMs"]:>10}{row["queries"]:>9}')
+    total = sum(row['requests'] for row in report)
+    print(f'{"total":<12}{total:>10}{sum(row["errors"] for row in report):>8}{round(total / args.duration, 1):>10}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'), help='строка подключения (по умолчанию DATABASE_URL)')
+    parser.add_argument('--workers', type=int, default=4, help='число процессов-экземпляров')
+    parser.add_argument('--duration', type=float, default=30, help='длительность замера, секунд')
+    parser.add_argument('--warmup', type=float, default=3, help='прогрев перед замером, секунд')
+    parser.add_argument('--scenarios', default=','.join(SCENARIO_WEIGHTS), help='сценарии через запятую')
+    parser.add_argument('--sample-size', type=int, default=5000, help='сколько пользователей и чатов брать в выборку')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='дополнительно записать отчёт в JSON-файл')
+    args = parser.parse_args()
+    
+    if not args.dsn:
+        parser.error('--dsn or DATABASE_URL is required')
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIO_WEIGHTS]
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(unknown)}')
+    
+    # Процессы наследуют окружение: handler читает DATABASE_URL сам.
+    # Одному экземпляру функции хватает одного соединения на вызов
+    os.environ['DATABASE_URL'] = args.dsn
+    os.environ.setdefault('DB_POOL_MAX_SIZE', '1')
+    # Построчный лог каждого вызова только мешает замеру; фазы берутся из Server-Timing
+    os.environ.setdefault('REQUEST_LOG', '0')
+    
+    fixtures = load_fixtures(args.dsn, args.sample_size, args.seed)
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(worker_id, args, fixtures, results))
+        for worker_id in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    samples: Dict[str, List[float]] = {name: [] for name in args.scenarios}
+    errors: Dict[str, int] = {name: 0 for name in args.scenarios}
+    db_totals: Dict[str, List[float]] = {name: [0.0, 0] for name in args.scenarios}
+    for _ in workers:
+        worker_samples, worker_errors, worker_db_totals = results.get()
+        for name, values in worker_samples.items():
+            samples[name].extend(values)
+            errors[name] += worker_errors[name]
+            db_totals[name][0] += worker_db_totals[name][0]
+            db_totals[name][1] += worker_db_totals[name][1]
+    for worker in workers:
+        worker.join()
+    
+    report = summarize(samples, errors, db_totals, args.duration)
+    print_report(report, args)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump({'workers': args.workers, 'duration': args.duration, 'scenarios': report}, output, indent=2)
+
+if __name__ == '__main__':
+    main()
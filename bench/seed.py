@@ -0,0 +1,224 @@
+'''
+Генератор синтетических данных для нагрузочных тестов функций backend
+Заливает пользователей, личные и групповые чаты и сообщения через COPY,
+поэтому миллионы строк загружаются за минуты, а не часы.
+Использование:
+    DATABASE_URL=postgresql://... python bench/seed.py --users 1000000 --chats 20000 --messages 5000000
+'''
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import psycopg2
+
+SYLLABLES = ['ан', 'ва', 'ми', 'ра', 'ко', 'ле', 'на', 'то', 'си', 'да', 'ли', 'ма', 'ни', 'ка', 'ро', 'са']
+WORDS = [
+    'привет', 'как', 'дела', 'завтра', 'встреча', 'проект', 'готово', 'отправил', 'файл',
+    'созвон', 'вечером', 'спасибо', 'отлично', 'посмотри', 'документ', 'ok', 'deploy',
+    'release', 'review', 'bug', 'fix', 'тест', 'сборка', 'кофе', 'обед', 'опоздаю'
+]
+
+class IteratorFile:
+    '''Файлоподобный объект для copy_expert поверх генератора строк TSV'''
+    
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+        self._buffer = ''
+    
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            chunk, self._buffer = self._buffer, ''
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+    
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+def tsv(*values) -> str:
+    '''Строка формата COPY text; None превращается в \\N'''
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('\\N')
+        elif isinstance(value, bool):
+            cells.append('t' if value else 'f')
+        else:
+            cells.append(str(value).replace('\\', '\\\\').replace('\t', ' ').replace('\n', ' '))
+    return '\t'.join(cells) + '\n'
+
+def next_id(cur, table: str) -> int:
+    cur.execute(f'SELECT COALESCE(MAX(id), 0) + 1 FROM {table}')
+    return cur.fetchone()[0]
+
+def copy_rows(cur, table: str, columns: str, lines: Iterator[str]) -> None:
+    cur.copy_expert(f'COPY {table} ({columns}) FROM STDIN', IteratorFile(lines), size=1 << 20)
+
+def timed(label: str, action: Callable[[], None]) -> None:
+    started = time.perf_counter()
+    action()
+    print(f'{label}: {time.perf_counter() - started:.1f}s', flush=True)
+
+def random_name(rng: random.Random) -> str:
+    first = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+    last = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+    return f'{first} {last}'
+
+def random_text(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+
+def seed(conn, args) -> None:
+    rng = random.Random(args.seed)
+    cur = conn.cursor()
+    now = datetime.now()
+    
+    first_user = next_id(cur, 'users')
+    user_ids = range(first_user, first_user + args.users)
+    
+    def users() -> Iterator[str]:
+        for user_id in user_ids:
+            last_seen = now - timedelta(seconds=rng.randint(0, 30 * 86400))
+            yield tsv(user_id, f'+7{9000000000 + user_id}', random_name(rng),
+                      random_text(rng) if rng.random() < 0.3 else None, last_seen, last_seen)
+    
+    timed(f'users x{args.users}', lambda: copy_rows(
+        cur, 'users', 'id, phone, name, bio, last_seen, created_at', users()))
+    
+    # Личные чаты между случайными парами, групповые — с 5..group_size участниками
+    first_chat = next_id(cur, 'chats')
+    group_count = int(args.chats * args.group_ratio)
+    direct_pairs = set()
+    while len(direct_pairs) < args.chats - group_count:
+        lo, hi = sorted(rng.sample(user_ids, 2))
+        direct_pairs.add((lo, hi))
+    
+    chat_members: Dict[int, List[int]] = {}
+    direct_rows: List[Tuple[int, int, int]] = []
+    chat_id = first_chat
+    for lo, hi in sorted(direct_pairs):
+        chat_members[chat_id] = [lo, hi]
+        direct_rows.append((lo, hi, chat_id))
+        chat_id += 1
+    group_ids = []
+    for _ in range(group_count):
+        chat_members[chat_id] = rng.sample(user_ids, rng.randint(5, args.group_size))
+        group_ids.append(chat_id)
+        chat_id += 1
+    group_set = set(group_ids)
+    
+    started_at = now - timedelta(days=args.days)
+    
+    def chats() -> Iterator[str]:
+        for cid in chat_members:
+            is_group = cid in group_set
+            yield tsv(cid, is_group, f'Группа {cid}' if is_group else None, started_at, started_at)
+    
+    def members() -> Iterator[str]:
+        for cid, member_ids in chat_members.items():
+            for member_id in member_ids:
+                yield tsv(cid, member_id, started_at)
+    
+    def directs() -> Iterator[str]:
+        for lo, hi, cid in direct_rows:
+            yield tsv(lo, hi, cid, started_at)
+    
+    timed(f'chats x{len(chat_members)}', lambda: copy_rows(
+        cur, 'chats', 'id, is_group, name, created_at, last_activity_at', chats()))
+    timed('chat_members', lambda: copy_rows(cur, 'chat_members', 'chat_id, user_id, joined_at', members()))
+    timed('direct_chats', lambda: copy_rows(cur, 'direct_chats', 'user_lo, user_hi, chat_id, created_at', directs()))
+    
+    # Активность чатов распределена по Парето: немногие чаты получают
+    # большую часть сообщений, как в живом мессенджере
+    chat_ids = list(chat_members.keys())
+    weights = [rng.paretovariate(1.2) for _ in chat_ids]
+    first_message = next_id(cur, 'messages')
+    step = timedelta(days=args.days) / max(args.messages, 1)
+    versions: Dict[int, int] = {}
+    
+    def messages() -> Iterator[str]:
+        batch = 10000
+        produced = 0
+        message_id = first_message
+        while produced < args.messages:
+            for cid in rng.choices(chat_ids, weights=weights, k=min(batch, args.messages - produced)):
+                versions[cid] = versions.get(cid, 0) + 1
+                created_at = started_at + step * produced
+                yield tsv(message_id, cid, rng.choice(chat_members[cid]), random_text(rng),
+                          versions[cid], created_at)
+                message_id += 1
+                produced += 1
+    
+    # Месячные партиции на весь диапазон истории и на месяцы вперёд
+    cur.execute("SELECT ensure_messages_partitions(%s, LOCALTIMESTAMP + INTERVAL '3 months')", (started_at,))
+    
+    # Триггер версий на каждую строку сделал бы загрузку на порядки медленнее:
+    # версии считаются здесь, а счётчики чатов выставляются одним UPDATE
+    cur.execute('ALTER TABLE messages DISABLE TRIGGER trg_messages_bump_chat_version')
+    try:
+        timed(f'messages x{args.messages}', lambda: copy_rows(
+            cur, 'messages', 'id, chat_id, sender_id, text, version, created_at', messages()))
+    finally:
+        cur.execute('ALTER TABLE messages ENABLE TRIGGER trg_messages_bump_chat_version')
+    
+    def finish() -> None:
+        cur.execute("""
+            UPDATE chats c
+            SET change_seq = latest.max_version,
+                last_message_id = latest.last_id,
+                last_message_at = latest.last_at,
+                last_activity_at = latest.last_at
+            FROM (
+                SELECT chat_id, MAX(version) AS max_version, MAX(id) AS last_id, MAX(created_at) AS last_at
+                FROM messages
+                WHERE chat_id BETWEEN %s AND %s
+                GROUP BY chat_id
+            ) latest
+            WHERE c.id = latest.chat_id
+        """, (first_chat, chat_id - 1))
+        cur.execute("""
+            UPDATE chat_members cm
+            SET last_read_message_id = c.last_message_id
+            FROM chats c
+            WHERE c.id = cm.chat_id AND c.id BETWEEN %s AND %s AND c.last_message_id IS NOT NULL
+        """, (first_chat, chat_id - 1))
+        for table in ('users', 'chats', 'messages', 'chat_members'):
+            cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+    
+    timed('chat counters', finish)
+    conn.commit()
+    
+    conn.autocommit = True
+    timed('analyze', lambda: cur.execute('ANALYZE users, chats, chat_members, direct_chats, messages'))
+    cur.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'), help='строка подключения (по умолчанию DATABASE_URL)')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--group-ratio', type=float, default=0.1, help='доля групповых чатов')
+    parser.add_argument('--group-size', type=int, default=200, help='максимум участников группы')
+    parser.add_argument('--days', type=int, default=365, help='глубина истории в днях')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    if not args.dsn:
+        parser.error('--dsn or DATABASE_URL is required')
+    
+    conn = psycopg2.connect(args.dsn)
+    try:
+        seed(conn, args)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
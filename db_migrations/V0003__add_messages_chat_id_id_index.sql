@@ -0,0 +1,5 @@
+-- Составной индекс для keyset-пагинации истории сообщений по (chat_id, id)
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+
+-- Одиночный индекс по chat_id покрывается префиксом составного
+DROP INDEX IF EXISTS idx_messages_chat_id;
@@ -0,0 +1,28 @@
+-- Канонический индекс личных чатов: пара пользователей хранится упорядоченно,
+-- поэтому поиск чата — одно обращение по первичному ключу, а уникальность
+-- пары не даёт конкурентным первым сообщениям создать два чата
+CREATE TABLE IF NOT EXISTS direct_chats (
+    user_lo INTEGER NOT NULL REFERENCES users(id),
+    user_hi INTEGER NOT NULL REFERENCES users(id),
+    chat_id INTEGER NOT NULL UNIQUE REFERENCES chats(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_lo, user_hi),
+    CHECK (user_lo <= user_hi)
+);
+
+-- Перенос существующих личных чатов; если у пары уже несколько чатов,
+-- каноническим становится самый ранний
+INSERT INTO direct_chats (user_lo, user_hi, chat_id, created_at)
+SELECT DISTINCT ON (pair.user_lo, pair.user_hi)
+    pair.user_lo, pair.user_hi, pair.chat_id, pair.created_at
+FROM (
+    SELECT c.id AS chat_id, c.created_at,
+           MIN(cm.user_id) AS user_lo, MAX(cm.user_id) AS user_hi
+    FROM chats c
+    JOIN chat_members cm ON cm.chat_id = c.id
+    WHERE c.is_group = false
+    GROUP BY c.id, c.created_at
+    HAVING COUNT(*) = 2
+) pair
+ORDER BY pair.user_lo, pair.user_hi, pair.chat_id
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,42 @@
+-- Монотонный счётчик изменений чата и версия каждого сообщения для
+-- инкрементальной синхронизации; удаление становится мягким (tombstone)
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+-- Существующие сообщения получают версии по порядку внутри чата
+UPDATE messages m
+SET version = numbered.rn
+FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS rn
+    FROM messages
+) numbered
+WHERE m.id = numbered.id;
+
+UPDATE chats c
+SET change_seq = latest.max_version
+FROM (
+    SELECT chat_id, MAX(version) AS max_version
+    FROM messages
+    GROUP BY chat_id
+) latest
+WHERE c.id = latest.chat_id;
+
+-- Любая вставка или изменение сообщения получает следующую версию чата.
+-- Блокировка строки чата упорядочивает писателей, поэтому версии
+-- фиксируются в том же порядке, в каком выдаются
+CREATE OR REPLACE FUNCTION messages_bump_chat_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE chats SET change_seq = change_seq + 1
+    WHERE id = NEW.chat_id
+    RETURNING change_seq INTO NEW.version;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_messages_bump_chat_version ON messages;
+CREATE TRIGGER trg_messages_bump_chat_version
+    BEFORE INSERT OR UPDATE ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_bump_chat_version();
+
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_version ON messages(chat_id, version);
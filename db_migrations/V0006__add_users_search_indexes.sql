@@ -0,0 +1,16 @@
+-- Индексы для поиска пользователей без последовательного сканирования
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Телефон в виде одних цифр; российский номер с 8 в начале приводится к 7
+ALTER TABLE users ADD COLUMN IF NOT EXISTS phone_digits VARCHAR(20)
+    GENERATED ALWAYS AS (regexp_replace(regexp_replace(phone, '\D', '', 'g'), '^8(\d{10})$', '7\1')) STORED;
+
+-- Точное совпадение и поиск по префиксу номера
+CREATE INDEX IF NOT EXISTS idx_users_phone_digits ON users (phone_digits varchar_pattern_ops);
+
+-- Вхождение подстроки в имя и био (LIKE '%q%' по lower())
+CREATE INDEX IF NOT EXISTS idx_users_name_trgm ON users USING gin (lower(name) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_bio_trgm ON users USING gin (lower(bio) gin_trgm_ops);
+
+-- Префикс имени для коротких запросов, на которых триграммы бесполезны
+CREATE INDEX IF NOT EXISTS idx_users_name_prefix ON users (lower(name) text_pattern_ops);
@@ -0,0 +1,6 @@
+-- Полнотекстовый поиск по сообщениям: вектор пересчитывается самой БД
+-- при каждой вставке и редактировании текста
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('russian', COALESCE(text, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search_vector ON messages USING gin (search_vector);
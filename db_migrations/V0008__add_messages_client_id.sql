@@ -0,0 +1,6 @@
+-- Ключ идемпотентности, сгенерированный клиентом: повторная отправка
+-- того же сообщения после таймаута не создаёт дубль
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS client_id VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_sender_client_id
+    ON messages(sender_id, client_id) WHERE client_id IS NOT NULL;
@@ -0,0 +1,60 @@
+-- Денормализованное последнее сообщение чата для списка чатов и отметка
+-- прочтения участника для подсчёта непрочитанных
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_activity_at TIMESTAMP;
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER NOT NULL DEFAULT 0;
+
+UPDATE chats c
+SET last_message_id = latest.id, last_activity_at = latest.created_at
+FROM (
+    SELECT DISTINCT ON (chat_id) chat_id, id, created_at
+    FROM messages
+    WHERE deleted_at IS NULL
+    ORDER BY chat_id, id DESC
+) latest
+WHERE c.id = latest.chat_id;
+
+UPDATE chats SET last_activity_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE last_activity_at IS NULL;
+ALTER TABLE chats ALTER COLUMN last_activity_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE chats ALTER COLUMN last_activity_at SET NOT NULL;
+
+-- Существующая история считается прочитанной, чтобы не показать всем
+-- участникам всю переписку как новую
+UPDATE chat_members cm
+SET last_read_message_id = c.last_message_id
+FROM chats c
+WHERE c.id = cm.chat_id AND c.last_message_id IS NOT NULL;
+
+-- Триггер версий заодно поддерживает последнее сообщение чата: вставка
+-- сдвигает его вперёд, мягкое удаление последнего откатывает к предыдущему
+CREATE OR REPLACE FUNCTION messages_bump_chat_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE chats
+        SET change_seq = change_seq + 1,
+            last_message_id = NEW.id,
+            last_activity_at = NEW.created_at
+        WHERE id = NEW.chat_id
+        RETURNING change_seq INTO NEW.version;
+    ELSIF NEW.deleted_at IS NOT NULL AND OLD.deleted_at IS NULL THEN
+        UPDATE chats
+        SET change_seq = change_seq + 1,
+            last_message_id = CASE
+                WHEN last_message_id = NEW.id THEN (
+                    SELECT m.id FROM messages m
+                    WHERE m.chat_id = NEW.chat_id AND m.deleted_at IS NULL AND m.id < NEW.id
+                    ORDER BY m.id DESC
+                    LIMIT 1
+                )
+                ELSE last_message_id
+            END
+        WHERE id = NEW.chat_id
+        RETURNING change_seq INTO NEW.version;
+    ELSE
+        UPDATE chats SET change_seq = change_seq + 1
+        WHERE id = NEW.chat_id
+        RETURNING change_seq INTO NEW.version;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,2 @@
+-- Версия списка контактов пользователя для условных GET (ETag / 304)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS contacts_version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,24 @@
+-- SHA-256 от нормализованных цифр телефона: клиент может сверять записную
+-- книжку, не передавая сами номера
+ALTER TABLE users ADD COLUMN IF NOT EXISTS phone_hash CHAR(64);
+
+-- Генерируемая колонка не может ссылаться на phone_digits, а BEFORE-триггер
+-- срабатывает до её вычисления, поэтому нормализация повторяется здесь
+CREATE OR REPLACE FUNCTION users_set_phone_hash() RETURNS trigger AS $$
+BEGIN
+    NEW.phone_hash := encode(sha256(convert_to(
+        regexp_replace(regexp_replace(NEW.phone, '\D', '', 'g'), '^8(\d{10})$', '7\1'),
+        'UTF8'
+    )), 'hex');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_set_phone_hash ON users;
+CREATE TRIGGER trg_users_set_phone_hash
+    BEFORE INSERT OR UPDATE OF phone ON users
+    FOR EACH ROW EXECUTE FUNCTION users_set_phone_hash();
+
+UPDATE users SET phone_hash = encode(sha256(convert_to(phone_digits, 'UTF8')), 'hex');
+
+CREATE INDEX IF NOT EXISTS idx_users_phone_hash ON users(phone_hash);
@@ -0,0 +1,17 @@
+-- Уведомление об изменении имени или аватара: тёплые экземпляры функций
+-- держат профили в кэше и сбрасывают запись по этому каналу
+CREATE OR REPLACE FUNCTION users_notify_profile_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('profile_changed', NEW.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Вход через auth перезаписывает имя при каждом входе, поэтому уведомление
+-- отправляется только при фактическом изменении
+DROP TRIGGER IF EXISTS trg_users_notify_profile_changed ON users;
+CREATE TRIGGER trg_users_notify_profile_changed
+    AFTER UPDATE OF name, avatar ON users
+    FOR EACH ROW
+    WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.avatar IS DISTINCT FROM NEW.avatar)
+    EXECUTE FUNCTION users_notify_profile_changed();
@@ -0,0 +1,200 @@
+-- Помесячное секционирование messages по created_at: индексы и VACUUM
+-- растут с объёмом активных месяцев, а не всей истории, а старые месяцы
+-- отсоединяются в схему messages_archive
+
+-- Внешние ключи на секционированную таблицу требуют уникальности по id
+-- без ключа секционирования, поэтому ссылки на сообщения становятся
+-- логическими и проверяются приложением
+ALTER TABLE message_reactions DROP CONSTRAINT IF EXISTS message_reactions_message_id_fkey;
+
+DROP TRIGGER IF EXISTS trg_messages_bump_chat_version ON messages;
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+-- Последовательность переживает старую таблицу и переходит к новой
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    chat_id INTEGER NOT NULL REFERENCES chats(id),
+    sender_id INTEGER NOT NULL REFERENCES users(id),
+    text TEXT,
+    is_voice BOOLEAN DEFAULT false,
+    voice_duration VARCHAR(10),
+    is_file BOOLEAN DEFAULT false,
+    file_name VARCHAR(255),
+    file_size VARCHAR(20),
+    is_edited BOOLEAN DEFAULT false,
+    is_forwarded BOOLEAN DEFAULT false,
+    forwarded_from VARCHAR(100),
+    reply_to_id INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    version BIGINT NOT NULL DEFAULT 0,
+    deleted_at TIMESTAMP,
+    client_id VARCHAR(64),
+    search_vector tsvector GENERATED ALWAYS AS (to_tsvector('russian', COALESCE(text, ''))) STORED,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Партиции messages_pYYYY_MM на каждый месяц диапазона. Функция messages
+-- вызывает её на тёплом экземпляре, чтобы партиции существовали заранее;
+-- проверка to_regclass не берёт блокировок, пока создавать нечего
+CREATE OR REPLACE FUNCTION ensure_messages_partitions(range_start TIMESTAMP, range_end TIMESTAMP)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', range_start);
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= range_end LOOP
+        partition_name := 'messages_p' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass('public.' || partition_name) IS NULL THEN
+            -- Экземпляры, одновременно заметившие нехватку, создают партицию по очереди
+            PERFORM pg_advisory_xact_lock(hashtext('ensure_messages_partitions'));
+            IF to_regclass('public.' || partition_name) IS NULL THEN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_start + INTERVAL '1 month'
+                );
+                created := created + 1;
+            END IF;
+        END IF;
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_messages_partitions(
+    COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), LOCALTIMESTAMP),
+    LOCALTIMESTAMP + INTERVAL '3 months'
+);
+
+INSERT INTO messages (
+    id, chat_id, sender_id, text, is_voice, voice_duration, is_file, file_name, file_size,
+    is_edited, is_forwarded, forwarded_from, reply_to_id, created_at, version, deleted_at, client_id
+)
+SELECT id, chat_id, sender_id, text, is_voice, voice_duration, is_file, file_name, file_size,
+       is_edited, is_forwarded, forwarded_from, reply_to_id,
+       COALESCE(created_at, CURRENT_TIMESTAMP), version, deleted_at, client_id
+FROM messages_unpartitioned;
+
+-- Уникальность clientId отправителя не может держаться индексом
+-- секционированной таблицы без created_at, поэтому ключи идемпотентности
+-- живут в отдельной таблице со ссылкой на (id, created_at) сообщения
+CREATE TABLE IF NOT EXISTS message_client_ids (
+    sender_id INTEGER NOT NULL,
+    client_id VARCHAR(64) NOT NULL,
+    message_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (sender_id, client_id)
+);
+
+INSERT INTO message_client_ids (sender_id, client_id, message_id, created_at)
+SELECT sender_id, client_id, id, created_at FROM messages WHERE client_id IS NOT NULL
+ON CONFLICT (sender_id, client_id) DO NOTHING;
+
+DROP TABLE messages_unpartitioned;
+
+-- Индексы создаются на родителе и наследуются каждой партицией.
+-- (chat_id, created_at, id) ведёт историю в порядке ключа секционирования,
+-- (chat_id, id) остаётся для long-poll по курсору id
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_created_at_id ON messages(chat_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_version ON messages(chat_id, version);
+CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages(sender_id);
+CREATE INDEX IF NOT EXISTS idx_messages_search_vector ON messages USING gin (search_vector);
+
+-- Время последнего сообщения рядом с его id: список чатов находит его
+-- с отсечением партиций, а не пробой первичного ключа каждой партиции
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+
+UPDATE chats c
+SET last_message_at = m.created_at
+FROM messages m
+WHERE m.id = c.last_message_id;
+
+-- Откат последнего сообщения при удалении идёт по (created_at, id) —
+-- в порядке секционирования, начиная с партиции удаляемого сообщения
+CREATE OR REPLACE FUNCTION messages_bump_chat_version() RETURNS trigger AS $$
+DECLARE
+    previous_id INTEGER;
+    previous_at TIMESTAMP;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE chats
+        SET change_seq = change_seq + 1,
+            last_message_id = NEW.id,
+            last_message_at = NEW.created_at,
+            last_activity_at = NEW.created_at
+        WHERE id = NEW.chat_id
+        RETURNING change_seq INTO NEW.version;
+    ELSIF NEW.deleted_at IS NOT NULL AND OLD.deleted_at IS NULL THEN
+        SELECT m.id, m.created_at INTO previous_id, previous_at
+        FROM messages m
+        WHERE m.chat_id = NEW.chat_id AND m.deleted_at IS NULL
+        AND m.created_at <= NEW.created_at
+        AND (m.created_at, m.id) < (NEW.created_at, NEW.id)
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT 1;
+
+        UPDATE chats
+        SET change_seq = change_seq + 1,
+            last_message_id = CASE WHEN last_message_id = NEW.id THEN previous_id ELSE last_message_id END,
+            last_message_at = CASE WHEN last_message_id = NEW.id THEN previous_at ELSE last_message_at END
+        WHERE id = NEW.chat_id
+        RETURNING change_seq INTO NEW.version;
+    ELSE
+        UPDATE chats SET change_seq = change_seq + 1
+        WHERE id = NEW.chat_id
+        RETURNING change_seq INTO NEW.version;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_messages_bump_chat_version
+    BEFORE INSERT OR UPDATE ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_bump_chat_version();
+
+-- Холодный архив: партиции, целиком старше cutoff, отсоединяются и
+-- переносятся в messages_archive. История и поиск их больше не видят;
+-- restore_messages_partition возвращает месяц обратно
+CREATE SCHEMA IF NOT EXISTS messages_archive;
+
+CREATE OR REPLACE FUNCTION archive_messages_partitions(cutoff TIMESTAMP)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.messages'::regclass
+        AND c.relname ~ '^messages_p\d{4}_\d{2}$'
+        AND to_date(substr(c.relname, 11), 'YYYY_MM') + INTERVAL '1 month' <= cutoff
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE messages DETACH PARTITION %I', partition_name);
+        EXECUTE format('ALTER TABLE %I SET SCHEMA messages_archive', partition_name);
+        RETURN NEXT partition_name;
+    END LOOP;
+    -- Повтор отправки приходит через секунды, а не месяцы: ключи
+    -- идемпотентности архивных сообщений больше не нужны
+    DELETE FROM message_client_ids WHERE created_at < cutoff;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION restore_messages_partition(partition_name TEXT) RETURNS VOID AS $$
+DECLARE
+    month_start TIMESTAMP := to_date(substr(partition_name, 11), 'YYYY_MM');
+BEGIN
+    EXECUTE format('ALTER TABLE messages_archive.%I SET SCHEMA public', partition_name);
+    EXECUTE format(
+        'ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, month_start, month_start + INTERVAL '1 month'
+    );
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,32 @@
+-- Групповые чаты: создатель управляет составом, остальные участники могут
+-- только приглашать и выходить сами
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS created_by INTEGER REFERENCES users(id);
+
+-- Функции держат состав чатов в памяти и сбрасывают его по уведомлению;
+-- триггер на уровне оператора шлёт одно уведомление на чат, а не на строку,
+-- поэтому массовое добавление в большую группу не порождает тысячи NOTIFY
+CREATE OR REPLACE FUNCTION chat_members_notify_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('chat_members_changed', changed.chat_id::text)
+        FROM (SELECT DISTINCT chat_id FROM new_members) changed;
+    ELSE
+        PERFORM pg_notify('chat_members_changed', changed.chat_id::text)
+        FROM (SELECT DISTINCT chat_id FROM old_members) changed;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Таблицы переходов допускают только одно событие на триггер
+DROP TRIGGER IF EXISTS trg_chat_members_inserted ON chat_members;
+CREATE TRIGGER trg_chat_members_inserted
+    AFTER INSERT ON chat_members
+    REFERENCING NEW TABLE AS new_members
+    FOR EACH STATEMENT EXECUTE FUNCTION chat_members_notify_changed();
+
+DROP TRIGGER IF EXISTS trg_chat_members_deleted ON chat_members;
+CREATE TRIGGER trg_chat_members_deleted
+    AFTER DELETE ON chat_members
+    REFERENCING OLD TABLE AS old_members
+    FOR EACH STATEMENT EXECUTE FUNCTION chat_members_notify_changed();
@@ -0,0 +1,33 @@
+-- Вложения: содержимое хранится один раз на SHA-256 в blobs, а каждая
+-- загрузка или повторная отправка файла — отдельная строка attachments,
+-- ссылающаяся на общее содержимое
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Загрузка идёт частями chunk_size байт; received_chunks хранит номера
+-- принятых частей, поэтому оборванную загрузку можно продолжить
+CREATE TABLE IF NOT EXISTS attachments (
+    id SERIAL PRIMARY KEY,
+    owner_id INTEGER NOT NULL REFERENCES users(id),
+    file_name VARCHAR(255) NOT NULL,
+    content_type VARCHAR(100) NOT NULL DEFAULT 'application/octet-stream',
+    size BIGINT NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    received_chunks INTEGER[] NOT NULL DEFAULT '{}',
+    status VARCHAR(10) NOT NULL DEFAULT 'uploading',
+    sha256 CHAR(64) REFERENCES blobs(sha256),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP,
+    CHECK (status IN ('uploading', 'ready'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_attachments_owner_id ON attachments(owner_id);
+CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments(sha256);
+
+-- Ссылка логическая, как reply_to_id: внешние ключи из секционированной
+-- messages не нужны. Пересылка копирует attachment_id, а не файл
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS attachment_id INTEGER;
+CREATE INDEX IF NOT EXISTS idx_messages_attachment_id ON messages(attachment_id) WHERE attachment_id IS NOT NULL;
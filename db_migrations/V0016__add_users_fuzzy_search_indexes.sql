@@ -0,0 +1,4 @@
+-- Вхождение цифр в любое место номера (LIKE '%digits%'), как искал
+-- исходный phone ILIKE; префикс по-прежнему идёт по idx_users_phone_digits.
+-- Нечёткий поиск имени оператором % использует idx_users_name_trgm из V0006
+CREATE INDEX IF NOT EXISTS idx_users_phone_digits_trgm ON users USING gin (phone_digits gin_trgm_ops);
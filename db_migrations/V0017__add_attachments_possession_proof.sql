@@ -0,0 +1,5 @@
+-- Дедупликация по sha256 от клиента только с доказательством владения:
+-- start запоминает заявленное содержимое и ожидаемый ответ на вызов,
+-- complete сверяет его один раз и очищает оба поля
+ALTER TABLE attachments ADD COLUMN IF NOT EXISTS claimed_sha256 CHAR(64) REFERENCES blobs(sha256);
+ALTER TABLE attachments ADD COLUMN IF NOT EXISTS proof_digest CHAR(64);
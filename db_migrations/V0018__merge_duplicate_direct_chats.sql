@@ -0,0 +1,73 @@
+-- Слияние личных чатов, созданных для одной пары до появления direct_chats:
+-- V0004 отобразила на пару только самый ранний чат, остальные оставались в
+-- списке со своими сообщениями. Их сообщения и отметки прочтения переносятся
+-- в канонический чат, после чего дубликаты удаляются
+CREATE TEMP TABLE direct_chat_duplicates AS
+SELECT pair.chat_id, dc.chat_id AS canonical_id
+FROM (
+    SELECT c.id AS chat_id, MIN(cm.user_id) AS user_lo, MAX(cm.user_id) AS user_hi
+    FROM chats c
+    JOIN chat_members cm ON cm.chat_id = c.id
+    WHERE c.is_group = false
+    GROUP BY c.id
+    HAVING COUNT(*) = 2
+) pair
+JOIN direct_chats dc ON dc.user_lo = pair.user_lo AND dc.user_hi = pair.user_hi
+WHERE dc.chat_id <> pair.chat_id;
+
+-- Триггер версий поднимает change_seq канонического чата на каждое
+-- перенесённое сообщение, так что синхронизация клиентов их подхватит
+UPDATE messages m
+SET chat_id = d.canonical_id
+FROM direct_chat_duplicates d
+WHERE m.chat_id = d.chat_id;
+
+-- Отсоединённые архивные партиции сохраняют внешний ключ на chats
+DO $$
+DECLARE
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'messages_archive' AND c.relkind = 'r'
+    LOOP
+        EXECUTE format(
+            'UPDATE messages_archive.%I m SET chat_id = d.canonical_id
+             FROM direct_chat_duplicates d WHERE m.chat_id = d.chat_id',
+            partition_name
+        );
+    END LOOP;
+END;
+$$;
+
+-- Прочитанное в любом из чатов пары считается прочитанным
+UPDATE chat_members cm
+SET last_read_message_id = merged.last_read_message_id
+FROM (
+    SELECT d.canonical_id, dm.user_id, MAX(dm.last_read_message_id) AS last_read_message_id
+    FROM direct_chat_duplicates d
+    JOIN chat_members dm ON dm.chat_id = d.chat_id
+    GROUP BY d.canonical_id, dm.user_id
+) merged
+WHERE cm.chat_id = merged.canonical_id AND cm.user_id = merged.user_id
+AND cm.last_read_message_id < merged.last_read_message_id;
+
+UPDATE chats c
+SET last_message_id = latest.id,
+    last_message_at = latest.created_at,
+    last_activity_at = GREATEST(c.last_activity_at, latest.created_at)
+FROM (
+    SELECT DISTINCT ON (m.chat_id) m.chat_id, m.id, m.created_at
+    FROM messages m
+    WHERE m.chat_id IN (SELECT canonical_id FROM direct_chat_duplicates)
+    AND m.deleted_at IS NULL
+    ORDER BY m.chat_id, m.created_at DESC, m.id DESC
+) latest
+WHERE c.id = latest.chat_id;
+
+DELETE FROM chat_members WHERE chat_id IN (SELECT chat_id FROM direct_chat_duplicates);
+DELETE FROM chats WHERE id IN (SELECT chat_id FROM direct_chat_duplicates);
+
+DROP TABLE direct_chat_duplicates;
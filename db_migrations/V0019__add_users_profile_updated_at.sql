@@ -0,0 +1,21 @@
+-- Время последнего изменения профиля: ETag списка контактов берёт его
+-- максимум по контактам, поэтому смена имени, аватара, описания или телефона
+-- контакта меняет ETag, хотя contacts_version владельца списка не трогается
+ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+CREATE OR REPLACE FUNCTION users_touch_profile_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.profile_updated_at := clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Как и profile_changed, срабатывает только при фактическом изменении:
+-- повторный вход с тем же именем ETag не сбрасывает
+DROP TRIGGER IF EXISTS trg_users_touch_profile_updated_at ON users;
+CREATE TRIGGER trg_users_touch_profile_updated_at
+    BEFORE UPDATE OF name, avatar, bio, phone ON users
+    FOR EACH ROW
+    WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.avatar IS DISTINCT FROM NEW.avatar
+          OR OLD.bio IS DISTINCT FROM NEW.bio OR OLD.phone IS DISTINCT FROM NEW.phone)
+    EXECUTE FUNCTION users_touch_profile_updated_at();
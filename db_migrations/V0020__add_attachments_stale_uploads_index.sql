@@ -0,0 +1,4 @@
+-- Уборка брошенных загрузок ищет незавершённые по возрасту; готовые
+-- вложения, которых подавляющее большинство, в индекс не входят
+CREATE INDEX IF NOT EXISTS idx_attachments_uploading_created_at
+    ON attachments(created_at) WHERE status = 'uploading';
@@ -5,6 +5,26 @@ export const API_ENDPOINTS = {
   messages: 'https://functions.poehali.dev/896c0236-c3b8-49f5-a834-422ba2f91333',
 };
 
+const SESSION_TOKENS_KEY = 'whatsok_session_tokens';
+
+const readSessionTokens = (): Record<string, string> => {
+  try {
+    return JSON.parse(localStorage.getItem(SESSION_TOKENS_KEY) || '{}');
+  } catch {
+    return {};
+  }
+};
+
+export const saveSessionToken = (userId: string | number, token?: string | null) => {
+  const tokens = readSessionTokens();
+  if (token) {
+    tokens[String(userId)] = token;
+  } else {
+    delete tokens[String(userId)];
+  }
+  localStorage.setItem(SESSION_TOKENS_KEY, JSON.stringify(tokens));
+};
+
 export const apiRequest = async (
   endpoint: string,
   options: RequestInit = {},
@@ -16,6 +36,10 @@ export const apiRequest = async (
   };
 
   if (userId) {
+    const token = readSessionTokens()[userId];
+    if (token) {
+      headers['Authorization'] = `Bearer ${token}`;
+    }
     headers['X-User-Id'] = userId;
   }
 
@@ -2,7 +2,7 @@ import { useState } from 'react';
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import Icon from '@/components/ui/icon';
-import { API_ENDPOINTS, apiRequest } from '@/config/api';
+import { API_ENDPOINTS, apiRequest, saveSessionToken } from '@/config/api';
 
 type AuthProps = {
   onAuthComplete: (phone: string, name: string, userId: number) => void;
@@ -76,6 +76,8 @@ const Auth = ({ onAuthComplete }: AuthProps) => {
         throw new Error('Server did not return user ID');
       }
       
+      saveSessionToken(response.id, response.token);
+      
       onAuthComplete(phone, name, response.id);
     } catch (err: any) {
       console.error('Auth error:', err);
@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from 'react';
+import { useState, useEffect, useCallback, useRef, useLayoutEffect } from 'react';
 import Icon from '@/components/ui/icon';
 import { API_ENDPOINTS, apiRequest } from '@/config/api';
 import { Avatar, AvatarFallback, AvatarImage } from '@/components/ui/avatar';
@@ -45,6 +45,7 @@ type Message = {
   isEdited?: boolean;
   isForwarded?: boolean;
   forwardedFrom?: string;
+  createdAt?: string;
 };
 
 type Story = {
@@ -55,6 +56,34 @@ type Story = {
   hasViewed: boolean;
 };
 
+const HISTORY_SCROLL_THRESHOLD = 80;
+
+const toMessage = (msg: any, referenced?: Record<string, { text: string; senderName: string }>): Message => {
+  const msgTime = new Date(msg.createdAt);
+  const timeString = `${msgTime.getHours()}:${msgTime.getMinutes().toString().padStart(2, '0')}`;
+  
+  return {
+    id: msg.id,
+    text: msg.text || '',
+    time: timeString,
+    isOwn: msg.isOwn,
+    isVoice: msg.isVoice,
+    voiceDuration: msg.voiceDuration,
+    isFile: msg.isFile,
+    fileName: msg.fileName,
+    fileSize: msg.fileSize,
+    isEdited: msg.isEdited,
+    isForwarded: msg.isForwarded,
+    forwardedFrom: msg.forwardedFrom,
+    replyTo: msg.replyToId ? {
+      id: msg.replyToId,
+      text: referenced?.[msg.replyToId]?.text || '',
+      sender: referenced?.[msg.replyToId]?.senderName || '',
+    } : undefined,
+    createdAt: msg.createdAt,
+  };
+};
+
 type IndexProps = {
   userName?: string;
   userAvatar?: string;
@@ -88,6 +117,9 @@ const Index = ({ userName = 'Вы', userAvatar, userPhone, userId, onUpdateProfi
   const [messages, setMessages] = useState<Message[]>([]);
   const [currentChatId, setCurrentChatId] = useState<number | null>(null);
   const [isLoadingMessages, setIsLoadingMessages] = useState(false);
+  const [historyCursor, setHistoryCursor] = useState<string | null>(null);
+  const [isLoadingOlderMessages, setIsLoadingOlderMessages] = useState(false);
+  const scrollRestoreRef = useRef<{ viewport: HTMLElement; scrollHeight: number; scrollTop: number } | null>(null);
 
   const chats: Chat[] = [];
 
@@ -119,36 +151,64 @@ const Index = ({ userName = 'Вы', userAvatar, userPhone, userId, onUpdateProfi
         setCurrentChatId(response.chatId);
       }
       
-      const loadedMessages: Message[] = (response.messages || []).map((msg: any) => {
-        const msgTime = new Date(msg.createdAt);
-        const timeString = `${msgTime.getHours()}:${msgTime.getMinutes().toString().padStart(2, '0')}`;
-        
-        return {
-          id: msg.id,
-          text: msg.text || '',
-          time: timeString,
-          isOwn: msg.isOwn,
-          isVoice: msg.isVoice,
-          voiceDuration: msg.voiceDuration,
-          isFile: msg.isFile,
-          fileName: msg.fileName,
-          fileSize: msg.fileSize,
-          isEdited: msg.isEdited,
-          isForwarded: msg.isForwarded,
-          forwardedFrom: msg.forwardedFrom,
-          replyTo: msg.replyToId ? { id: msg.replyToId, text: '', sender: '' } : undefined,
-        };
-      });
+      const loadedMessages: Message[] = (response.messages || []).map((msg: any) => toMessage(msg, response.referenced));
       
       setMessages(loadedMessages);
+      setHistoryCursor(response.hasMore ? response.nextCursor : null);
+      
+      const lastIncoming = [...loadedMessages].reverse().find((msg) => !msg.isOwn);
+      if (response.chatId && lastIncoming) {
+        apiRequest(`${API_ENDPOINTS.messages}?action=read`, {
+          method: 'POST',
+          body: JSON.stringify({ chatId: response.chatId, messageId: lastIncoming.id }),
+        }, userId).catch((err) => console.error('Failed to mark chat as read:', err));
+      }
     } catch (err) {
       console.error('Failed to load messages:', err);
       setMessages([]);
+      setHistoryCursor(null);
     } finally {
       setIsLoadingMessages(false);
     }
   }, [selectedChat, newChatContact, currentChatId, userId]);
 
+  const loadOlderMessages = useCallback(async (viewport: HTMLElement) => {
+    if (!currentChatId || !historyCursor || isLoadingOlderMessages) return;
+    
+    setIsLoadingOlderMessages(true);
+    try {
+      const url = `${API_ENDPOINTS.messages}?chatId=${currentChatId}&before=${encodeURIComponent(historyCursor)}`;
+      const response = await apiRequest(url, { method: 'GET' }, userId);
+      const olderMessages: Message[] = (response.messages || []).map((msg: any) => toMessage(msg, response.referenced));
+      
+      // После вставки сверху возвращаем пользователя к тому же сообщению
+      scrollRestoreRef.current = { viewport, scrollHeight: viewport.scrollHeight, scrollTop: viewport.scrollTop };
+      setMessages(prevMessages => {
+        const known = new Set(prevMessages.map(msg => msg.id));
+        return [...olderMessages.filter(msg => !known.has(msg.id)), ...prevMessages];
+      });
+      setHistoryCursor(response.hasMore ? response.nextCursor : null);
+    } catch (err) {
+      console.error('Failed to load older messages:', err);
+    } finally {
+      setIsLoadingOlderMessages(false);
+    }
+  }, [currentChatId, historyCursor, isLoadingOlderMessages, userId]);
+
+  useLayoutEffect(() => {
+    const restore = scrollRestoreRef.current;
+    if (!restore) return;
+    scrollRestoreRef.current = null;
+    restore.viewport.scrollTop = restore.scrollTop + (restore.viewport.scrollHeight - restore.scrollHeight);
+  }, [messages]);
+
+  const handleMessagesScroll = (e: React.UIEvent<HTMLDivElement>) => {
+    const viewport = e.target as HTMLElement;
+    if (viewport.scrollTop <= HISTORY_SCROLL_THRESHOLD) {
+      loadOlderMessages(viewport);
+    }
+  };
+
   useEffect(() => {
     if (selectedChat || newChatContact) {
       loadMessages();
@@ -197,7 +257,7 @@ const Index = ({ userName = 'Вы', userAvatar, userPhone, userId, onUpdateProfi
       try {
         await apiRequest(API_ENDPOINTS.messages, {
           method: 'PUT',
-          body: JSON.stringify({ messageId: editingMessage.id, text: messageInput })
+          body: JSON.stringify({ messageId: editingMessage.id, createdAt: editingMessage.createdAt, text: messageInput })
         }, userId);
         
         setMessages(messages.map(msg => 
@@ -267,7 +327,7 @@ const Index = ({ userName = 'Вы', userAvatar, userPhone, userId, onUpdateProfi
       setMessages(prevMessages => {
         const updated = prevMessages.map(msg => 
           msg.id === tempId 
-            ? { ...msg, id: response.id }
+            ? { ...msg, id: response.id, createdAt: response.createdAt }
             : msg
         );
         console.log('Updated messages with real ID:', updated.length);
@@ -302,8 +362,10 @@ const Index = ({ userName = 'Вы', userAvatar, userPhone, userId, onUpdateProfi
   };
 
   const handleDeleteMessage = async (messageId: number) => {
+    const createdAt = messages.find(msg => msg.id === messageId)?.createdAt;
     try {
-      await apiRequest(`${API_ENDPOINTS.messages}?messageId=${messageId}`, {
+      const createdAtParam = createdAt ? `&createdAt=${encodeURIComponent(createdAt)}` : '';
+      await apiRequest(`${API_ENDPOINTS.messages}?messageId=${messageId}${createdAtParam}`, {
         method: 'DELETE'
       }, userId);
       
@@ -668,7 +730,12 @@ const Index = ({ userName = 'Вы', userAvatar, userPhone, userId, onUpdateProfi
             </div>
           </div>
 
-          <ScrollArea className="flex-1 px-6 py-6">
+          <ScrollArea className="flex-1 px-6 py-6" onScrollCapture={handleMessagesScroll}>
+            {isLoadingOlderMessages && (
+              <div className="flex justify-center pb-4">
+                <Icon name="Loader2" size={20} className="animate-spin text-muted-foreground" />
+              </div>
+            )}
             {newChatContact && messages.length === 0 && !isLoadingMessages && (
               <div className="text-center py-8 mb-4">
                 <div className="w-24 h-24 mx-auto mb-4 bg-primary/10 rounded-full flex items-center justify-center">